@@ -0,0 +1,134 @@
+### === API APPLICATION === ###
+# The FastAPI app without the web interface: auth, uploads, downloads, tiles, jobs, project
+# deletion and metrics, plus the background services they need. main.py mounts the NiceGUI
+# pages on top of it; API-only and batch nodes serve it directly and never import NiceGUI:
+#   uvicorn api:fastapi_app --workers 4
+#   LOTOGRAFIA_HEADLESS=1 python main.py
+import os
+from datetime import timedelta
+from typing import Annotated
+
+from fastapi import Depends, FastAPI, HTTPException, status
+from fastapi.security import OAuth2PasswordRequestForm
+
+from auth import (
+    ACCESS_TOKEN_EXPIRE_MINUTES, HashingPoolBusy, authenticate_user_async, create_access_token,
+    get_current_active_user, oauth2_scheme,
+)
+from config import USER_PROJECTS_PATH
+from db_connector import create_db_and_tables
+from direct_uploads import router as direct_uploads_router, resumer as import_resumer
+from downloads import router as downloads_router
+from image_tiles import router as image_tiles_router
+from jobs import router as jobs_router, scheduler
+from measurements import router as measurements_router
+from metrics import router as metrics_router, MetricsMiddleware
+from models import Token, User, UserPublic
+from previews import router as previews_router
+from spatial import router as spatial_router
+from tiling import router as tiling_router
+from trash import router as trash_router, reclaimer
+from uploads import router as uploads_router
+import usage
+
+fastapi_app = FastAPI()
+
+fastapi_app.include_router(uploads_router) # resumable uploads (tus-style)
+fastapi_app.include_router(direct_uploads_router) # multipart uploads straight to S3
+fastapi_app.include_router(downloads_router) # ranged/conditional file downloads
+fastapi_app.include_router(tiling_router) # Potree octrees of uploaded point clouds
+fastapi_app.include_router(image_tiles_router) # thumbnails and tile pyramids of images
+fastapi_app.include_router(previews_router) # top-down previews of point clouds
+fastapi_app.include_router(spatial_router) # bbox/polygon point queries
+fastapi_app.include_router(measurements_router) # distances, areas, profiles and volumes
+fastapi_app.include_router(jobs_router) # processing jobs (dense point clouds)
+fastapi_app.include_router(trash_router) # project deletion
+fastapi_app.include_router(metrics_router) # Prometheus /metrics
+fastapi_app.add_middleware(MetricsMiddleware) # request latency per route, optional span log
+
+@fastapi_app.on_event("startup")
+def on_startup():
+    create_db_and_tables()
+    if not os.path.exists(USER_PROJECTS_PATH):
+        os.makedirs(USER_PROJECTS_PATH)
+    scheduler.start()
+    reclaimer.start()
+    import_resumer.start() # direct upload imports interrupted by a restart
+    usage.reconciler.start()
+
+
+@fastapi_app.on_event("shutdown")
+async def on_shutdown():
+    await scheduler.stop()
+    await reclaimer.stop()
+    await import_resumer.stop()
+    await usage.reconciler.stop()
+
+
+@fastapi_app.post("/token") # endpoint to obtain a JWT token needed to access protected routes
+async def login_for_access_token(
+    form_data: Annotated[OAuth2PasswordRequestForm, Depends()],
+) -> Token:
+    try:
+        user = await authenticate_user_async(form_data.username, form_data.password)
+    except HashingPoolBusy:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Too many logins in progress, try again shortly",
+            headers={"Retry-After": "1"}
+        )
+    if not user:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Incorrect username or password",
+            headers={"WWW-Authenticate": "Bearer"}
+        )
+    access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    access_token = create_access_token(
+        # "sub" stems from "subject" and is a standard defined in JWT docs
+        data = {"sub": user.username}, expires_delta=access_token_expires)
+    return Token(access_token=access_token, token_type="bearer")
+
+### WITH NO JWT (left here for learning purposes) ###
+# @fastapi_app.post("/token") # according to OAuth2 spec, this response must be a JSON object
+# async def login(form_data: Annotated[OAuth2PasswordRequestForm, Depends()]):
+#     user_dict = fake_users_db.get(form_data.username)
+#     if not user_dict:
+#         raise HTTPException(status_code=400, detail="Incorrect username or password")
+#     user = UserInDB(**user_dict)
+#     hashed_password = fake_hash_password(form_data.password)
+#     if not hashed_password == user.hashed_password:
+#         raise HTTPException(status_code=400, detail="Incorrect username or password")
+
+#     # this access token should be something unique and secret
+#     return {"access_token": user.username, "token_type": "bearer"}
+
+
+# @fastapi_app.get("/users/me/items/")
+# async def read_own_items(current_user):
+#     return [{"item_id": "Foo", "owner": current_user.username}]
+
+@fastapi_app.get("/users/me", response_model=UserPublic)
+async def read_users_me(
+    current_user: Annotated[User, Depends(get_current_active_user)]
+    ):
+    return current_user
+
+
+@fastapi_app.get("/users/me/items/")
+async def read_own_items(
+    current_user: Annotated[User, Depends(get_current_active_user)],
+):
+    return [{"item_id": "Foo", "owner": current_user.username}]
+
+
+@fastapi_app.get("/items/")
+async def read_items(token: Annotated[str, Depends(oauth2_scheme)]):
+    return {"token": token}
+
+
+### ROOT
+@fastapi_app.get('/')
+def get_root():
+    return {'message': 'Hello, FastAPI! Browse to /app to see the NiceGUI app.'}
+
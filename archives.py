@@ -0,0 +1,410 @@
+### === STREAMING ARCHIVE EXTRACTION === ###
+# ZIP and TAR uploads can be unpacked into the project while they arrive, so the archive itself is
+# never stored: the upload feeds its chunks into a ChunkPipe, a thread reads the archive from it
+# sequentially and writes every member straight to the project (hashed on the way), and each
+# finished member is ingested like a single upload. Memory stays bounded by the pipe size.
+# - members are flattened to plain file names; absolute paths, ".." and links are never followed
+# - a member never replaces a file the project already has, it gets a numbered name instead
+# - TAR (also .tar.gz/.bz2/.xz) is sequential by design, members are ingested as they complete
+# - ZIP is read through its local headers and only trusted after the central directory at the
+#   end agrees (same offsets, CRC and size); members are held in .partial until then
+import asyncio
+import os
+import queue
+import re
+import struct
+import tarfile
+import uuid
+import zlib
+
+from starlette.concurrency import run_in_threadpool
+
+from blobs import HashingWriter
+from config import PARTIAL_UPLOADS_DIRNAME
+from file_index import project_dir
+from ingest import ingest_file
+from metrics import ARCHIVE_MEMBERS
+
+ARCHIVE_SUFFIXES = {".zip": "zip", ".tar": "tar", ".tgz": "tar", ".tar.gz": "tar", ".tar.bz2": "tar", ".tar.xz": "tar"}
+PIPE_CHUNKS = 8  # chunks buffered between the upload and the extraction thread
+READ_SIZE = 1024 * 1024
+
+ZIP_LOCAL = b"PK\x03\x04"
+ZIP_CENTRAL = b"PK\x01\x02"
+ZIP_DESCRIPTOR = b"PK\x07\x08"
+ZIP_END = (b"PK\x05\x06", b"PK\x06\x06", b"PK\x06\x07")  # end of central directory (classic, zip64, zip64 locator)
+LOCAL_HEADER = struct.Struct("<HHHHHIIIHH")  # version, flags, method, time, date, crc, compressed, size, name, extra
+CENTRAL_HEADER = struct.Struct("<HHHHHHIIIHHHHHII")  # made by, version, flags, method, time, date, crc, compressed,
+                                                     # size, name, extra, comment, disk, internal, external, offset
+ZIP64_EXTRA = 0x0001
+MAX32 = 0xFFFFFFFF
+
+
+class ArchiveError(Exception):
+    pass
+
+
+def archive_kind(filename: str) -> str | None:
+    lower = filename.lower()
+    for suffix, kind in ARCHIVE_SUFFIXES.items():
+        if lower.endswith(suffix):
+            return kind
+    return None
+
+
+def member_parts(path: str) -> list[str] | None:
+    # folders and name of an archive member; None for members that are never extracted
+    path = path.replace("\\", "/")
+    parts = [part for part in path.split("/") if part not in ("", ".")]
+    if path.startswith("/") or re.match(r"^[A-Za-z]:", path) or ".." in parts or "\0" in path:
+        return None  # absolute or escaping paths
+    if not parts or any(part.startswith(".") or part == "__MACOSX" for part in parts):
+        return None  # hidden files and macOS resource forks
+    return parts
+
+
+def member_name(path: str, used: set[str]) -> str | None:
+    # flat, safe project file name for an archive member; None -> skip it
+    parts = member_parts(path)
+    if parts is None:
+        return None
+    name = parts[-1]
+    if name in used:  # same name in another folder of the archive: keep the folder in the name
+        name = "_".join(parts)
+        stem, ext = os.path.splitext(name)
+        counter = 1
+        while name in used:
+            name = f"{stem}_{counter}{ext}"
+            counter += 1
+    used.add(name)
+    return name
+
+
+class ChunkPipe:
+    # file-like object read by the extraction thread and fed from the event loop
+    def __init__(self, maxsize: int = PIPE_CHUNKS):
+        self.queue = queue.Queue(maxsize)
+        self.buffer = bytearray()
+        self.position = 0  # bytes handed to the reader
+        self.eof = False
+        self.closed = False  # the reader is gone, further chunks are dropped
+
+    def put(self, chunk: bytes | None) -> bool:
+        # blocking (call it in the threadpool); None marks the end; False once the reader stopped
+        while not self.closed:
+            try:
+                self.queue.put(chunk, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def read(self, size: int = -1) -> bytes:
+        while not self.eof and (size < 0 or len(self.buffer) < size):
+            try:
+                chunk = self.queue.get(timeout=0.1)
+            except queue.Empty:
+                if self.closed:
+                    raise ArchiveError("Extraction aborted")
+                continue
+            if chunk is None:
+                self.eof = True
+            else:
+                self.buffer += chunk
+        size = len(self.buffer) if size < 0 else min(size, len(self.buffer))
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        self.position += size
+        return data
+
+    def read_exactly(self, size: int) -> bytes:
+        data = self.read(size)
+        if len(data) != size:
+            raise ArchiveError("Archive is truncated")
+        return data
+
+    def unread(self, data: bytes) -> None:
+        # gives back bytes read past the end of a deflate stream
+        self.buffer[:0] = data
+        self.position -= len(data)
+
+    def close(self) -> None:
+        self.closed = True
+
+
+class ArchiveExtractor:
+    # extracts one archive into a project; feed() the chunks in order, then finish()
+    def __init__(self, project_id: int, kind: str, limit: int | None = None):
+        self.project_id = project_id
+        self.kind = kind
+        self.limit = limit  # bytes the extracted members may add up to (quota), None = unlimited
+        self.pipe = ChunkPipe()
+        self.ready: queue.Queue = queue.Queue()  # (name, sha256) of members ready to be ingested
+        self.partial_dir = os.path.join(project_dir(project_id), PARTIAL_UPLOADS_DIRNAME)
+        self.pending: list[str] = []  # partial files written but not moved into place yet
+        self.used: set[str] = set()
+        self.extracted_bytes = 0
+        self.report = {"extracted": [], "skipped": []}
+        self.future: asyncio.Future | None = None
+
+    def start(self) -> None:
+        os.makedirs(self.partial_dir, exist_ok=True)
+        self.future = asyncio.get_running_loop().run_in_executor(None, self.run)
+
+    async def feed(self, chunk: bytes) -> None:
+        if not await run_in_threadpool(self.pipe.put, chunk):
+            await self.future  # the reader stopped early: raises its error, or the archive simply ended
+        await self.ingest_ready()
+
+    async def finish(self) -> dict:
+        await run_in_threadpool(self.pipe.put, None)
+        await self.future
+        await self.ingest_ready()
+        ARCHIVE_MEMBERS.inc(len(self.report["extracted"]), outcome="extracted")
+        ARCHIVE_MEMBERS.inc(len(self.report["skipped"]), outcome="skipped")
+        return self.report
+
+    async def abort(self) -> None:
+        self.pipe.close()
+        if self.future is not None:
+            try:
+                await self.future
+            except Exception:
+                pass
+
+    async def ingest_ready(self) -> None:
+        while not self.ready.empty():
+            name, sha256 = self.ready.get_nowait()
+            await ingest_file(self.project_id, name, sha256)
+            self.report["extracted"].append(name)
+
+    ### extraction thread
+    def run(self) -> None:
+        try:
+            self.used.update(name for name in os.listdir(project_dir(self.project_id)) if not name.startswith("."))
+            if self.kind == "zip":
+                self.extract_zip()
+            else:
+                self.extract_tar()
+        finally:
+            self.pipe.close()
+            for partial in self.pending:  # members that never made it into the project
+                if os.path.exists(partial):
+                    os.remove(partial)
+
+    def write_member(self, read) -> tuple[str, str, int, int]:
+        # copies read(n) until it returns b"" into a partial file; returns (partial path, sha256, crc32, size)
+        partial = os.path.join(self.partial_dir, uuid.uuid4().hex)
+        self.pending.append(partial)
+        writer = HashingWriter(partial)
+        crc, size = 0, 0
+        try:
+            while data := read(READ_SIZE):
+                size += len(data)
+                self.extracted_bytes += len(data)
+                if self.limit is not None and self.extracted_bytes > self.limit:
+                    raise ArchiveError("Storage quota exceeded")
+                writer.write(data)
+                crc = zlib.crc32(data, crc)
+        finally:
+            sha256 = writer.close()
+        return partial, sha256, crc, size
+
+    def place(self, partial: str, name: str, sha256: str) -> None:
+        if os.path.exists(os.path.join(project_dir(self.project_id), name)):  # uploaded since the extraction started
+            name = member_name(name, self.used)
+        os.replace(partial, os.path.join(project_dir(self.project_id), name))
+        self.pending.remove(partial)
+        self.ready.put((name, sha256))
+
+    def extract_tar(self) -> None:
+        try:
+            with tarfile.open(fileobj=self.pipe, mode="r|*") as archive:
+                for member in archive:
+                    name = member_name(member.name, self.used) if member.isfile() else None
+                    if name is None:  # directories, links, devices, unsafe or hidden paths
+                        if not member.isdir():
+                            self.report["skipped"].append(member.name)
+                        continue
+                    partial, sha256, _, _ = self.write_member(archive.extractfile(member).read)
+                    self.place(partial, name, sha256)
+        except tarfile.TarError as e:
+            raise ArchiveError(f"Invalid TAR archive: {e}") from e
+
+    def extract_zip(self) -> None:
+        pipe = self.pipe
+        members = {}  # local header offset -> (path, partial, sha256, crc32, size)
+        signature = pipe.read(4)
+        while signature == ZIP_LOCAL:
+            offset = pipe.position - 4
+            _, flags, method, _, _, crc, compressed, size, name_length, extra_length = \
+                LOCAL_HEADER.unpack(pipe.read_exactly(LOCAL_HEADER.size))
+            path = pipe.read_exactly(name_length).decode("utf-8" if flags & 0x800 else "cp437")
+            extra = pipe.read_exactly(extra_length)
+            zip64 = zip64_fields(extra, [size, compressed], (size, compressed))
+            if zip64 is not None:
+                size, compressed = zip64
+            has_descriptor = bool(flags & 0x08)
+
+            if has_descriptor and (flags & 0x01 or method != 8):
+                # the end of the data can only be found by inflating it
+                raise ArchiveError(f"Cannot stream {path}: entry without sizes")
+            if flags & 0x01 or method not in (0, 8):  # encrypted or unsupported compression
+                self.report["skipped"].append(path)
+                skip_reader(limited_reader(pipe, compressed))
+                signature = pipe.read(4)
+                continue
+
+            if has_descriptor:
+                raw, read = None, inflating_reader(pipe.read, pipe.unread)
+            else:
+                raw = limited_reader(pipe, compressed)
+                read = raw if method == 0 else inflating_reader(raw, lambda data: None)
+            if path.endswith("/") or member_parts(path) is None:
+                result = None
+                skip_reader(read)
+                if not path.endswith("/"):
+                    self.report["skipped"].append(path)
+            else:
+                result = self.write_member(read)
+            if raw is not None:
+                skip_reader(raw)  # whatever the deflate stream didn't use
+            if has_descriptor:
+                crc, compressed, size = read_descriptor(pipe, zip64 is not None)
+            if result is not None:
+                members[offset] = (path, *result, crc, size)
+            signature = pipe.read(4)
+
+        # central directory: the archive's own list of members decides what is kept
+        listed = {}
+        while signature == ZIP_CENTRAL:
+            fields = CENTRAL_HEADER.unpack(pipe.read_exactly(CENTRAL_HEADER.size))
+            crc, compressed, size = fields[6:9]
+            name_length, extra_length, comment_length, offset = fields[9], fields[10], fields[11], fields[15]
+            path = pipe.read_exactly(name_length).decode("utf-8" if fields[2] & 0x800 else "cp437")
+            extra = pipe.read_exactly(extra_length)
+            pipe.read_exactly(comment_length)
+            wanted = [value for value in (size, compressed, offset) if value == MAX32]
+            values = zip64_fields(extra, wanted, (size, compressed, offset))
+            if values is not None:
+                size, compressed, offset = values
+            listed[offset] = (path, crc, size)
+            signature = pipe.read(4)
+        if signature not in ZIP_END:
+            raise ArchiveError("Invalid ZIP archive: central directory not found")
+        pipe.read()  # drain the end records and comment
+
+        for offset, (path, partial, sha256, written_crc, written_size, crc, size) in members.items():
+            verified = listed.get(offset) == (path, written_crc, written_size) and (crc, size) == (written_crc, written_size)
+            name = member_name(path, self.used) if verified else None
+            if name is None:
+                # stale/duplicate local entries, corrupt data or unsafe names are dropped
+                self.report["skipped"].append(path)
+                continue
+            self.place(partial, name, sha256)
+        for offset, (path, _, _) in listed.items():
+            if offset not in members and not path.endswith("/") and path not in self.report["skipped"]:
+                self.report["skipped"].append(path)
+
+
+### ZIP stream helpers
+def zip64_fields(extra: bytes, wanted: list, values: tuple) -> tuple | None:
+    # replaces the 0xFFFFFFFF placeholders in values by the zip64 extra field, in order
+    position = 0
+    while position + 4 <= len(extra):
+        header_id, length = struct.unpack_from("<HH", extra, position)
+        if header_id == ZIP64_EXTRA:
+            data = extra[position + 4:position + 4 + length]
+            result, index = [], 0
+            for value in values:
+                if value == MAX32 and index + 8 <= len(data):
+                    value = struct.unpack_from("<Q", data, index)[0]
+                    index += 8
+                result.append(value)
+            return tuple(result)
+        position += 4 + length
+    return None
+
+
+def read_descriptor(pipe: ChunkPipe, zip64: bool) -> tuple[int, int, int]:
+    # crc32, compressed size, size; the signature is optional
+    head = pipe.read_exactly(4)
+    if head == ZIP_DESCRIPTOR:
+        head = pipe.read_exactly(4)
+    crc = struct.unpack("<I", head)[0]
+    if zip64:
+        compressed, size = struct.unpack("<QQ", pipe.read_exactly(16))
+    else:
+        compressed, size = struct.unpack("<II", pipe.read_exactly(8))
+    return crc, compressed, size
+
+
+def limited_reader(pipe: ChunkPipe, length: int):
+    remaining = [length]
+
+    def read(size: int) -> bytes:
+        data = pipe.read_exactly(min(size, remaining[0])) if remaining[0] else b""
+        remaining[0] -= len(data)
+        return data
+    return read
+
+
+def inflating_reader(raw_read, unread):
+    # raw deflate; input the stream doesn't use (past its end marker) is given back through unread
+    decompressor = zlib.decompressobj(-15)
+
+    def read(size: int) -> bytes:
+        while not decompressor.eof:
+            data = decompressor.unconsumed_tail or raw_read(64 * 1024)
+            if not data:
+                raise ArchiveError("Archive is truncated")
+            output = decompressor.decompress(data, size)
+            if decompressor.unused_data:
+                unread(decompressor.unused_data)
+            if output:
+                return output
+        return b""
+    return read
+
+
+def skip_reader(read) -> None:
+    while read(READ_SIZE):
+        pass
+
+
+def test_member_name():
+    used = set()
+    assert member_name("DCIM/100/IMG_1.JPG", used) == "IMG_1.JPG"
+    assert member_name("DCIM/101/IMG_1.JPG", used) == "DCIM_101_IMG_1.JPG"
+    assert member_name("../../etc/passwd", used) is None
+    assert member_name("/etc/passwd", used) is None
+    assert member_name("__MACOSX/._IMG_1.JPG", used) is None
+
+
+def test_extract_keeps_existing_files():
+    import io
+    from config import USER_PROJECTS_PATH
+    from db_connector import create_db_and_tables
+    assert "lotografia-test-" in USER_PROJECTS_PATH, "run it through pytest"
+    create_db_and_tables()
+    project_id = 990017
+    os.makedirs(project_dir(project_id), exist_ok=True)
+    with open(os.path.join(project_dir(project_id), "notes.txt"), "wb") as f:
+        f.write(b"existing")
+    data = io.BytesIO()
+    with tarfile.open(fileobj=data, mode="w") as archive:
+        for path in ("notes.txt", "a/notes.txt"):
+            info = tarfile.TarInfo(path)
+            info.size = len(path)
+            archive.addfile(info, io.BytesIO(path.encode()))
+
+    async def extract() -> dict:
+        extractor = ArchiveExtractor(project_id, "tar")
+        extractor.start()
+        await extractor.feed(data.getvalue())
+        return await extractor.finish()
+
+    report = asyncio.run(extract())
+    assert sorted(report["extracted"]) == ["a_notes.txt", "notes_1.txt"]
+    with open(os.path.join(project_dir(project_id), "notes.txt"), "rb") as f:
+        assert f.read() == b"existing"
@@ -1,5 +1,11 @@
 
 
+import asyncio
+import functools
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
 from typing import Annotated
 
@@ -7,11 +13,17 @@ from typing import Annotated
 import jwt
 from jwt.exceptions import InvalidTokenError
 from pwdlib import PasswordHash
+from pwdlib.hashers.argon2 import Argon2Hasher
+from sqlalchemy import event
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from fastapi import Depends, FastAPI, HTTPException, status
 from sqlmodel import select
 
+from config import ARGON2_TIME_COST, ARGON2_MEMORY_COST, ARGON2_PARALLELISM
+from config import HASHING_POOL_WORKERS, HASHING_POOL_MAX_QUEUE
+from config import PRINCIPAL_CACHE_SIZE, PRINCIPAL_CACHE_TTL
 from db_connector import engine, Session, DBConnector
+from metrics import FunctionGauge
 
 from models import Token, TokenData, User
 ### OAuth2
@@ -23,6 +35,7 @@ db = DBConnector()
 SECRET_KEY = "09d25e094faa6ca2556c818166b7a9563b93f7099f6f0f4caa6cf63b88e8d3e7"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
+FILE_TOKEN_EXPIRE_MINUTES = 60 * 12
 
 
 fake_users_db = {
@@ -45,7 +58,46 @@ fake_users_db = {
 }
 
 
-password_hash = PasswordHash.recommended() # from pwdlib
+password_hash = PasswordHash((
+    Argon2Hasher(time_cost=ARGON2_TIME_COST, memory_cost=ARGON2_MEMORY_COST, parallelism=ARGON2_PARALLELISM),
+))
+
+
+### Password hashing pool
+class HashingPoolBusy(Exception):
+    pass
+
+
+class HashingPool:
+    # runs Argon2 work on a fixed number of threads so it never blocks the event loop;
+    # when more than max_queue calls are already waiting, new ones are rejected right away
+    def __init__(self, max_workers: int, max_queue: int):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="argon2")
+        self.in_flight = 0
+        self.rejected = 0
+
+    @property
+    def queue_depth(self) -> int:
+        return max(0, self.in_flight - self.max_workers)
+
+    async def run(self, func, *args):
+        if self.queue_depth >= self.max_queue:
+            self.rejected += 1
+            raise HashingPoolBusy()
+        self.in_flight += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+        finally:
+            self.in_flight -= 1
+
+
+hashing_pool = HashingPool(HASHING_POOL_WORKERS, HASHING_POOL_MAX_QUEUE)
+FunctionGauge("lotografia_hashing_pool_in_flight", "Password hashes running or waiting.", lambda: hashing_pool.in_flight)
+FunctionGauge("lotografia_hashing_pool_queue_depth", "Password hashes waiting for a worker.", lambda: hashing_pool.queue_depth)
+FunctionGauge("lotografia_hashing_pool_rejected_total", "Logins turned away because the queue was full.",
+              lambda: hashing_pool.rejected, kind="counter")
 
 
 
@@ -57,6 +109,17 @@ def get_password_hash(password):
     return password_hash.hash(password)
 
 
+@functools.cache
+def dummy_hash() -> str:
+    return password_hash.hash("lotografia-dummy-password")
+
+
+def verify_unknown_user(password: str) -> bool:
+    # the same Argon2 work as a wrong password, so a login does not reveal whether the username exists
+    verify_password(password, dummy_hash())
+    return False
+
+
 # def get_user(db, username: str):
 #     if username in db:
 #         user_dict = db[username]
@@ -81,14 +144,143 @@ def get_password_hash(password):
 #         ).first()
 #         return user
 
+### Authenticated principal cache
+class PrincipalCache:
+    # TTL + LRU cache of users resolved from bearer tokens, keyed by username
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries: OrderedDict[str, tuple[float, User]] = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, username: str) -> User | None:
+        with self.lock:
+            entry = self.entries.get(username)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self.entries[username]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(username)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, username: str, user: User) -> None:
+        with self.lock:
+            self.entries[username] = (time.monotonic() + self.ttl, user)
+            self.entries.move_to_end(username)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, username: str | None = None) -> None:
+        # no username -> drop everything
+        with self.lock:
+            if username is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(username, None)
+
+    def invalidate_user_id(self, user_id: int) -> None:
+        # the username itself may have been changed, so look the entry up by id
+        with self.lock:
+            for username, (_, user) in list(self.entries.items()):
+                if user.id == user_id:
+                    del self.entries[username]
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"size": len(self.entries), "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+
+principal_cache = PrincipalCache(PRINCIPAL_CACHE_SIZE, PRINCIPAL_CACHE_TTL)
+FunctionGauge("lotografia_principal_cache_size", "Users held by the principal cache.", lambda: len(principal_cache.entries))
+FunctionGauge("lotografia_principal_cache_hits_total", "Principal cache hits.", lambda: principal_cache.hits, kind="counter")
+FunctionGauge("lotografia_principal_cache_misses_total", "Principal cache misses.", lambda: principal_cache.misses, kind="counter")
+FunctionGauge("lotografia_principal_cache_evictions_total", "Principal cache evictions.",
+              lambda: principal_cache.evictions, kind="counter")
+
+
+# every ORM update/delete of a User (disabling, password rehash, ...) evicts its cached principal in this
+# process; bulk UPDATE statements and changes made by other workers are only caught by the TTL
+@event.listens_for(User, "after_update")
+@event.listens_for(User, "after_delete")
+def _evict_changed_user(mapper, connection, target: User) -> None:
+    principal_cache.invalidate_user_id(target.id)
+
+
+async def get_user_cached(username: str) -> User | None:
+    user = principal_cache.get(username)
+    if user is None:
+        user = await db.get_user_async(username)
+        if user is not None:
+            principal_cache.put(username, user)
+    return user
+
+
+def test_principal_cache():
+    cache = PrincipalCache(2, 0.05)
+    a, b, c = User(id=1, username="a"), User(id=2, username="b"), User(id=3, username="c")
+    cache.put("a", a)
+    cache.put("b", b)
+    assert cache.get("a") is a  # a is now the most recently used
+    cache.put("c", c)
+    assert cache.get("b") is None and cache.get("a") is a and cache.evictions == 1
+    time.sleep(0.06)
+    assert cache.get("a") is None and cache.get("c") is None and not cache.entries
+
+    # ORM updates and deletes evict the cached principal, found by id even after a rename
+    from db_connector import create_db_and_tables
+    create_db_and_tables()
+    username = f"cache-test-{time.monotonic_ns()}"
+    try:
+        with Session(engine) as session:
+            user = User(username=username)
+            session.add(user)
+            session.commit()
+            session.refresh(user)
+            principal_cache.put(username, user)
+            renamed = user.username = username + "-renamed"
+            user.disabled = True
+            session.add(user)
+            session.commit()
+            assert principal_cache.get(username) is None
+            principal_cache.put(renamed, user)
+            session.delete(user)
+            session.commit()
+            assert principal_cache.get(renamed) is None
+    finally:  # a failed run leaves neither the user nor its cache entry behind
+        principal_cache.invalidate()
+        with Session(engine) as session:
+            for user in session.exec(select(User).where(User.username.startswith(username))).all():
+                session.delete(user)
+            session.commit()
+
+
 def authenticate_user(username: str, password: str) -> bool:
     user = db.get_user(username)
     if user is None:
-        return False
+        return verify_unknown_user(password)
     if verify_password(password, user.hashed_password):
         return user
     else: return False
             
+async def authenticate_user_async(username: str, password: str) -> User | bool:
+    # same as authenticate_user, but hashing happens on hashing_pool (may raise HashingPoolBusy)
+    user = await db.get_user_async(username)
+    if user is None:
+        return await hashing_pool.run(verify_unknown_user, password)
+    valid, updated_hash = await hashing_pool.run(password_hash.verify_and_update, password, user.hashed_password)
+    if not valid:
+        return False
+    if updated_hash is not None: # stored hash uses outdated cost parameters
+        await db.update_password_hash_async(username, updated_hash)
+        user.hashed_password = updated_hash
+    return user
+
 def test_authenticate_user(username = "test", password = "secret"):
     assert authenticate_user("test", "secret") != False
     assert authenticate_user("testa", "secret") == False
@@ -106,6 +298,24 @@ def create_access_token(data: dict, expires_delta: timedelta | None = None):
     return encoded_jwt
 
 
+### Signed file links
+# A file token grants read access to one project file (and what is derived from it) without a bearer header,
+# so browsers, viewers and download managers can fetch it directly. It has no "sub", so it is not a login token.
+def create_file_token(project_id: int, name: str, expires_delta: timedelta | None = None) -> str:
+    expire = datetime.now(timezone.utc) + (expires_delta or timedelta(minutes=FILE_TOKEN_EXPIRE_MINUTES))
+    return jwt.encode({"scope": "file", "pid": project_id, "name": name, "exp": expire}, SECRET_KEY, algorithm=ALGORITHM)
+
+
+def decode_file_token(token: str) -> tuple[int, str]:
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except InvalidTokenError:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Invalid or expired link")
+    if payload.get("scope") != "file":
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Invalid or expired link")
+    return payload["pid"], payload["name"]
+
+
 async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)]):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
@@ -120,7 +330,7 @@ async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)]):
         token_data = TokenData(username=username)
     except InvalidTokenError:
         raise credentials_exception
-    user = db.get_user(username=token_data.username)
+    user = await get_user_cached(token_data.username)
     if user is None: 
         raise credentials_exception
     return user
@@ -0,0 +1,243 @@
+### === BENCHMARKS === ###
+# Runs the app in-process (httpx ASGI transport, no network) against a throw-away SQLite
+# database and storage directory, and writes the results as JSON so runs of different
+# versions can be compared:
+#   python benchmark.py --output bench.json
+#   python benchmark.py --sizes 1MB,1GB,5GB --files 10,100,1000,10000 --requests 1000
+# Measured: /token login throughput, /users/me latency under concurrency, resumable upload
+# throughput, and render time of the /projects and /project/{id} NiceGUI pages.
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+SIZE_UNITS = {"KB": 1024, "MB": 1024**2, "GB": 1024**3}
+UPLOAD_CHUNK_SIZE = 64 * 1024**2  # bytes per PATCH request
+STREAM_BLOCK_SIZE = 1024**2
+USERNAME, PASSWORD = "bench", "bench-password"
+
+
+def parse_size(text: str) -> int:
+    text = text.strip().upper()
+    for unit, factor in SIZE_UNITS.items():
+        if text.endswith(unit):
+            return int(float(text[:-len(unit)]) * factor)
+    return int(text)
+
+
+def latency_stats(seconds: list[float], wall: float) -> dict:
+    ms = np.array(seconds) * 1000
+    return {
+        "requests": len(seconds),
+        "throughput_rps": round(len(seconds) / wall, 2) if wall else None,
+        "p50_ms": round(float(np.percentile(ms, 50)), 3),
+        "p95_ms": round(float(np.percentile(ms, 95)), 3),
+        "p99_ms": round(float(np.percentile(ms, 99)), 3),
+        "max_ms": round(float(ms.max()), 3),
+    }
+
+
+def git_version() -> str | None:
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], cwd=REPO_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run_concurrently(total: int, concurrency: int, request) -> tuple[list[float], float, dict[int, int]]:
+    # request() -> status code; returns per-request latencies, wall time and status histogram
+    latencies, statuses = [], {}
+    queue = iter(range(total))
+
+    async def worker():
+        for _ in queue:
+            start = time.perf_counter()
+            code = await request()
+            latencies.append(time.perf_counter() - start)
+            statuses[code] = statuses.get(code, 0) + 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies, time.perf_counter() - start, statuses
+
+
+### Fixtures
+def seed_user_and_projects(file_counts: list[int]) -> tuple[int, dict[int, int]]:
+    # one user, one project per file count; files are empty but real, rows are bulk inserted
+    from sqlmodel import Session
+    from auth import get_password_hash
+    from db_connector import engine
+    from file_index import project_dir
+    from models import Project, ProjectFile, User
+    import usage
+
+    with Session(engine) as session:
+        user = User(username=USERNAME, hashed_password=get_password_hash(PASSWORD))
+        session.add(user)
+        session.commit()
+        session.refresh(user)
+        projects = {}
+        for count in file_counts:
+            project = Project(name=f"bench-{count}", user_id=user.id)
+            session.add(project)
+            session.commit()
+            session.refresh(project)
+            os.makedirs(project_dir(project.id), exist_ok=True)
+            for i in range(count):
+                name = f"IMG_{i:05d}.jpg"
+                open(os.path.join(project_dir(project.id), name), "wb").close()
+                session.add(ProjectFile(project_id=project.id, name=name, size=0, content_type="image/jpeg"))
+            session.commit()
+            projects[count] = project.id
+        usage.recount(session)  # rows were inserted directly, not through file_index
+        session.commit()
+        return user.id, projects
+
+
+async def authenticate_ui(client) -> None:
+    # NiceGUI keeps the login state in app.storage.user, keyed by the session cookie:
+    # open a page once to get a session, then mark it as logged in
+    from nicegui import app
+    known = set(app.storage._users)
+    await client.get("/app/")
+    for session_id in set(app.storage._users) - known:
+        app.storage._users[session_id].update({"authenticated": True, "username": USERNAME})
+
+
+### Benchmarks
+async def bench_login(client, total: int, concurrency: int) -> dict:
+    async def request():
+        response = await client.post("/token", data={"username": USERNAME, "password": PASSWORD})
+        return response.status_code
+
+    latencies, wall, statuses = await run_concurrently(total, concurrency, request)
+    return {**latency_stats(latencies, wall), "concurrency": concurrency, "status_codes": statuses}
+
+
+async def bench_users_me(client, headers: dict, total: int, concurrency: int) -> dict:
+    async def request():
+        return (await client.get("/users/me", headers=headers)).status_code
+
+    latencies, wall, statuses = await run_concurrently(total, concurrency, request)
+    return {**latency_stats(latencies, wall), "concurrency": concurrency, "status_codes": statuses}
+
+
+async def bench_upload(client, headers: dict, project_id: int, size: int) -> dict:
+    block = os.urandom(STREAM_BLOCK_SIZE)
+
+    async def body(length: int):
+        while length > 0:
+            yield block[:min(length, STREAM_BLOCK_SIZE)]
+            length -= STREAM_BLOCK_SIZE
+
+    start = time.perf_counter()
+    response = await client.post(f"/projects/{project_id}/uploads", params={"filename": f"upload-{size}.bin"},
+                                 headers={**headers, "Upload-Length": str(size)})
+    location = response.headers["location"]
+    offset = 0
+    while offset < size:
+        length = min(UPLOAD_CHUNK_SIZE, size - offset)
+        response = await client.patch(location, content=body(length), headers={
+            **headers, "Upload-Offset": str(offset), "Content-Type": "application/offset+octet-stream",
+            "Content-Length": str(length),
+        })
+        if response.status_code != 204:
+            return {"bytes": size, "error": response.status_code}
+        offset += length
+    wall = time.perf_counter() - start
+    return {"bytes": size, "seconds": round(wall, 3), "throughput_mib_s": round(size / 1024**2 / wall, 2)}
+
+
+async def bench_page(client, path: str, repeat: int) -> dict:
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(repeat):
+        request_start = time.perf_counter()
+        response = await client.get(path)
+        latencies.append(time.perf_counter() - request_start)
+        if response.status_code != 200:
+            return {"error": response.status_code}
+    return {**latency_stats(latencies, time.perf_counter() - start), "bytes": len(response.content)}
+
+
+async def run(args) -> dict:
+    import httpx
+    import main
+
+    results = {}
+    # the app's lifespan runs NiceGUI's and our own startup/shutdown handlers, as under uvicorn
+    async with main.fastapi_app.router.lifespan_context(main.fastapi_app):
+        _, projects = seed_user_and_projects(args.files)
+        transport = httpx.ASGITransport(app=main.fastapi_app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+            results["login"] = await bench_login(client, args.logins, args.concurrency)
+            token = (await client.post("/token", data={"username": USERNAME, "password": PASSWORD})).json()["access_token"]
+            headers = {"Authorization": f"Bearer {token}"}
+            results["users_me"] = await bench_users_me(client, headers, args.requests, args.concurrency)
+
+            upload_project = projects[min(projects)]
+            results["upload"] = [await bench_upload(client, headers, upload_project, size) for size in args.sizes]
+
+            await authenticate_ui(client)
+            results["projects_page"] = await bench_page(client, "/app/projects", args.page_repeat)
+            results["project_page"] = {
+                str(count): await bench_page(client, f"/app/project/{project_id}", args.page_repeat)
+                for count, project_id in projects.items()
+            }
+    return results
+
+
+def main_cli() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the API and NiceGUI pages on a temporary database")
+    parser.add_argument("--sizes", default="1MB,100MB", help="upload sizes, e.g. 1MB,1GB,5GB")
+    parser.add_argument("--files", default="10,100,1000,10000", help="files per seeded project")
+    parser.add_argument("--logins", type=int, default=50, help="number of /token requests")
+    parser.add_argument("--requests", type=int, default=500, help="number of /users/me requests")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--page-repeat", type=int, default=5, help="renders per page")
+    parser.add_argument("--output", help="write the JSON results here instead of stdout")
+    args = parser.parse_args()
+    args.sizes = [parse_size(size) for size in args.sizes.split(",")]
+    args.files = sorted({int(count) for count in args.files.split(",")})
+    output = os.path.abspath(args.output) if args.output else None
+
+    with tempfile.TemporaryDirectory(prefix="lotografia-bench-") as work_dir:
+        # everything the app writes goes to the temporary directory - set before the app is imported
+        os.environ["LOTOGRAFIA_DATABASE_PATH"] = os.path.join(work_dir, "database.db")
+        os.environ["LOTOGRAFIA_USER_PROJECTS_PATH"] = os.path.join(work_dir, "user_projects")
+        os.environ["LOTOGRAFIA_BLOB_STORE_PATH"] = os.path.join(work_dir, "blobs")
+        os.environ["LOTOGRAFIA_TILE_CACHE_PATH"] = os.path.join(work_dir, "tiles")
+        os.environ["LOTOGRAFIA_SPATIAL_INDEX_PATH"] = os.path.join(work_dir, "spatial")
+        os.environ["LOTOGRAFIA_PREVIEW_CACHE_PATH"] = os.path.join(work_dir, "previews")
+        sys.path.insert(0, REPO_DIR)
+        os.chdir(work_dir)
+        results = asyncio.run(run(args))
+
+    report = {
+        "version": git_version(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "parameters": {key: value for key, value in vars(args).items() if key != "output"},
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if output:
+        with open(output, "w") as f:
+            f.write(text)
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main_cli()
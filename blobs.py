@@ -0,0 +1,180 @@
+### === CONTENT-ADDRESSED BLOB STORE === ###
+# Project files are hardlinks to blobs/<sha[:2]>/<sha[2:4]>/<sha256>, so content uploaded into
+# several projects is stored once, and moving or copying a file between projects is a rename
+# or a new link instead of a copy. A Blob row counts the ProjectFile rows using its content;
+# the store's link is removed when the count drops to zero and the disk space is freed once
+# the last project link is gone too. Refcounts are kept by file_index, in the same
+# transaction as the ProjectFile change.
+import errno
+import hashlib
+import os
+import shutil
+import uuid
+
+from sqlmodel import Session, select
+from sqlalchemy import func
+
+from config import BLOB_STORE_PATH, PREVIEW_CACHE_PATH, SPATIAL_INDEX_PATH
+from models import Blob, PointCloudMetadata, ProjectFile
+from storage import get_storage
+
+
+def blob_path(sha256: str) -> str:
+    return os.path.join(BLOB_STORE_PATH, sha256[:2], sha256[2:4], sha256)
+
+
+def blob_key(sha256: str) -> str:
+    # the copy of the content in the storage backend (mirror.py)
+    return f"blobs/{sha256}"
+
+
+def envelope_path(sha256: str) -> str:
+    # kept next to a blob that is stored compressed (see compression.py)
+    return blob_path(sha256) + ".envelope"
+
+
+def stored_encoding(path: str, sha256: str) -> str | None:
+    # "laz" when path is a link to the compressed copy of a LAS blob, None when it holds the content as is
+    if not os.path.exists(envelope_path(sha256)):
+        return None
+    with open(path, "rb") as f:
+        head = f.read(105)
+    # LAZ sets the two high bits of the point format byte
+    return "laz" if len(head) == 105 and head[:4] == b"LASF" and head[104] & 0xC0 else None
+
+
+def link_into_store(path: str, sha256: str) -> bool:
+    # blocking; makes the file at path share its inode with the stored blob,
+    # returns True when the content was already stored (path now points at that copy)
+    target = blob_path(sha256)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    try:
+        os.link(path, target)
+        return False
+    except FileExistsError:
+        pass
+    except OSError as e:
+        if e.errno == errno.EXDEV:
+            print(f"[blobs] {BLOB_STORE_PATH} is on another filesystem, {path} is not deduplicated")
+            return False
+        raise
+    if os.path.samefile(path, target):
+        return True
+    # duplicate content: replace the new copy by a link to the stored one
+    temporary = os.path.join(os.path.dirname(path), f".{uuid.uuid4().hex}.link")
+    os.link(target, temporary)
+    os.replace(temporary, path)
+    return True
+
+
+def discard(sha256: str) -> None:
+    # blocking; drops the store's link of a blob nobody references anymore
+    for path in (blob_path(sha256), envelope_path(sha256)):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+    for derived in (SPATIAL_INDEX_PATH, PREVIEW_CACHE_PATH):
+        shutil.rmtree(os.path.join(derived, sha256), ignore_errors=True)
+    if (storage := get_storage()) is not None:
+        try:
+            storage.delete(blob_key(sha256))
+        except Exception as e:
+            print(f"[blobs] removing the stored copy of {sha256[:12]} failed: {e!r}")
+
+
+### Reference counting (inside the caller's session)
+def acquire(session: Session, sha256: str, size: int) -> None:
+    blob = session.get(Blob, sha256) or Blob(sha256=sha256, size=size)
+    blob.refcount += 1
+    session.add(blob)
+
+
+def release(session: Session, sha256: str | None) -> bool:
+    # returns True when this was the last reference - call discard() after the commit
+    if sha256 is None:
+        return False
+    blob = session.get(Blob, sha256)
+    if blob is None:
+        return False
+    blob.refcount -= 1
+    if blob.refcount > 0:
+        session.add(blob)
+        return False
+    session.delete(blob)
+    metadata = session.get(PointCloudMetadata, sha256)  # records derived from the content go with it
+    if metadata is not None:
+        session.delete(metadata)
+    return True
+
+
+def rebuild_refcounts(session: Session) -> list[str]:
+    # recounts every blob from the ProjectFile rows; returns the hashes that lost all references
+    counts = dict(session.exec(
+        select(ProjectFile.sha256, func.count(ProjectFile.id)).where(ProjectFile.sha256.is_not(None)).group_by(ProjectFile.sha256)
+    ).all())
+    orphans = []
+    for blob in session.exec(select(Blob)).all():
+        if blob.sha256 not in counts:
+            session.delete(blob)
+            orphans.append(blob.sha256)
+        else:
+            blob.refcount = counts.pop(blob.sha256)
+            session.add(blob)
+    for sha256, count in counts.items():
+        size = session.exec(select(ProjectFile.size).where(ProjectFile.sha256 == sha256)).first()
+        session.add(Blob(sha256=sha256, size=size or 0, refcount=count))
+    return orphans
+
+
+### Hashing while writing
+class HashingWriter:
+    # writes a stream to a file, hashing it on the way so it never has to be read back
+    def __init__(self, path: str):
+        self.path = path
+        self.digest = hashlib.sha256()
+        self.file = open(path, "wb")
+
+    def write(self, data: bytes) -> None:
+        self.file.write(data)
+        self.digest.update(data)
+
+    def close(self) -> str:
+        self.file.close()
+        return self.digest.hexdigest()
+
+
+def test_refcounts():
+    import file_index
+    from db_connector import create_db_and_tables, engine
+    from models import Project, User
+    create_db_and_tables()
+    with Session(engine) as session:
+        user = User(username=f"blobs-test-{uuid.uuid4().hex}")
+        session.add(user)
+        session.commit()
+        projects = [Project(name="blobs-test", user_id=user.id) for _ in range(2)]
+        session.add_all(projects)
+        session.commit()
+        a, b = (project.id for project in projects)
+    content = uuid.uuid4().bytes * 1024
+    sha256 = hashlib.sha256(content).hexdigest()
+    os.makedirs(file_index.project_dir(a), exist_ok=True)
+    with open(os.path.join(file_index.project_dir(a), "x.bin"), "wb") as f:
+        f.write(content)
+
+    def refcount() -> int:
+        with Session(engine) as session:
+            blob = session.get(Blob, sha256)
+            return blob.refcount if blob else 0
+
+    file_index.index_file(a, "x.bin")
+    assert refcount() == 1 and os.path.exists(blob_path(sha256))
+    file_index.copy_file(a, "x.bin", b)
+    assert refcount() == 2
+    file_index.relocate_file(b, "x.bin", a, "y.bin")  # a rename, the content keeps its references
+    assert refcount() == 2
+    for name in ("x.bin", "y.bin"):
+        os.remove(os.path.join(file_index.project_dir(a), name))
+        file_index.remove_file(a, name)
+    assert refcount() == 0 and not os.path.exists(blob_path(sha256))
@@ -1,4 +1,9 @@
-import os
-from anymap import PotreeMap
-viewer = PotreeMap(description="Test", point_cloud_url = url)
-viewer
\ No newline at end of file
+### === POINT CLOUD VIEWER === ###
+from nicegui import ui
+
+
+def show_point_cloud(point_cloud_url: str, description: str = "") -> None:
+    # point_cloud_url: metadata.json of a Potree 2.0 octree (see tiling.octree_url)
+    from anymap import PotreeMap # heavy, only imported once a cloud is actually opened
+    viewer = PotreeMap(point_cloud_url=point_cloud_url, description=description)
+    ui.anywidget(viewer).classes("w-full")
@@ -0,0 +1,95 @@
+### === POINT CLOUD PREVIEWS === ###
+# Small top-down rasters of a point cloud, north up, rendered in one streaming pass over the points:
+#   dem.jpg        highest Z per pixel, coloured low (blue) to high (white)
+#   intensity.jpg  mean intensity per pixel
+#   rgb.jpg        mean colour per pixel (only for files with colours)
+#   thumb.jpg      rgb.jpg when there is one, dem.jpg otherwise
+# THUMBNAIL_SIZE px on the longer side at most; pixels without points are BACKGROUND.
+import math
+import os
+import shutil
+import uuid
+
+import numpy as np
+from PIL import Image
+
+from las_io import iter_points, read_header
+from pyramid import BACKGROUND, JPEG_QUALITY, THUMBNAIL_SIZE
+
+PREVIEW_KINDS = ("dem", "intensity", "rgb")
+POINTS_PER_PIXEL = 2
+# colour ramp of the DEM: position in the Z range -> RGB
+DEM_STOPS = np.array([0.0, 0.25, 0.5, 0.75, 1.0])
+DEM_COLOURS = np.array([(40, 60, 160), (40, 160, 180), (90, 170, 60), (190, 150, 70), (250, 250, 250)])
+
+
+def preview_shape(header) -> tuple[int, int]:
+    # (height, width): THUMBNAIL_SIZE on the longer side, less for sparse clouds (POINTS_PER_PIXEL on average)
+    width, height = max(header.maxs[0] - header.mins[0], 1e-9), max(header.maxs[1] - header.mins[1], 1e-9)
+    aspect = max(width, height) / min(width, height)
+    side = int(min(THUMBNAIL_SIZE, max(1, math.sqrt(header.point_count / POINTS_PER_PIXEL * aspect))))
+    if width >= height:
+        return max(1, round(side * height / width)), side
+    return side, max(1, round(side * width / height))
+
+
+def stretch(values: np.ndarray, filled: np.ndarray, low: float = 2, high: float = 98) -> np.ndarray:
+    # 0..1 between the given percentiles of the filled pixels
+    if not filled.any():
+        return np.zeros_like(values)
+    bottom, top = np.percentile(values[filled], [low, high])
+    return np.clip((values - bottom) / max(top - bottom, 1e-9), 0, 1)
+
+
+def to_image(rgb: np.ndarray, filled: np.ndarray, shape: tuple[int, int]) -> Image.Image:
+    pixels = np.empty((filled.size, 3), dtype=np.uint8)
+    pixels[:] = BACKGROUND
+    pixels[filled] = np.clip(rgb[filled], 0, 255)
+    return Image.fromarray(pixels.reshape(*shape, 3), "RGB")
+
+
+def render_cloud_previews(src: str, out_dir: str, chunk_points: int = 1_000_000) -> dict:
+    header = read_header(src)
+    shape = preview_shape(header)
+    pixels = shape[0] * shape[1]
+    z_max = np.full(pixels, -np.inf)
+    count = np.zeros(pixels, dtype=np.int64)
+    intensity = np.zeros(pixels)
+    colour = np.zeros((3, pixels))
+    pixel_size = max((header.maxs[0] - header.mins[0]) / shape[1], (header.maxs[1] - header.mins[1]) / shape[0], 1e-9)
+    for points in iter_points(src, chunk_points):
+        x = points["X"] * header.scale[0] + header.offset[0]
+        y = points["Y"] * header.scale[1] + header.offset[1]
+        column = np.clip(((x - header.mins[0]) / pixel_size).astype(np.int64), 0, shape[1] - 1)
+        row = np.clip(((header.maxs[1] - y) / pixel_size).astype(np.int64), 0, shape[0] - 1)
+        pixel = row * shape[1] + column
+        np.maximum.at(z_max, pixel, points["Z"] * header.scale[2] + header.offset[2])
+        count += np.bincount(pixel, minlength=pixels)
+        intensity += np.bincount(pixel, weights=points["intensity"], minlength=pixels)
+        for channel, name in enumerate(("red", "green", "blue")):
+            colour[channel] += np.bincount(pixel, weights=points[name], minlength=pixels)
+
+    filled = count > 0
+    mean = np.maximum(count, 1)
+    images = {}
+    heights = stretch(z_max, filled)
+    images["dem"] = np.stack([np.interp(heights, DEM_STOPS, DEM_COLOURS[:, channel]) for channel in range(3)], axis=1)
+    images["intensity"] = np.repeat((stretch(intensity / mean, filled, 1, 99) * 255)[:, None], 3, axis=1)
+    if colour.any():
+        colour /= mean
+        colour = colour.T / 257 if colour.max() > 255 else colour.T  # 16 bit colours (the LAS norm) or 8 bit ones
+        images["rgb"] = colour
+
+    work_dir = f"{out_dir}.{uuid.uuid4().hex}.tmp"
+    os.makedirs(work_dir)
+    try:
+        for kind, rgb in images.items():
+            to_image(rgb, filled, shape).save(os.path.join(work_dir, f"{kind}.jpg"), "JPEG", quality=JPEG_QUALITY)
+        thumb = "rgb" if "rgb" in images else "dem"
+        shutil.copyfile(os.path.join(work_dir, f"{thumb}.jpg"), os.path.join(work_dir, "thumb.jpg"))
+        shutil.rmtree(out_dir, ignore_errors=True)
+        os.replace(work_dir, out_dir)
+    except BaseException:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        raise
+    return {"width": shape[1], "height": shape[0], "kinds": list(images)}
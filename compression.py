@@ -0,0 +1,93 @@
+### === LAS COMPRESSION === ###
+# Storage policy (LOTOGRAFIA_LAS_COMPRESSION): after ingest, the blob of an uploaded .las file is
+# recompressed to LAZ by the background workers. The store then holds blobs/.../<sha256> as LAZ next
+# to <sha256>.envelope (the LAS without its point records, see las_io), every project link is switched
+# to the LAZ copy and the LAS data is freed. ProjectFile keeps the name, size and hash of the LAS, and
+# downloads stream the original bytes back (downloads.restored_las_response).
+# The LAZ copy only replaces the LAS after a full round trip reproduced its hash.
+import os
+import uuid
+from concurrent.futures import Future
+
+from sqlmodel import Session, select
+
+import blobs
+from config import LAS_COMPRESSION, LAS_COMPRESSION_MIN_SIZE
+from db_connector import engine
+from file_index import get_file
+from las_io import compress_las
+from metrics import Counter
+from models import Blob, ProjectFile
+from workers import submit
+
+SAVED_BYTES = Counter("lotografia_las_compression_saved_bytes_total", "Disk space saved by storing LAS files as LAZ.")
+
+_laz_available: bool | None = None
+
+
+def laz_available() -> bool:
+    global _laz_available
+    if _laz_available is None:
+        try:
+            import laspy
+            _laz_available = bool(laspy.LazBackend.detect_available())
+        except ImportError:
+            _laz_available = False
+        if not _laz_available:
+            print("[compression] LAS compression is on, but laspy with a LAZ backend is not installed")
+    return _laz_available
+
+
+def is_compressible(name: str) -> bool:
+    return name.lower().endswith(".las")
+
+
+### Scheduling
+def schedule_compression(project_id: int, name: str) -> Future | None:
+    if not LAS_COMPRESSION or not is_compressible(name):
+        return None
+    record = get_file(project_id, name)
+    if record is None or not record.sha256 or record.encoding or record.size < LAS_COMPRESSION_MIN_SIZE:
+        return None
+    source = blobs.blob_path(record.sha256)
+    if not os.path.exists(source) or os.path.exists(blobs.envelope_path(record.sha256)):
+        return None  # store on another filesystem, or the same content is already compressed
+    if not laz_available():
+        return None
+    temporary = os.path.join(os.path.dirname(source), f".{uuid.uuid4().hex}")
+    laz_path, envelope_path = temporary + ".laz", temporary + ".envelope"
+    return submit(f"compression {project_id}/{name}", compress_las, source, laz_path, envelope_path, record.sha256,
+                  on_done=lambda done: swap_in(record.sha256, laz_path, envelope_path, done))
+
+
+def swap_in(sha256: str, laz_path: str, envelope_path: str, done: Future) -> None:
+    # replaces the LAS blob by its LAZ copy: the store first, so new duplicates link to the LAZ, then every project link
+    if done.exception() is not None:
+        return  # compress_las cleaned up after itself
+    stored_size = done.result()
+    target = blobs.blob_path(sha256)
+    with Session(engine) as session:
+        blob = session.get(Blob, sha256)
+        if blob is None or os.path.exists(blobs.envelope_path(sha256)):
+            # the content was deleted meanwhile, or compressed for a concurrent upload of it
+            os.remove(laz_path)
+            os.remove(envelope_path)
+            return
+        las_size = blob.size
+        os.replace(envelope_path, blobs.envelope_path(sha256))
+        os.replace(laz_path, target)
+        for record in session.exec(select(ProjectFile).where(ProjectFile.sha256 == sha256)).all():
+            if not os.path.exists(record.path):
+                continue  # being deleted
+            link = os.path.join(os.path.dirname(record.path), f".{uuid.uuid4().hex}.link")
+            try:
+                os.link(target, link)
+                os.replace(link, record.path)
+            except FileNotFoundError:
+                continue
+            record.encoding, record.stored_size = "laz", stored_size
+            record.mtime = os.stat(record.path).st_mtime
+            session.add(record)
+        session.commit()
+    SAVED_BYTES.inc(las_size - stored_size)
+    print(f"[compression] {sha256[:12]}: {las_size / 1024**2:.1f} MiB LAS stored as {stored_size / 1024**2:.1f} MiB LAZ")
@@ -0,0 +1,144 @@
+import os
+
+### === STARTUP === ###
+# serve the API only (api.fastapi_app) - no NiceGUI, for API and batch nodes
+HEADLESS = os.environ.get("LOTOGRAFIA_HEADLESS", "0").lower() in ("1", "true", "yes")
+# uvicorn worker processes - uvicorn takes the default of --workers from the same variable
+SERVER_WORKERS = int(os.environ.get("WEB_CONCURRENCY", 1))
+# set when the proxy sends every request for /uploads/{upload_id} to the same worker: archive uploads
+# (extract mode) keep their state in one worker's memory and are refused with several workers otherwise
+UPLOAD_STICKY_ROUTING = os.environ.get("LOTOGRAFIA_UPLOAD_STICKY_ROUTING", "0").lower() in ("1", "true", "yes")
+
+### === STORAGE === ###
+USER_PROJECTS_PATH = os.environ.get("LOTOGRAFIA_USER_PROJECTS_PATH", os.path.join("user_projects"))
+
+# hidden directory inside every project dir for uploads that are still in progress
+PARTIAL_UPLOADS_DIRNAME = ".partial"
+# hidden directory inside every project dir for artifacts generated from its files (octrees, ...)
+DERIVED_DIRNAME = ".derived"
+# deleted projects are renamed into this hidden directory of USER_PROJECTS_PATH and reclaimed in the background
+TRASH_DIRNAME = ".trash"
+# content-addressed store; must be on the same filesystem as USER_PROJECTS_PATH (project files are hardlinks into it)
+BLOB_STORE_PATH = os.environ.get("LOTOGRAFIA_BLOB_STORE_PATH", os.path.join("blobs"))
+
+### === OBJECT STORAGE === ###
+# file contents are mirrored to this backend after upload: "" (none), "local" (the STORAGE_PATH directory)
+# or "s3"; with s3, downloads are redirected to presigned URLs and direct (multipart) uploads are offered
+STORAGE_BACKEND = os.environ.get("LOTOGRAFIA_STORAGE_BACKEND", "")
+STORAGE_PATH = os.environ.get("LOTOGRAFIA_STORAGE_PATH", os.path.join("storage"))
+# S3-compatible bucket; credentials come from the usual AWS_ACCESS_KEY_ID / AWS_SECRET_ACCESS_KEY
+S3_BUCKET = os.environ.get("LOTOGRAFIA_S3_BUCKET", "lotografia")
+S3_PREFIX = os.environ.get("LOTOGRAFIA_S3_PREFIX", "")
+S3_ENDPOINT_URL = os.environ.get("LOTOGRAFIA_S3_ENDPOINT_URL")  # MinIO and other non-AWS servers
+S3_REGION = os.environ.get("LOTOGRAFIA_S3_REGION")
+STORAGE_URL_EXPIRES = int(os.environ.get("LOTOGRAFIA_STORAGE_URL_EXPIRES", 3600))  # seconds presigned URLs stay valid
+MULTIPART_PART_SIZE = int(os.environ.get("LOTOGRAFIA_MULTIPART_PART_SIZE", 64 * 1024**2))
+
+### === LAS COMPRESSION === ###
+# when on, uploaded .las files are recompressed to LAZ in the background (needs laspy with a LAZ backend);
+# downloads still return the original LAS, decompressed on the fly
+LAS_COMPRESSION = os.environ.get("LOTOGRAFIA_LAS_COMPRESSION", "0").lower() in ("1", "true", "yes")
+# smaller files are left as they are - not worth a worker process
+LAS_COMPRESSION_MIN_SIZE = int(os.environ.get("LOTOGRAFIA_LAS_COMPRESSION_MIN_SIZE", 16 * 1024**2))
+
+### === STORAGE QUOTAS === ###
+# bytes each user may store (User.storage_quota overrides it per user); 0 = unlimited
+USER_QUOTA_BYTES = int(os.environ.get("LOTOGRAFIA_USER_QUOTA_BYTES", 0))
+# seconds between full reconciles of the file index and usage counters against the disk; 0 = never
+USAGE_RECONCILE_INTERVAL = float(os.environ.get("LOTOGRAFIA_USAGE_RECONCILE_INTERVAL", 24 * 3600))
+
+### === PROJECT DELETION === ###
+# files removed per reclaimer batch, and the deletion rate the reclaimer keeps to (so the disk stays responsive)
+TRASH_RECLAIM_BATCH = int(os.environ.get("LOTOGRAFIA_TRASH_RECLAIM_BATCH", 200))
+TRASH_RECLAIM_BYTES_PER_SECOND = int(os.environ.get("LOTOGRAFIA_TRASH_RECLAIM_BYTES_PER_SECOND", 512 * 1024**2))
+# a deletion whose reclaiming worker has not finished a batch for this long is taken over by another worker
+TRASH_RECLAIM_LEASE = float(os.environ.get("LOTOGRAFIA_TRASH_RECLAIM_LEASE", 300))  # seconds
+
+### === DATABASE === ###
+DATABASE_PATH = os.environ.get("LOTOGRAFIA_DATABASE_PATH", "database.db")
+# milliseconds a connection waits for a write lock before failing with "database is locked"
+SQLITE_BUSY_TIMEOUT = int(os.environ.get("LOTOGRAFIA_SQLITE_BUSY_TIMEOUT", 5000))
+# connections kept open by the async engine (WAL lets them read while one of them writes)
+DB_POOL_SIZE = int(os.environ.get("LOTOGRAFIA_DB_POOL_SIZE", 8))
+
+### === UPLOADS === ###
+# unfinished uploads without a chunk for this long are deleted and release their quota (seconds)
+UPLOAD_EXPIRES_AFTER = float(os.environ.get("LOTOGRAFIA_UPLOAD_EXPIRES_AFTER", 24 * 3600))
+# size of the slices read from the request body while streaming a chunk to disk
+UPLOAD_WRITE_BUFFER_SIZE = 1024 * 1024  # 1 MiB
+# form upload files larger than this are spooled to the temp directory instead of memory
+UPLOAD_SPOOL_MAX_SIZE = int(os.environ.get("LOTOGRAFIA_UPLOAD_SPOOL_MAX_SIZE", 16 * 1024**2))
+# upload bodies (resumable chunks, form posts) streaming at the same time, overall and per user, in all uvicorn
+# workers together; 0 = unlimited
+UPLOAD_MAX_CONCURRENT = int(os.environ.get("LOTOGRAFIA_UPLOAD_MAX_CONCURRENT", 8))
+UPLOAD_USER_CONCURRENCY = int(os.environ.get("LOTOGRAFIA_UPLOAD_USER_CONCURRENCY", 2))
+# seconds a body waits for a free slot before it is turned away with 503 and Retry-After
+UPLOAD_QUEUE_TIMEOUT = float(os.environ.get("LOTOGRAFIA_UPLOAD_QUEUE_TIMEOUT", 10))
+# bytes every volume uploads write to keeps free, counting the bodies in flight as written
+UPLOAD_MIN_FREE_BYTES = int(os.environ.get("LOTOGRAFIA_UPLOAD_MIN_FREE_BYTES", 2 * 1024**3))
+# body bytes read per second, overall and per user, by each uvicorn worker; 0 = unlimited
+UPLOAD_MAX_BYTES_PER_SECOND = int(os.environ.get("LOTOGRAFIA_UPLOAD_MAX_BYTES_PER_SECOND", 0))
+UPLOAD_USER_BYTES_PER_SECOND = int(os.environ.get("LOTOGRAFIA_UPLOAD_USER_BYTES_PER_SECOND", 0))
+
+### === PASSWORD HASHING === ###
+# Argon2 cost parameters - changing them makes existing hashes get re-hashed on the next login
+ARGON2_TIME_COST = int(os.environ.get("LOTOGRAFIA_ARGON2_TIME_COST", 3))
+ARGON2_MEMORY_COST = int(os.environ.get("LOTOGRAFIA_ARGON2_MEMORY_COST", 65536))  # KiB
+ARGON2_PARALLELISM = int(os.environ.get("LOTOGRAFIA_ARGON2_PARALLELISM", 4))
+
+# argon2 releases the GIL, so a small thread pool hashes in parallel without blocking the event loop
+HASHING_POOL_WORKERS = int(os.environ.get("LOTOGRAFIA_HASHING_POOL_WORKERS", min(4, os.cpu_count() or 1)))
+# verifications allowed to wait for a worker before logins are turned away with 503
+HASHING_POOL_MAX_QUEUE = int(os.environ.get("LOTOGRAFIA_HASHING_POOL_MAX_QUEUE", 32))
+
+### === AUTH === ###
+# resolved users kept in memory by get_current_user, so bearer requests skip the database. A change to a user
+# (disabled, deleted, new password) evicts it only in the worker that made it: with several uvicorn workers
+# the others keep accepting the old principal until the TTL runs out, so keep the TTL short
+PRINCIPAL_CACHE_SIZE = int(os.environ.get("LOTOGRAFIA_PRINCIPAL_CACHE_SIZE", 1024))
+PRINCIPAL_CACHE_TTL = float(os.environ.get("LOTOGRAFIA_PRINCIPAL_CACHE_TTL", 60))  # seconds
+
+### === USER SESSIONS === ###
+# where NiceGUI's app.storage.user lives: "sqlite" (the database, shared by all uvicorn workers) or
+# "file" (NiceGUI's own storage-user-*.json files, single process only)
+SESSION_STORE = os.environ.get("LOTOGRAFIA_SESSION_STORE", "sqlite")
+# changed sessions are written together at most this often (seconds)
+SESSION_FLUSH_INTERVAL = float(os.environ.get("LOTOGRAFIA_SESSION_FLUSH_INTERVAL", 0.5))
+# sessions untouched for this long are removed at startup (seconds)
+SESSION_MAX_AGE = float(os.environ.get("LOTOGRAFIA_SESSION_MAX_AGE", 30 * 24 * 3600))
+
+### === BACKGROUND PROCESSING === ###
+# worker processes for work triggered by uploads (Potree octrees, image pyramids)
+BACKGROUND_WORKERS = int(os.environ.get("LOTOGRAFIA_BACKGROUND_WORKERS", 2))
+
+### === IMAGE TILES === ###
+# thumbnails and zoom pyramids of project images, keyed by content hash
+TILE_CACHE_PATH = os.environ.get("LOTOGRAFIA_TILE_CACHE_PATH", os.path.join("cache", "tiles"))
+# least recently used tiles are evicted once the cache grows past this
+TILE_CACHE_MAX_BYTES = int(os.environ.get("LOTOGRAFIA_TILE_CACHE_MAX_BYTES", 10 * 1024**3))  # 10 GiB
+# larger images are not decoded (no tiles or previews): 500 MP is 1.5 GB as RGB in a worker's memory
+IMAGE_MAX_PIXELS = int(os.environ.get("LOTOGRAFIA_IMAGE_MAX_PIXELS", 500_000_000))
+
+### === POINT CLOUD PREVIEWS === ###
+# top-down DEM/intensity/RGB previews of point clouds, keyed by content hash
+PREVIEW_CACHE_PATH = os.environ.get("LOTOGRAFIA_PREVIEW_CACHE_PATH", os.path.join("cache", "previews"))
+
+### === SPATIAL QUERIES === ###
+# grid indexes of point clouds for region queries (spatial_index.py), keyed by content hash
+SPATIAL_INDEX_PATH = os.environ.get("LOTOGRAFIA_SPATIAL_INDEX_PATH", os.path.join("cache", "spatial"))
+
+### === JOBS === ###
+# jobs (dense reconstruction, ...) running at the same time, in all uvicorn workers together; each worker
+# keeps a process pool of this size, separate from the upload workers
+JOB_WORKERS = int(os.environ.get("LOTOGRAFIA_JOB_WORKERS", 2))
+# jobs of one user that may run at the same time, in all uvicorn workers together
+JOB_USER_CONCURRENCY = int(os.environ.get("LOTOGRAFIA_JOB_USER_CONCURRENCY", 1))
+JOB_POLL_INTERVAL = float(os.environ.get("LOTOGRAFIA_JOB_POLL_INTERVAL", 5))  # seconds
+# running jobs whose worker has not reported for this long are taken to be interrupted and queued again
+JOB_HEARTBEAT_TIMEOUT = float(os.environ.get("LOTOGRAFIA_JOB_HEARTBEAT_TIMEOUT", 60))  # seconds
+
+### === METRICS === ###
+# when set, /metrics requires "Authorization: Bearer <token>"
+METRICS_TOKEN = os.environ.get("LOTOGRAFIA_METRICS_TOKEN")
+# when set, one JSON line per request (route, status, duration, DB time) is appended to this file
+METRICS_SPAN_LOG = os.environ.get("LOTOGRAFIA_METRICS_SPAN_LOG")
@@ -0,0 +1,21 @@
+### === INLINE TESTS === ###
+# The test_* functions in the modules (python -m pytest <module>.py) run against a throw-away
+# database and storage tree, like benchmark.py: the paths are set here, before pytest imports
+# any module that reads config.py, and removed when the run ends.
+import os
+import shutil
+import tempfile
+
+WORK_DIR = tempfile.mkdtemp(prefix="lotografia-test-")
+
+os.environ["LOTOGRAFIA_DATABASE_PATH"] = os.path.join(WORK_DIR, "database.db")
+os.environ["LOTOGRAFIA_USER_PROJECTS_PATH"] = os.path.join(WORK_DIR, "user_projects")
+os.environ["LOTOGRAFIA_BLOB_STORE_PATH"] = os.path.join(WORK_DIR, "blobs")
+os.environ["LOTOGRAFIA_TILE_CACHE_PATH"] = os.path.join(WORK_DIR, "tiles")
+os.environ["LOTOGRAFIA_SPATIAL_INDEX_PATH"] = os.path.join(WORK_DIR, "spatial")
+os.environ["LOTOGRAFIA_PREVIEW_CACHE_PATH"] = os.path.join(WORK_DIR, "previews")
+os.environ["LOTOGRAFIA_STORAGE_PATH"] = os.path.join(WORK_DIR, "storage")
+
+
+def pytest_unconfigure(config):
+    shutil.rmtree(WORK_DIR, ignore_errors=True)
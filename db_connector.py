@@ -1,24 +1,79 @@
 from typing import Annotated
 
 from fastapi import Depends, FastAPI, HTTPException, Query
+from sqlalchemy import event, func
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.orm import selectinload
 from sqlmodel import Field, Session, SQLModel, create_engine, select
+from sqlmodel.ext.asyncio.session import AsyncSession
 
-from models import * 
+from config import DATABASE_PATH, SQLITE_BUSY_TIMEOUT, DB_POOL_SIZE
+from metrics import instrument_engine
+from models import *
 
-sqlite_file_name = "database.db"
+sqlite_file_name = DATABASE_PATH
 sqlite_url = f"sqlite:///{sqlite_file_name}"
+async_sqlite_url = f"sqlite+aiosqlite:///{sqlite_file_name}"
 
+# set on every new connection; WAL lets readers run alongside the single writer
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",  # durable across application crashes, fsync only at checkpoints
+    "busy_timeout": SQLITE_BUSY_TIMEOUT,
+    "cache_size": -64000,  # 64 MB page cache per connection
+    "temp_store": "MEMORY",
+    "mmap_size": 256 * 1024**2,
+}
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record) -> None:
+    cursor = dbapi_connection.cursor()
+    for pragma, value in SQLITE_PRAGMAS.items():
+        cursor.execute(f"PRAGMA {pragma}={value}")
+    cursor.close()
+
+
+# sync engine: worker processes, threadpool helpers and scripts
 connect_args = {"check_same_thread": False}
 engine = create_engine(sqlite_url, connect_args = connect_args)
+event.listen(engine, "connect", set_sqlite_pragmas)
+instrument_engine(engine, "sync")
+
+# async engine: routes and NiceGUI handlers, so queries don't block the event loop
+async_engine = create_async_engine(async_sqlite_url, pool_size=DB_POOL_SIZE, max_overflow=DB_POOL_SIZE)
+event.listen(async_engine.sync_engine, "connect", set_sqlite_pragmas)
+instrument_engine(async_engine.sync_engine, "async")
+# expire_on_commit=False: returned objects stay usable after their session is closed
+async_session_maker = async_sessionmaker(async_engine, class_=AsyncSession, expire_on_commit=False)
 
 def create_db_and_tables():
     SQLModel.metadata.create_all(engine)
+    add_missing_columns()
+
+
+def add_missing_columns() -> None:
+    # create_all only creates missing tables; nullable columns added to existing models are added here
+    with engine.begin() as connection:
+        for table in SQLModel.metadata.sorted_tables:
+            existing = {row[1] for row in connection.exec_driver_sql(f'PRAGMA table_info("{table.name}")')}
+            for column in table.columns:
+                if column.name not in existing and column.nullable:
+                    column_type = column.type.compile(dialect=engine.dialect)
+                    connection.exec_driver_sql(f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {column_type}')
+                    print(f"[db] added column {table.name}.{column.name}")
+            for index in table.indexes:
+                index.create(connection, checkfirst=True)
 
 
 def get_session():
     with Session(engine) as session:
         yield session
 
+
+async def get_async_session():
+    async with async_session_maker() as session:
+        yield session
+
 class DBConnector():
     def get_user(self, username: str) -> User | None:
         with Session(engine) as session:
@@ -26,20 +81,107 @@ class DBConnector():
                 select(User).where(User.username == username)
             ).first()
             return user
-        
-    def get_projects(self, username: str) -> list["Project"] | None:
+
+    def update_password_hash(self, username: str, hashed_password: str) -> None:
+        with Session(engine) as session:
+            user = session.exec(
+                select(User).where(User.username == username)
+            ).one()
+            user.hashed_password = hashed_password
+            session.add(user)
+            session.commit()
+
+    def set_user_disabled(self, username: str, disabled: bool = True) -> None:
         with Session(engine) as session:
             user = session.exec(
                 select(User).where(User.username == username)
+            ).one()
+            user.disabled = disabled
+            session.add(user)
+            session.commit()
+
+    def get_projects(self, username: str) -> list[Project]:
+        with Session(engine) as session:
+            return list(session.exec(
+                select(Project).join(User)
+                .where(User.username == username, Project.deleted_at.is_(None)).order_by(Project.id)
+            ).all())
+
+    def get_project(self, project_id: int, username: str) -> Project | None:
+        with Session(engine) as session:
+            project = session.exec(
+                select(Project).join(User)
+                .where(Project.id == project_id, User.username == username, Project.deleted_at.is_(None))
             ).first()
-            return user.projects
-    
+            return project
+
+    ### async variants (for routes and NiceGUI handlers)
+    async def get_user_async(self, username: str) -> User | None:
+        async with async_session_maker() as session:
+            result = await session.exec(
+                select(User).where(User.username == username)
+            )
+            return result.first()
+
+    async def update_password_hash_async(self, username: str, hashed_password: str) -> None:
+        async with async_session_maker() as session:
+            user = (await session.exec(
+                select(User).where(User.username == username)
+            )).one()
+            user.hashed_password = hashed_password
+            session.add(user)
+            await session.commit()
+
+    async def get_projects_async(
+        self, username: str, offset: int = 0, limit: int | None = None,
+        descending: bool = False, name_filter: str | None = None,
+    ) -> list[Project]:
+        # one query for the projects, no lazy load of user.projects after the session closed
+        async with async_session_maker() as session:
+            result = await session.exec(
+                select(Project).join(User).where(*self._projects_where(username, name_filter))
+                .order_by(Project.name.desc() if descending else Project.name, Project.id)
+                .offset(offset).limit(limit)
+            )
+            return list(result.all())
+
+    async def count_projects_async(self, username: str, name_filter: str | None = None) -> int:
+        async with async_session_maker() as session:
+            result = await session.exec(
+                select(func.count(Project.id)).join(User).where(*self._projects_where(username, name_filter))
+            )
+            return result.one()
+
+    @staticmethod
+    def _projects_where(username: str, name_filter: str | None) -> list:
+        conditions = [User.username == username, Project.deleted_at.is_(None)]
+        if name_filter:
+            conditions.append(Project.name.contains(name_filter, autoescape=True))
+        return conditions
+
+    async def get_project_async(self, project_id: int, username: str) -> Project | None:
+        async with async_session_maker() as session:
+            result = await session.exec(
+                select(Project).join(User)
+                .where(Project.id == project_id, User.username == username, Project.deleted_at.is_(None))
+                .options(selectinload(Project.user))
+            )
+            return result.first()
+
+    async def project_name_taken_async(self, username: str, name: str) -> bool:
+        async with async_session_maker() as session:
+            result = await session.exec(
+                select(Project.id).join(User)
+                .where(User.username == username, Project.name == name, Project.deleted_at.is_(None))
+            )
+            return result.first() is not None
+
 
 def test_dbconnector_get_projects():
     db = DBConnector()
     assert db.get_projects(username="test") == []
-    
 
 
-SessionDep = Annotated[Session, Depends(get_session)]
 
+SessionDep = Annotated[Session, Depends(get_session)]
+AsyncSessionDep = Annotated[AsyncSession, Depends(get_async_session)]
@@ -0,0 +1,315 @@
+### === DIRECT UPLOADS === ###
+# With a presigning storage backend (S3, see storage.py) clients send large files straight to the bucket:
+#   POST   /projects/{project_id}/direct-uploads   {"filename", "size"} -> presigned PUT URL per part
+#   PUT    <part url>                              -> the client uploads every part and keeps its ETag header
+#   POST   /direct-uploads/{upload_id}/complete    {"parts": [{"number", "etag"}]} -> 202, the file is imported
+#   GET    /direct-uploads/{upload_id}             -> status (fresh part URLs while uploading)
+#   DELETE /direct-uploads/{upload_id}             -> abort
+# The upload is an UploadSession with a storage_key, so quotas count it like a resumable upload. Once the
+# parts are put together the object is copied into the project (hashed on the way) and ingested like
+# any other upload; the object then becomes the stored copy of the new blob (mirror.py), so it is
+# never uploaded twice. Parts of abandoned uploads are best left to a bucket lifecycle rule.
+# An import holds an upload governor slot for the size of the file, whose id it records on the session.
+# Imports without a live slot (the worker stopped, or the governor was busy) are started again by the
+# ImportResumer of any worker; a failed import deletes the object and frees the session's quota.
+import asyncio
+import math
+import os
+import uuid
+from typing import Annotated
+
+from fastapi import APIRouter, Depends, HTTPException, Response, status
+from pydantic import BaseModel
+from sqlalchemy import or_, update
+from sqlmodel import Session, select
+from starlette.concurrency import run_in_threadpool
+
+from auth import get_current_active_user
+from blobs import HashingWriter, blob_key
+from db_connector import async_session_maker, engine, DBConnector
+from file_index import project_dir
+from ingest import ingest_file
+from metrics import UPLOAD_BYTES
+from models import Blob, User, UploadSession, UploadSlot, utcnow
+from storage import StorageError, get_storage
+from upload_governor import UploadRejected, governor
+from uploads import clean_filename, final_path, get_upload_for_user, partial_path
+import usage
+
+MAX_PARTS = 10_000  # S3 limit
+IMPORT_RESUME_INTERVAL = 30  # seconds
+
+router = APIRouter()
+db = DBConnector()
+
+_imports: dict[str, asyncio.Task] = {}  # upload id -> import task of this worker, referenced until it finishes
+
+
+def direct_storage():
+    storage = get_storage()
+    if storage is None or not storage.presigns:
+        raise HTTPException(status_code=501, detail="Direct uploads need an S3 storage backend, use /projects/{project_id}/uploads")
+    return storage
+
+
+def upload_status(upload: UploadSession) -> dict:
+    if upload.completed:
+        state = "done"
+    elif upload.error:
+        state = "failed"
+    elif upload.multipart_id is None:
+        state = "importing"
+    else:
+        state = "uploading"
+    result = {"id": upload.id, "filename": upload.filename, "size": upload.length, "status": state, "error": upload.error}
+    if state == "uploading":
+        storage = get_storage()
+        result["part_size"] = upload.part_size
+        result["parts"] = [
+            {"number": number, "url": storage.part_url(upload.storage_key, upload.multipart_id, number)}
+            for number in range(1, max(1, math.ceil(upload.length / upload.part_size)) + 1)
+        ]
+    return result
+
+
+async def get_direct_upload(upload_id: str, user: User) -> UploadSession:
+    upload = await get_upload_for_user(upload_id, user)
+    if upload.storage_key is None:
+        raise HTTPException(status_code=404, detail="Upload not found")
+    return upload
+
+
+async def save(upload: UploadSession) -> None:
+    async with async_session_maker() as session:
+        session.add(upload)
+        await session.commit()
+
+
+### Import into the project
+def fetch_object(key: str, path: str) -> str:
+    # blocking; copies the object to path, returns its sha256
+    writer = HashingWriter(path)
+    try:
+        for chunk in get_storage().open(key):
+            writer.write(chunk)
+            UPLOAD_BYTES.inc(len(chunk), kind="direct")
+    finally:
+        sha256 = writer.close()
+    return sha256
+
+
+def adopt_object(key: str, sha256: str) -> None:
+    # blocking; the uploaded object becomes the stored copy of its blob - before ingest, whose mirror
+    # task then finds it in place
+    storage = get_storage()
+    if storage.size(blob_key(sha256)) is None:
+        storage.copy(key, blob_key(sha256))
+    storage.delete(key)
+
+
+def mark_mirrored(sha256: str) -> None:
+    with Session(engine) as session:
+        blob = session.get(Blob, sha256)
+        if blob is not None and blob.mirrored_at is None:
+            blob.mirrored_at = utcnow()
+            session.add(blob)
+            session.commit()
+
+
+def discard_import(upload: UploadSession) -> None:
+    # blocking; removes what a failed import leaves behind
+    partial = partial_path(upload)
+    if os.path.exists(partial):
+        os.remove(partial)
+    try:
+        get_storage().delete(upload.storage_key)
+    except StorageError as e:
+        print(f"[uploads] deleting {upload.storage_key} failed: {e!r}")
+
+
+def importing(statement):
+    # sessions whose object is put together and waits to be imported
+    return statement.where(UploadSession.storage_key != None, UploadSession.multipart_id == None,  # noqa: E711
+                           UploadSession.completed == False, UploadSession.error == None)  # noqa: E711, E712
+
+
+async def claim_import(upload: UploadSession, slot_id: str) -> bool:
+    # False when a worker with a live slot imports it already, or it is no longer waiting
+    async with async_session_maker() as session:
+        result = await session.execute(importing(update(UploadSession)).where(
+            UploadSession.id == upload.id,
+            or_(UploadSession.import_slot == None, UploadSession.import_slot.not_in(select(UploadSlot.id))),  # noqa: E711
+        ).values(import_slot=slot_id))
+        await session.commit()
+    if not result.rowcount:
+        return False
+    upload.import_slot = slot_id
+    return True
+
+
+async def run_import(upload: UploadSession) -> None:
+    partial = partial_path(upload)
+    await run_in_threadpool(os.makedirs, os.path.dirname(partial), exist_ok=True)
+    try:
+        sha256 = await run_in_threadpool(fetch_object, upload.storage_key, partial)
+        await run_in_threadpool(adopt_object, upload.storage_key, sha256)
+        await run_in_threadpool(os.replace, partial, final_path(upload))
+        await ingest_file(upload.project_id, upload.filename, sha256)
+        await run_in_threadpool(mark_mirrored, sha256)
+        upload.completed = True
+    except Exception as e:
+        print(f"[uploads] importing {upload.storage_key} failed: {e!r}")
+        await run_in_threadpool(discard_import, upload)
+        upload.error = str(e) or repr(e)
+    await save(upload)
+
+
+async def import_upload(upload: UploadSession) -> None:
+    async with async_session_maker() as session:
+        user = await session.get(User, upload.user_id)
+    try:
+        # the file lands in the project dir, so it counts against that volume like an upload body
+        async with governor.admit(user.username, upload.length, project_dir(upload.project_id)) as slot_id:
+            if await claim_import(upload, slot_id):
+                await run_import(upload)
+    except UploadRejected as e:
+        print(f"[uploads] importing {upload.storage_key} postponed: {e.detail}")  # the resumer tries again
+
+
+def start_import(upload: UploadSession) -> None:
+    if upload.id in _imports:
+        return
+    task = asyncio.create_task(import_upload(upload))
+    _imports[upload.id] = task
+    task.add_done_callback(lambda done: _imports.pop(upload.id, None))
+
+
+class ImportResumer:
+    # starts the imports no worker holds a live slot for: interrupted by a restart, or postponed
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.task: asyncio.Task | None = None
+
+    def start(self) -> None:
+        storage = get_storage()
+        if storage is not None and storage.presigns:
+            self.task = asyncio.create_task(self.loop())
+
+    async def stop(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+
+    async def loop(self) -> None:
+        while True:
+            try:
+                async with async_session_maker() as session:
+                    uploads = (await session.exec(importing(select(UploadSession)).where(or_(
+                        UploadSession.import_slot == None,  # noqa: E711
+                        UploadSession.import_slot.not_in(select(UploadSlot.id)),
+                    )))).all()
+                for upload in uploads:
+                    start_import(upload)
+            except Exception as e:
+                print(f"[uploads] resuming imports failed: {e!r}")
+            await asyncio.sleep(self.interval)
+
+
+resumer = ImportResumer(IMPORT_RESUME_INTERVAL)
+
+
+### === ROUTES === ###
+class DirectUploadCreate(BaseModel):
+    filename: str
+    size: int
+
+
+class DirectUploadPart(BaseModel):
+    number: int
+    etag: str
+
+
+class DirectUploadComplete(BaseModel):
+    parts: list[DirectUploadPart]
+
+
+@router.post("/projects/{project_id}/direct-uploads", status_code=status.HTTP_201_CREATED)
+async def create_direct_upload(
+    project_id: int,
+    request: DirectUploadCreate,
+    current_user: Annotated[User, Depends(get_current_active_user)],
+):
+    storage = direct_storage()
+    if await db.get_project_async(project_id, current_user.username) is None:
+        raise HTTPException(status_code=404, detail="Project not found")
+    name = clean_filename(request.filename)
+    if request.size <= 0:
+        raise HTTPException(status_code=400, detail="Invalid size")
+    part_size = max(storage.part_size, math.ceil(request.size / MAX_PARTS))
+    if not await usage.admits(current_user, request.size):
+        raise HTTPException(status_code=413, detail="Storage quota exceeded")
+    try:
+        await governor.check_space(project_dir(project_id), request.size)  # the import lands there
+    except UploadRejected as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail, headers=e.headers)
+    upload = UploadSession(id=uuid.uuid4().hex, project_id=project_id, user_id=current_user.id, filename=name,
+                           length=request.size, part_size=part_size)
+    upload.storage_key = f"incoming/{upload.id}"
+    upload.multipart_id = await run_in_threadpool(storage.create_multipart, upload.storage_key)
+    if not await usage.reserve(current_user, upload):  # another upload took the quota in the meantime
+        await run_in_threadpool(storage.abort_multipart, upload.storage_key, upload.multipart_id)
+        raise HTTPException(status_code=413, detail="Storage quota exceeded")
+    return upload_status(upload)
+
+
+@router.get("/direct-uploads/{upload_id}")
+async def read_direct_upload(
+    upload_id: str,
+    current_user: Annotated[User, Depends(get_current_active_user)],
+):
+    return upload_status(await get_direct_upload(upload_id, current_user))
+
+
+@router.post("/direct-uploads/{upload_id}/complete", status_code=status.HTTP_202_ACCEPTED)
+async def complete_direct_upload(
+    upload_id: str,
+    request: DirectUploadComplete,
+    current_user: Annotated[User, Depends(get_current_active_user)],
+):
+    storage = direct_storage()
+    upload = await get_direct_upload(upload_id, current_user)
+    if upload.multipart_id is None:
+        raise HTTPException(status_code=409, detail="Upload already completed")
+    parts = [(part.number, part.etag) for part in request.parts]
+    try:
+        await run_in_threadpool(storage.complete_multipart, upload.storage_key, upload.multipart_id, parts)
+    except StorageError as e:
+        raise HTTPException(status_code=400, detail=f"Parts rejected by the storage: {e}")
+    upload.multipart_id = None
+    size = await run_in_threadpool(storage.size, upload.storage_key)
+    if size != upload.length:
+        await run_in_threadpool(storage.delete, upload.storage_key)
+        upload.error = f"Uploaded {size} bytes, {upload.length} were announced"
+        await save(upload)
+        raise HTTPException(status_code=400, detail=upload.error)
+    await save(upload)
+    start_import(upload)
+    return upload_status(upload)
+
+
+@router.delete("/direct-uploads/{upload_id}")
+async def abort_direct_upload(
+    upload_id: str,
+    current_user: Annotated[User, Depends(get_current_active_user)],
+):
+    storage = direct_storage()
+    upload = await get_direct_upload(upload_id, current_user)
+    if upload.multipart_id is None and not upload.error:
+        raise HTTPException(status_code=409, detail="Upload already completed")
+    if upload.multipart_id is not None:
+        await run_in_threadpool(storage.abort_multipart, upload.storage_key, upload.multipart_id)
+    async with async_session_maker() as session:
+        stored = await session.get(UploadSession, upload.id)
+        if stored is not None:
+            await session.delete(stored)
+            await session.commit()
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
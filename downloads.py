@@ -0,0 +1,242 @@
+### === FILE DOWNLOADS === ###
+# GET/HEAD /projects/{project_id}/files/{name}  -> bearer-authenticated
+# GET/HEAD /files/{token}/{name}                -> signed link (auth.create_file_token), for browsers and viewers
+# Both support Range/If-Range (single byte range), ETag/If-None-Match and Last-Modified,
+# and hand the body to the server with the ASGI zero-copy (sendfile) extension when it is available.
+# Files stored compressed (compression.py) are returned as the original LAS, decompressed while it is
+# sent; ?form=laz returns the stored LAZ instead.
+# Files with a copy in an S3 storage backend (mirror.py) are redirected to a presigned URL of it.
+import os
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Annotated
+from urllib.parse import quote
+
+import anyio
+from fastapi import APIRouter, Depends, HTTPException, Request
+from starlette.responses import RedirectResponse, Response, StreamingResponse
+from starlette.types import Receive, Scope, Send
+
+from auth import get_current_active_user, create_file_token, decode_file_token
+from blobs import envelope_path
+from db_connector import DBConnector
+from file_index import get_file_async
+from las_io import iter_restored_las
+from mirror import mirrored_url
+from models import User, ProjectFile
+
+CHUNK_SIZE = 1024 * 1024  # 1 MiB, used when the server has no zero-copy extension
+
+router = APIRouter()
+db = DBConnector()
+
+
+### Conditional request helpers
+def file_etag(size: int, mtime: float, sha256: str | None = None) -> str:
+    if sha256:
+        return f'"{sha256}"'
+    return f'"{size:x}-{int(mtime * 1_000_000):x}"'
+
+
+def parse_range(header: str, size: int) -> tuple[int, int] | None:
+    # returns an inclusive (start, end) for a single "bytes=" range, None if the header
+    # should be ignored (syntax we don't serve, e.g. multiple ranges) -> the full file is sent;
+    # raises 416 for a range that lies outside the file
+    unit, _, ranges = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in ranges:
+        return None
+    first, sep, last = ranges.strip().partition("-")
+    if not sep:
+        return None
+    try:
+        if first == "":  # suffix range: the last N bytes
+            length = int(last)
+            if length <= 0:
+                raise ValueError
+            start, end = max(0, size - length), size - 1
+        else:
+            start = int(first)
+            end = int(last) if last else size - 1
+    except ValueError:
+        return None
+    if start > end and last:
+        return None
+    if start >= size:
+        raise HTTPException(status_code=416, detail="Range not satisfiable", headers={"Content-Range": f"bytes */{size}"})
+    return start, min(end, size - 1)
+
+
+def if_range_matches(header: str, etag: str, mtime: float) -> bool:
+    if header.startswith('"') or header.startswith("W/"):
+        return header == etag
+    try:
+        return int(parsedate_to_datetime(header).timestamp()) == int(mtime)
+    except (TypeError, ValueError):
+        return False
+
+
+def none_match(header: str, etag: str) -> bool:
+    tags = [tag.strip().removeprefix("W/") for tag in header.split(",")]
+    return "*" in tags or etag in tags
+
+
+class FileRangeResponse(Response):
+    # sends bytes [start, end] of path; uses http.response.zerocopysend when the server supports it
+    def __init__(self, path: str, start: int, end: int, status_code: int, headers: dict[str, str], send_body: bool = True):
+        super().__init__(status_code=status_code, headers=headers)
+        self.path = path
+        self.start = start
+        self.count = end - start + 1
+        self.send_body = send_body
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        if not self.send_body or self.count <= 0:
+            await send({"type": "http.response.body", "body": b""})
+            return
+        if "http.response.zerocopysend" in scope.get("extensions", {}):
+            with open(self.path, "rb") as f:
+                await send({"type": "http.response.zerocopysend", "file": f, "offset": self.start, "count": self.count})
+            return
+        async with await anyio.open_file(self.path, "rb") as f:
+            await f.seek(self.start)
+            remaining = self.count
+            while remaining > 0:
+                chunk = await f.read(min(CHUNK_SIZE, remaining))
+                if not chunk:  # file shrank underneath us
+                    break
+                remaining -= len(chunk)
+                await send({"type": "http.response.body", "body": chunk, "more_body": remaining > 0})
+            if remaining > 0:
+                await send({"type": "http.response.body", "body": b""})
+
+
+def ranged_file_response(
+    request: Request, path: str, etag: str | None = None,
+    content_type: str | None = None, download_name: str | None = None, cache_control: str = "private, no-cache",
+) -> Response:
+    # shared by every route that serves a file from disk (downloads, viewer assets, tiles)
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="File not found")
+    size = stat.st_size
+    etag = etag or file_etag(size, stat.st_mtime)
+    headers = {
+        "ETag": etag,
+        "Last-Modified": formatdate(stat.st_mtime, usegmt=True),
+        "Accept-Ranges": "bytes",
+        "Cache-Control": cache_control,
+    }
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and none_match(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+
+    headers["Content-Type"] = content_type or "application/octet-stream"
+    if download_name:
+        headers["Content-Disposition"] = f"attachment; filename*=UTF-8''{quote(download_name)}"
+
+    byte_range = None
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header and (not if_range or if_range_matches(if_range, etag, stat.st_mtime)):
+        byte_range = parse_range(range_header, size)
+
+    send_body = request.method != "HEAD"
+    if byte_range is None:
+        headers["Content-Length"] = str(size)
+        return FileRangeResponse(path, 0, size - 1, 200, headers, send_body)
+    start, end = byte_range
+    headers["Content-Length"] = str(end - start + 1)
+    headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    return FileRangeResponse(path, start, end, 206, headers, send_body)
+
+
+def restored_las_response(request: Request, record: ProjectFile) -> Response:
+    # the LAS a compressed file was made from, decompressed chunk by chunk into the response (no temporary file)
+    etag = file_etag(record.size, record.mtime, record.sha256)
+    headers = {
+        "ETag": etag,
+        "Last-Modified": formatdate(record.mtime, usegmt=True),
+        "Accept-Ranges": "bytes",
+        "Cache-Control": "private, no-cache",
+    }
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and none_match(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+    headers["Content-Disposition"] = f"attachment; filename*=UTF-8''{quote(record.name)}"
+
+    start, end, status = 0, record.size - 1, 200
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header and (not if_range or if_range_matches(if_range, etag, record.mtime)):
+        byte_range = parse_range(range_header, record.size)
+        if byte_range is not None:
+            (start, end), status = byte_range, 206
+            headers["Content-Range"] = f"bytes {start}-{end}/{record.size}"
+    headers["Content-Length"] = str(end - start + 1)
+    # a sync iterator: Starlette runs every next() (the decompression) in the threadpool
+    body = iter_restored_las(record.path, envelope_path(record.sha256), start, end) if request.method != "HEAD" else iter(())
+    return StreamingResponse(body, status_code=status, headers=headers,
+                             media_type=record.content_type or "application/octet-stream")
+
+
+async def download_response(request: Request, record: ProjectFile) -> Response:
+    if "form" not in request.query_params and (url := await mirrored_url(record)) is not None:
+        return RedirectResponse(url, status_code=307)
+    return project_file_response(request, record)
+
+
+def project_file_response(request: Request, record: ProjectFile) -> Response:
+    if record.encoding == "laz":
+        if request.query_params.get("form") != "laz":
+            return restored_las_response(request, record)
+        return ranged_file_response(
+            request, record.path, etag=f'"{record.sha256}-laz"',
+            download_name=os.path.splitext(record.name)[0] + ".laz",
+        )
+    return ranged_file_response(
+        request, record.path,
+        etag=file_etag(record.size, record.mtime, record.sha256),
+        content_type=record.content_type,
+        download_name=record.name,
+    )
+
+
+### === ROUTES === ###
+@router.api_route("/projects/{project_id}/files/{name}", methods=["GET", "HEAD"])
+async def download_project_file(
+    project_id: int,
+    name: str,
+    request: Request,
+    current_user: Annotated[User, Depends(get_current_active_user)],
+):
+    if await db.get_project_async(project_id, current_user.username) is None:
+        raise HTTPException(status_code=404, detail="Project not found")
+    record = await get_file_async(project_id, name)
+    if record is None:
+        raise HTTPException(status_code=404, detail="File not found")
+    return await download_response(request, record)
+
+
+@router.api_route("/files/{token}/{name}", methods=["GET", "HEAD"])
+async def download_signed_file(token: str, name: str, request: Request):
+    project_id, token_name = decode_file_token(token)
+    if token_name != name:
+        raise HTTPException(status_code=403, detail="Invalid or expired link")
+    record = await get_file_async(project_id, name)
+    if record is None:
+        raise HTTPException(status_code=404, detail="File not found")
+    return await download_response(request, record)
+
+
+def signed_file_url(project_id: int, name: str) -> str:
+    return f"/files/{create_file_token(project_id, name)}/{quote(name)}"
+
+
+def test_parse_range():
+    assert parse_range("bytes=0-99", 1000) == (0, 99)
+    assert parse_range("bytes=900-", 1000) == (900, 999)
+    assert parse_range("bytes=-100", 1000) == (900, 999)
+    assert parse_range("bytes=0-5000", 1000) == (0, 999)
+    assert parse_range("bytes=0-1,5-6", 1000) is None
+    assert parse_range("items=0-1", 1000) is None
@@ -0,0 +1,317 @@
+### === PROJECT FILE INDEX === ###
+# ProjectFile rows mirror the files in user_projects/<project_id>, so listings and
+# counts are indexed queries instead of directory walks. Every code path that adds,
+# deletes or moves a project file goes through the functions below.
+# To rebuild the index from disk:  python file_index.py reconcile [project_id]
+import hashlib
+import mimetypes
+import os
+import shutil
+import sys
+
+from sqlalchemy import func, or_
+from sqlmodel import Session, select
+
+from config import USER_PROJECTS_PATH, DERIVED_DIRNAME
+import blobs
+import usage
+from db_connector import engine, async_session_maker
+from models import Blob, Project, ProjectFile, ProjectUsage
+
+HASH_READ_SIZE = 1024 * 1024  # 1 MiB
+
+
+def project_dir(project_id: int) -> str:
+    return os.path.join(USER_PROJECTS_PATH, str(project_id))
+
+
+def derived_dir(project_id: int, name: str) -> str:
+    # generated artifacts of one file (octree, previews, ...)
+    return os.path.join(project_dir(project_id), DERIVED_DIRNAME, name)
+
+
+def is_hidden(name: str) -> bool:
+    # partial uploads and other bookkeeping live in dot-directories of the project dir
+    return name.startswith(".")
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(HASH_READ_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+### Updates (blocking - call them through run_in_threadpool from async code)
+def index_file(project_id: int, name: str, sha256: str | None = None) -> ProjectFile:
+    # adds or refreshes the record of a file that is already in the project dir and links it into the blob store
+    path = os.path.join(project_dir(project_id), name)
+    stat = os.stat(path)
+    with Session(engine) as session:
+        record = session.exec(get_file_statement(project_id, name)).first()
+        if record is None:
+            record = ProjectFile(project_id=project_id, name=name)
+        unchanged = (record.stored_size or record.size) == stat.st_size and record.mtime == stat.st_mtime and record.sha256
+        old_sha256 = record.sha256 if record.id is not None else None
+        old_size = record.size if record.id is not None else 0
+        if sha256 is None:
+            sha256 = record.sha256 if unchanged else file_sha256(path)
+        if sha256 != old_sha256:
+            blobs.link_into_store(path, sha256)
+            stat = os.stat(path)  # a duplicate was replaced by a link to the stored copy
+            blobs.acquire(session, sha256, stat.st_size)
+            orphaned = blobs.release(session, old_sha256)
+        else:
+            orphaned = False
+        record.sha256 = sha256
+        record.encoding = blobs.stored_encoding(path, sha256)
+        if record.encoding is None:
+            record.size, record.stored_size = stat.st_size, None
+        else:  # a link to a compressed blob: the listing keeps the size of the LAS
+            blob = session.get(Blob, sha256)
+            record.size, record.stored_size = (blob.size if blob else record.size), stat.st_size
+        record.mtime = stat.st_mtime
+        record.content_type = mimetypes.guess_type(name)[0]
+        usage.record(session, project_id, 0 if record.id is not None else 1, record.size - old_size)
+        session.add(record)
+        session.commit()
+        session.refresh(record)
+    if orphaned:
+        blobs.discard(old_sha256)
+    return record
+
+
+def remove_file(project_id: int, name: str) -> None:
+    with Session(engine) as session:
+        record = session.exec(get_file_statement(project_id, name)).first()
+        if record is None:
+            return
+        session.delete(record)
+        orphaned = blobs.release(session, record.sha256)
+        usage.record(session, project_id, -1, -record.size)
+        session.commit()
+    if orphaned:
+        blobs.discard(record.sha256)
+
+
+def remove_batch(project_id: int, limit: int) -> list[str]:
+    # drops up to limit records of a project in one transaction (project deletion); returns their names
+    with Session(engine) as session:
+        records = session.exec(select(ProjectFile).where(ProjectFile.project_id == project_id).limit(limit)).all()
+        orphaned = []
+        for record in records:
+            session.delete(record)
+            if blobs.release(session, record.sha256):
+                orphaned.append(record.sha256)
+        usage.record(session, project_id, -len(records), -sum(record.size for record in records))
+        session.commit()
+    for sha256 in orphaned:
+        blobs.discard(sha256)
+    return [record.name for record in records]
+
+
+def move_file(project_id: int, name: str, new_project_id: int, new_name: str | None = None) -> ProjectFile:
+    # the file itself must already be at its new place on disk; the content (and its refcount) is unchanged
+    with Session(engine) as session:
+        record = session.exec(get_file_statement(project_id, name)).one()
+        record.project_id = new_project_id
+        record.name = new_name or name
+        if new_project_id != project_id:
+            usage.record(session, project_id, -1, -record.size)
+            usage.record(session, new_project_id, 1, record.size)
+        session.add(record)
+        session.commit()
+        session.refresh(record)
+        return record
+
+
+def relocate_file(project_id: int, name: str, new_project_id: int, new_name: str | None = None) -> ProjectFile:
+    # moves a file (and its derived artifacts) to another project: renames only, no data is copied
+    new_name = new_name or name
+    target = os.path.join(project_dir(new_project_id), new_name)
+    if os.path.exists(target):
+        raise FileExistsError(f"{new_name} already exists in project {new_project_id}")
+    os.makedirs(project_dir(new_project_id), exist_ok=True)
+    os.rename(os.path.join(project_dir(project_id), name), target)
+    if os.path.isdir(derived_dir(project_id, name)):
+        os.makedirs(os.path.dirname(derived_dir(new_project_id, new_name)), exist_ok=True)
+        os.rename(derived_dir(project_id, name), derived_dir(new_project_id, new_name))
+    return move_file(project_id, name, new_project_id, new_name)
+
+
+def copy_file(project_id: int, name: str, new_project_id: int, new_name: str | None = None) -> ProjectFile:
+    # copies a file (and its derived artifacts) into another project as hardlinks to the same data
+    new_name = new_name or name
+    record = get_file(project_id, name)
+    if record is None:
+        raise FileNotFoundError(name)
+    target = os.path.join(project_dir(new_project_id), new_name)
+    if os.path.exists(target):
+        raise FileExistsError(f"{new_name} already exists in project {new_project_id}")
+    os.makedirs(project_dir(new_project_id), exist_ok=True)
+    os.link(record.path, target)
+    if os.path.isdir(derived_dir(project_id, name)):
+        shutil.copytree(derived_dir(project_id, name), derived_dir(new_project_id, new_name), copy_function=os.link)
+    return index_file(new_project_id, new_name, sha256=record.sha256)
+
+
+### Queries (statements shared by the sync and async variants)
+def get_file_statement(project_id: int, name: str):
+    return select(ProjectFile).where(ProjectFile.project_id == project_id, ProjectFile.name == name)
+
+
+# columns the file listings may be sorted by
+SORT_COLUMNS = {"name": ProjectFile.name, "size": ProjectFile.size, "created_at": ProjectFile.created_at}
+
+
+def files_where(project_id: int, name_filter: str | None = None) -> list:
+    conditions = [ProjectFile.project_id == project_id]
+    if name_filter:
+        conditions.append(ProjectFile.name.contains(name_filter, autoescape=True))
+    return conditions
+
+
+def list_files_statement(project_id: int, offset: int = 0, limit: int | None = None,
+                         sort_by: str = "name", descending: bool = False, name_filter: str | None = None):
+    column = SORT_COLUMNS.get(sort_by, ProjectFile.name)
+    return (
+        select(ProjectFile)
+        .where(*files_where(project_id, name_filter))
+        .order_by(column.desc() if descending else column, ProjectFile.id)
+        .offset(offset)
+        .limit(limit)
+    )
+
+
+def count_files_statement(project_id: int, name_filter: str | None = None):
+    return select(func.count(ProjectFile.id)).where(*files_where(project_id, name_filter))
+
+
+def project_stats_statement(project_ids: list[int]):
+    # read from the usage counters - a primary key lookup per project, not an aggregate over its files
+    return select(ProjectUsage.project_id, ProjectUsage.files, ProjectUsage.size).where(ProjectUsage.project_id.in_(project_ids))
+
+
+def largest_files_statement(project_ids: list[int], extensions: tuple[str, ...]):
+    # SQLite returns the other columns from the row that holds the max()
+    return (
+        select(ProjectFile.project_id, ProjectFile.sha256, func.max(ProjectFile.size))
+        .where(ProjectFile.project_id.in_(project_ids), ProjectFile.sha256.is_not(None),
+               or_(*(ProjectFile.name.ilike(f"%{extension}") for extension in extensions)))
+        .group_by(ProjectFile.project_id)
+    )
+
+
+def get_file(project_id: int, name: str) -> ProjectFile | None:
+    with Session(engine) as session:
+        return session.exec(get_file_statement(project_id, name)).first()
+
+
+def find_by_hash(sha256: str) -> ProjectFile | None:
+    # any indexed file with this content
+    with Session(engine) as session:
+        return session.exec(select(ProjectFile).where(ProjectFile.sha256 == sha256)).first()
+
+
+def list_files(project_id: int, offset: int = 0, limit: int | None = None) -> list[ProjectFile]:
+    with Session(engine) as session:
+        return list(session.exec(list_files_statement(project_id, offset, limit)).all())
+
+
+def project_stats(project_ids: list[int]) -> dict[int, tuple[int, int]]:
+    # project_id -> (number of files, total bytes); projects without files are left out
+    if not project_ids:
+        return {}
+    with Session(engine) as session:
+        rows = session.exec(project_stats_statement(project_ids)).all()
+    return {project_id: (count, size) for project_id, count, size in rows}
+
+
+async def get_file_async(project_id: int, name: str) -> ProjectFile | None:
+    async with async_session_maker() as session:
+        return (await session.exec(get_file_statement(project_id, name))).first()
+
+
+async def list_files_async(project_id: int, offset: int = 0, limit: int | None = None, sort_by: str = "name",
+                           descending: bool = False, name_filter: str | None = None) -> list[ProjectFile]:
+    async with async_session_maker() as session:
+        statement = list_files_statement(project_id, offset, limit, sort_by, descending, name_filter)
+        return list((await session.exec(statement)).all())
+
+
+async def count_files_async(project_id: int, name_filter: str | None = None) -> int:
+    async with async_session_maker() as session:
+        return (await session.exec(count_files_statement(project_id, name_filter))).one()
+
+
+async def project_stats_async(project_ids: list[int]) -> dict[int, tuple[int, int]]:
+    if not project_ids:
+        return {}
+    async with async_session_maker() as session:
+        rows = (await session.exec(project_stats_statement(project_ids))).all()
+    return {project_id: (count, size) for project_id, count, size in rows}
+
+
+async def largest_files_async(project_ids: list[int], extensions: tuple[str, ...]) -> dict[int, str]:
+    # project_id -> sha256 of its largest file with one of the extensions
+    if not project_ids:
+        return {}
+    async with async_session_maker() as session:
+        rows = (await session.exec(largest_files_statement(project_ids, extensions))).all()
+    return {project_id: sha256 for project_id, sha256, _ in rows}
+
+
+### Reconcile
+def reconcile(project_id: int | None = None) -> dict[str, int]:
+    # rebuilds the index from what is actually on disk (all projects when project_id is None)
+    report = {"added": 0, "updated": 0, "removed": 0}
+    if project_id is not None:
+        project_ids = [project_id]
+    elif os.path.isdir(USER_PROJECTS_PATH):
+        project_ids = [int(entry.name) for entry in os.scandir(USER_PROJECTS_PATH) if entry.name.isdigit()]
+    else:
+        project_ids = []
+    with Session(engine) as session:
+        indexed_ids = session.exec(select(ProjectFile.project_id).distinct()).all()
+        # deleted projects are left to the reclaimer (their files are in the trash, not in the project dir)
+        deleted_ids = session.exec(select(Project.id).where(Project.deleted_at.is_not(None))).all()
+    if project_id is None:
+        project_ids = sorted((set(project_ids) | set(indexed_ids)) - set(deleted_ids))
+
+    for pid in project_ids:
+        on_disk = {}
+        if os.path.isdir(project_dir(pid)):
+            on_disk = {
+                entry.name: entry.stat() for entry in os.scandir(project_dir(pid))
+                if entry.is_file() and not is_hidden(entry.name)
+            }
+        indexed = {record.name: record for record in list_files(pid)}
+        for name, stat in on_disk.items():
+            record = indexed.get(name)
+            if record is None:
+                index_file(pid, name)
+                report["added"] += 1
+            elif (record.stored_size or record.size) != stat.st_size or record.mtime != stat.st_mtime:
+                index_file(pid, name)
+                report["updated"] += 1
+        for name in indexed.keys() - on_disk.keys():
+            remove_file(pid, name)
+            report["removed"] += 1
+    if project_id is None:  # refcounts are only exact after a full pass
+        with Session(engine) as session:
+            orphans = blobs.rebuild_refcounts(session)
+            report["usage_corrected"] = usage.recount(session)
+            session.commit()
+        for sha256 in orphans:
+            blobs.discard(sha256)
+    return report
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] != "reconcile":
+        print("usage: python file_index.py reconcile [project_id]")
+        sys.exit(1)
+    from db_connector import create_db_and_tables
+    create_db_and_tables()
+    print(reconcile(int(sys.argv[2]) if len(sys.argv) > 2 else None))
@@ -0,0 +1,28 @@
+### === IMAGE VIEWER === ###
+# Leaflet over the tile pyramid of an image: the browser only loads the tiles in view.
+import math
+
+from nicegui import ui
+
+from image_tiles import tile_url_template
+from pyramid import TILE_SIZE
+
+
+def pixel_to_latlng(x: float, y: float) -> tuple[float, float]:
+    # zoom 0 pixel -> Web Mercator lat/lng (Leaflet's default CRS)
+    lng = x / TILE_SIZE * 360 - 180
+    lat = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / TILE_SIZE))))
+    return lat, lng
+
+
+def show_image_tiles(sha256: str, info: dict) -> None:
+    # info: width, height and max_zoom of the image (image_tiles.image_info)
+    scale = 2 ** -info["max_zoom"]
+    width, height = info["width"] * scale, info["height"] * scale
+    bounds = [pixel_to_latlng(0, height), pixel_to_latlng(width, 0)]
+    viewer = ui.leaflet(center=pixel_to_latlng(width / 2, height / 2), zoom=0,
+                        options={"maxZoom": info["max_zoom"], "attributionControl": False}).classes("w-full h-96")
+    viewer.clear_layers()
+    viewer.tile_layer(url_template=tile_url_template(sha256), options={
+        "maxZoom": info["max_zoom"], "maxNativeZoom": info["max_zoom"], "noWrap": True, "bounds": bounds,
+    })
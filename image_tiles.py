@@ -0,0 +1,152 @@
+### === IMAGE TILE CACHE === ###
+# Pyramids (see pyramid.py) are built in the background after an image upload and kept in
+# TILE_CACHE_PATH/<sha256>/. URLs are content addressed, so they can be cached forever:
+#   GET /tiles/{sha256}/thumb.jpg
+#   GET /tiles/{sha256}/{z}/{x}/{y}.jpg
+# The cache is an LRU on disk: file mtimes act as access times, and the oldest files are removed
+# once TILE_CACHE_MAX_BYTES is exceeded. Evicted assets are rendered again on the next request.
+import asyncio
+import json
+import os
+import re
+import threading
+import time
+from concurrent.futures import Future
+
+from fastapi import APIRouter, HTTPException, Request
+from starlette.concurrency import run_in_threadpool
+
+from config import TILE_CACHE_PATH, TILE_CACHE_MAX_BYTES
+from downloads import ranged_file_response
+from file_index import find_by_hash, get_file
+from pyramid import build_pyramid, render_thumbnail, render_tile, image_size, max_zoom, is_image
+from workers import get_pool, submit
+
+SHA256_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+TOUCH_INTERVAL = 300  # seconds - an access refreshes the mtime at most this often
+EVICTION_INTERVAL = 60  # seconds - on-demand renders check the cache budget at most this often
+IMMUTABLE = "private, max-age=31536000, immutable"
+
+router = APIRouter()
+_eviction_lock = threading.Lock()
+_building: dict[str, Future] = {}  # sha256 -> build in progress
+_last_eviction = 0.0
+
+
+def pyramid_dir(sha256: str) -> str:
+    return os.path.join(TILE_CACHE_PATH, sha256)
+
+
+def thumbnail_url(sha256: str) -> str:
+    return f"/tiles/{sha256}/thumb.jpg"
+
+
+def tile_url_template(sha256: str) -> str:
+    return f"/tiles/{sha256}/{{z}}/{{x}}/{{y}}.jpg"
+
+
+def image_info(sha256: str, path: str) -> dict:
+    try:
+        with open(os.path.join(pyramid_dir(sha256), "info.json")) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        width, height = image_size(path)
+        return {"width": width, "height": height, "max_zoom": max_zoom(width, height)}
+
+
+### Scheduling and eviction
+def schedule_pyramid(project_id: int, name: str) -> Future | None:
+    record = get_file(project_id, name)
+    if record is None or not record.sha256 or not is_image(name):
+        return None
+    if os.path.exists(os.path.join(pyramid_dir(record.sha256), "info.json")) or record.sha256 in _building:
+        return None  # same content already tiled, or being tiled
+    sha256 = record.sha256
+
+    def done(future: Future) -> None:
+        _building.pop(sha256, None)
+        enforce_budget()
+
+    _building[sha256] = submit(f"pyramid {project_id}/{name}", build_pyramid, record.path, pyramid_dir(sha256),
+                               on_done=done)
+    return _building[sha256]
+
+
+def enforce_budget(max_bytes: int = TILE_CACHE_MAX_BYTES) -> int:
+    # removes least recently used files until the cache is back to 90% of the budget; returns bytes freed
+    if not _eviction_lock.acquire(blocking=False):
+        return 0  # another thread is already at it
+    try:
+        files = []
+        for root, _, names in os.walk(TILE_CACHE_PATH):
+            for name in names:
+                path = os.path.join(root, name)
+                if ".tmp" in path:  # being written
+                    continue
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in files)
+        if total <= max_bytes:
+            return 0
+        freed = 0
+        for _, size, path in sorted(files):
+            if total - freed <= max_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+                freed += size
+            except FileNotFoundError:
+                pass
+        return freed
+    finally:
+        _eviction_lock.release()
+
+
+def schedule_eviction() -> None:
+    # renders may remake large levels; the walk over the cache runs in a thread, not awaited
+    global _last_eviction
+    if time.monotonic() - _last_eviction < EVICTION_INTERVAL:
+        return
+    _last_eviction = time.monotonic()
+    asyncio.get_running_loop().run_in_executor(None, enforce_budget)
+
+
+def touch(path: str) -> None:
+    try:
+        if time.time() - os.stat(path).st_mtime > TOUCH_INTERVAL:
+            os.utime(path)
+    except FileNotFoundError:
+        pass
+
+
+async def cached_asset(request: Request, sha256: str, relative: str, render, *args):
+    if not SHA256_PATTERN.match(sha256):
+        raise HTTPException(status_code=404, detail="Not found")
+    path = os.path.join(pyramid_dir(sha256), relative)
+    if not await run_in_threadpool(os.path.exists, path):
+        record = await run_in_threadpool(find_by_hash, sha256)
+        if record is None:
+            raise HTTPException(status_code=404, detail="Not found")
+        future = get_pool().submit(render, record.path, pyramid_dir(sha256), *args)
+        try:
+            path = await asyncio.wrap_future(future)
+        except ValueError:
+            raise HTTPException(status_code=404, detail="Not found")
+        schedule_eviction()
+    else:
+        await run_in_threadpool(touch, path)
+    return ranged_file_response(request, path, etag=f'"{sha256}/{relative}"', content_type="image/jpeg", cache_control=IMMUTABLE)
+
+
+### === ROUTES === ###
+@router.get("/tiles/{sha256}/thumb.jpg")
+async def get_thumbnail(sha256: str, request: Request):
+    return await cached_asset(request, sha256, "thumb.jpg", render_thumbnail)
+
+
+@router.get("/tiles/{sha256}/{z}/{x}/{y}.jpg")
+async def get_tile(sha256: str, z: int, x: int, y: int, request: Request):
+    return await cached_asset(request, sha256, os.path.join(str(z), str(x), f"{y}.jpg"), render_tile, z, x, y)
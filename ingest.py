@@ -0,0 +1,43 @@
+### === POST-UPLOAD PROCESSING === ###
+# ingest_file is called once a file has landed in a project dir: it indexes the file, extracts
+# what is cheap to know right away (LAS headers) and starts the background work that depends
+# on the file type. Nothing here may block - work goes to the threadpool or worker pools.
+import shutil
+
+from starlette.concurrency import run_in_threadpool
+
+from compression import schedule_compression
+from file_index import derived_dir, index_file
+from las_metadata import ensure_metadata
+from mirror import schedule_mirror
+from models import ProjectFile
+from image_tiles import schedule_pyramid
+from previews import schedule_cloud_preview
+from pyramid import is_image
+from spatial import schedule_spatial_index
+from tiling import is_point_cloud, schedule_tiling
+
+
+async def ingest_file(project_id: int, name: str, sha256: str | None = None) -> ProjectFile:
+    record = await run_in_threadpool(index_file, project_id, name, sha256)
+    if is_point_cloud(name):
+        await run_in_threadpool(ensure_metadata, record.path, record.sha256)
+    await run_in_threadpool(after_upload, project_id, name)
+    return record
+
+
+def after_upload(project_id: int, name: str) -> None:
+    # blocking (index lookups, cache checks) - call it through run_in_threadpool
+    schedule_mirror(project_id, name)
+    if is_point_cloud(name):
+        schedule_tiling(project_id, name)
+        schedule_compression(project_id, name)
+        schedule_spatial_index(project_id, name)
+        schedule_cloud_preview(project_id, name)
+    elif is_image(name):
+        schedule_pyramid(project_id, name)
+
+
+def discard_derived(project_id: int, name: str) -> None:
+    # blocking (rmtree of a possibly large octree) - call it through run_in_threadpool
+    shutil.rmtree(derived_dir(project_id, name), ignore_errors=True)
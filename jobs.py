@@ -0,0 +1,255 @@
+### === JOB QUEUE AND SCHEDULER === ###
+# Jobs are rows in the Job table (so the queue survives restarts) and run on a dedicated
+# process pool through a processing backend (processing.py) - never inside the uvicorn worker.
+# The scheduler starts queued jobs by priority, then age, within the global worker limit
+# (JOB_WORKERS) and the per-user limit (JOB_USER_CONCURRENCY). Every uvicorn worker runs a scheduler:
+# a job is claimed with one conditional UPDATE that also checks both limits, so each job runs once
+# and the limits hold for all workers together. The owner renews Job.heartbeat_at while its jobs
+# run; jobs whose heartbeat is older than JOB_HEARTBEAT_TIMEOUT (their worker died) are queued again.
+#   POST /projects/{project_id}/jobs   GET /projects/{project_id}/jobs
+#   GET  /jobs/{job_id}                POST /jobs/{job_id}/cancel
+import asyncio
+import json
+import multiprocessing
+import os
+import socket
+import uuid
+from datetime import timedelta
+from concurrent.futures import ProcessPoolExecutor
+from typing import Annotated
+
+from fastapi import APIRouter, Depends, HTTPException
+from pydantic import BaseModel
+from sqlalchemy import case, func, or_, update
+from sqlalchemy.orm import aliased
+from sqlmodel import select
+
+from auth import get_current_active_user
+from config import JOB_HEARTBEAT_TIMEOUT, JOB_WORKERS, JOB_USER_CONCURRENCY, JOB_POLL_INTERVAL
+from db_connector import async_session_maker, DBConnector
+from models import Job, JobPublic, User, utcnow
+from processing import BACKENDS, run_job
+
+ACTIVE_STATUSES = ("running", "cancelling")
+FINISHED_STATUSES = ("done", "failed", "cancelled")
+
+router = APIRouter()
+db = DBConnector()
+
+
+class JobScheduler:
+    def __init__(self, max_workers: int, per_user: int):
+        self.max_workers = max_workers
+        self.per_user = per_user
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.pool: ProcessPoolExecutor | None = None
+        self.task: asyncio.Task | None = None
+        self.wake_event: asyncio.Event | None = None
+        self.running: set[int] = set()
+
+    def start(self) -> None:
+        self.pool = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context("spawn"))
+        self.wake_event = asyncio.Event()
+        self.task = asyncio.create_task(self.loop())
+
+    async def stop(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+
+    def wake(self) -> None:
+        if self.wake_event is not None:
+            self.wake_event.set()
+
+    async def loop(self) -> None:
+        while True:
+            try:
+                await self.heartbeat()
+                await self.dispatch()
+            except Exception as e:
+                print(f"[jobs] dispatch failed: {e!r}")
+            self.wake_event.clear()
+            try:
+                await asyncio.wait_for(self.wake_event.wait(), timeout=JOB_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    async def heartbeat(self) -> None:
+        # renews the jobs of this scheduler and queues the ones nobody renews any more
+        now = utcnow()
+        async with async_session_maker() as session:
+            if self.running:
+                await session.execute(update(Job).where(Job.id.in_(self.running), Job.owner == self.owner)
+                                      .values(heartbeat_at=now).execution_options(synchronize_session=False))
+            requeued = await session.execute(requeue_stale_statement(now))
+            await session.commit()
+        if requeued.rowcount:
+            print(f"[jobs] {requeued.rowcount} interrupted jobs queued again")
+
+    async def claim(self, job_id: int, user_id: int) -> bool:
+        # one statement, so two schedulers cannot both start the job or both take the last free slot
+        other = aliased(Job)
+        active = select(func.count(other.id)).where(other.status.in_(ACTIVE_STATUSES))
+        now = utcnow()
+        async with async_session_maker() as session:
+            result = await session.execute(update(Job).where(
+                Job.id == job_id,
+                Job.status == "queued",
+                active.scalar_subquery() < self.max_workers,
+                active.where(other.user_id == user_id).scalar_subquery() < self.per_user,
+            ).values(
+                status="running", owner=self.owner, heartbeat_at=now, started_at=now, message="Starting",
+            ).execution_options(synchronize_session=False))
+            await session.commit()
+        return result.rowcount == 1
+
+    async def dispatch(self) -> None:
+        free = self.max_workers - len(self.running)
+        if free <= 0:
+            return
+        async with async_session_maker() as session:
+            running_per_user = dict((await session.exec(
+                select(Job.user_id, func.count(Job.id)).where(Job.status.in_(ACTIVE_STATUSES)).group_by(Job.user_id)
+            )).all())
+            queued = (await session.exec(
+                select(Job.id, Job.user_id).where(Job.status == "queued").order_by(Job.priority.desc(), Job.created_at)
+            )).all()
+        free = min(free, self.max_workers - sum(running_per_user.values()))
+        started = []
+        for job_id, user_id in queued:
+            if len(started) >= free:
+                break
+            if running_per_user.get(user_id, 0) >= self.per_user:
+                continue
+            if await self.claim(job_id, user_id):
+                running_per_user[user_id] = running_per_user.get(user_id, 0) + 1
+                started.append(job_id)
+        for job_id in started:
+            self.running.add(job_id)
+            asyncio.create_task(self.execute(job_id))
+
+    async def execute(self, job_id: int) -> None:
+        try:
+            await asyncio.wrap_future(self.pool.submit(run_job, job_id, self.owner))
+        except Exception as e:  # the worker process died - run_job could not record the outcome
+            async with async_session_maker() as session:
+                job = await session.get(Job, job_id)
+                if job.owner == self.owner and job.status in ACTIVE_STATUSES:
+                    job.status = "failed"
+                    job.message = repr(e)
+                    job.finished_at = utcnow()
+                    session.add(job)
+                    await session.commit()
+        finally:
+            self.running.discard(job_id)
+            self.wake()
+
+
+scheduler = JobScheduler(JOB_WORKERS, JOB_USER_CONCURRENCY)
+
+
+### Job operations (shared by the API and the NiceGUI pages)
+def requeue_stale_statement(now):
+    # running jobs without a recent heartbeat start over; jobs that were being cancelled end as cancelled
+    stale = or_(Job.heartbeat_at.is_(None), Job.heartbeat_at < now - timedelta(seconds=JOB_HEARTBEAT_TIMEOUT))
+    return update(Job).where(Job.status.in_(ACTIVE_STATUSES), stale).values(
+        status=case((Job.status == "cancelling", "cancelled"), else_="queued"),
+        finished_at=case((Job.status == "cancelling", now), else_=None),
+        progress=0, owner=None, heartbeat_at=None, message="Interrupted, its worker stopped",
+    ).execution_options(synchronize_session=False)
+
+
+async def submit_job(user_id: int, project_id: int, backend: str = "local", priority: int = 0, params: dict | None = None) -> Job:
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend {backend!r}")
+    job = Job(user_id=user_id, project_id=project_id, backend=backend,
+              priority=max(-10, min(10, priority)), params=json.dumps(params or {}), message="Queued")
+    async with async_session_maker() as session:
+        session.add(job)
+        await session.commit()
+    scheduler.wake()
+    return job
+
+
+async def cancel_job(job_id: int, user_id: int) -> Job | None:
+    async with async_session_maker() as session:
+        job = await session.get(Job, job_id)
+        if job is None or job.user_id != user_id:
+            return None
+        if job.status == "queued":
+            job.status = "cancelled"
+            job.message = "Cancelled"
+            job.finished_at = utcnow()
+        elif job.status == "running":
+            job.status = "cancelling"  # the worker stops at its next progress report
+            job.message = "Cancelling"
+        session.add(job)
+        await session.commit()
+    scheduler.wake()
+    return job
+
+
+async def list_jobs(project_id: int, limit: int = 20) -> list[Job]:
+    async with async_session_maker() as session:
+        return list((await session.exec(
+            select(Job).where(Job.project_id == project_id).order_by(Job.created_at.desc()).limit(limit)
+        )).all())
+
+
+### === ROUTES === ###
+class JobCreate(BaseModel):
+    backend: str = "local"
+    priority: int = 0
+    params: dict = {}
+
+
+async def get_owned_project_id(project_id: int, user: User) -> int:
+    if await db.get_project_async(project_id, user.username) is None:
+        raise HTTPException(status_code=404, detail="Project not found")
+    return project_id
+
+
+@router.post("/projects/{project_id}/jobs", response_model=JobPublic, status_code=201)
+async def create_job(
+    project_id: int,
+    job: JobCreate,
+    current_user: Annotated[User, Depends(get_current_active_user)],
+):
+    await get_owned_project_id(project_id, current_user)
+    try:
+        return await submit_job(current_user.id, project_id, job.backend, job.priority, job.params)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@router.get("/projects/{project_id}/jobs", response_model=list[JobPublic])
+async def read_project_jobs(
+    project_id: int,
+    current_user: Annotated[User, Depends(get_current_active_user)],
+):
+    await get_owned_project_id(project_id, current_user)
+    return await list_jobs(project_id)
+
+
+@router.get("/jobs/{job_id}", response_model=JobPublic)
+async def read_job(
+    job_id: int,
+    current_user: Annotated[User, Depends(get_current_active_user)],
+):
+    async with async_session_maker() as session:
+        job = await session.get(Job, job_id)
+    if job is None or job.user_id != current_user.id:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+@router.post("/jobs/{job_id}/cancel", response_model=JobPublic)
+async def cancel_job_route(
+    job_id: int,
+    current_user: Annotated[User, Depends(get_current_active_user)],
+):
+    job = await cancel_job(job_id, current_user.id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
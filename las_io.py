@@ -0,0 +1,358 @@
+### === LAS READING === ###
+# Minimal LAS 1.0-1.4 reader: header parsing and chunked point iteration with NumPy
+# structured dtypes, so point clouds are never loaded into memory as a whole.
+# Compressed .laz files are read through laspy (with the lazrs backend) when it is installed.
+import hashlib
+import os
+import struct
+from dataclasses import dataclass
+
+import numpy as np
+
+DEFAULT_CHUNK_POINTS = 1_000_000
+
+# point fields every consumer works with (also the record layout of the Potree octree bins)
+POINT_DTYPE = np.dtype([
+    ("X", "<i4"), ("Y", "<i4"), ("Z", "<i4"),
+    ("intensity", "<u2"),
+    ("classification", "u1"),
+    ("red", "<u2"), ("green", "<u2"), ("blue", "<u2"),
+])
+
+_LEGACY_BASE = [
+    ("X", "<i4"), ("Y", "<i4"), ("Z", "<i4"), ("intensity", "<u2"),
+    ("return_bits", "u1"), ("class_bits", "u1"), ("scan_angle_rank", "i1"),
+    ("user_data", "u1"), ("point_source_id", "<u2"),
+]
+_EXTENDED_BASE = [
+    ("X", "<i4"), ("Y", "<i4"), ("Z", "<i4"), ("intensity", "<u2"),
+    ("return_bits", "u1"), ("class_flags", "u1"), ("classification", "u1"),
+    ("user_data", "u1"), ("scan_angle", "<i2"), ("point_source_id", "<u2"), ("gps_time", "<f8"),
+]
+_GPS = [("gps_time", "<f8")]
+_RGB = [("red", "<u2"), ("green", "<u2"), ("blue", "<u2")]
+_NIR = [("nir", "<u2")]
+_WAVE = [
+    ("wave_descriptor", "u1"), ("wave_offset", "<u8"), ("wave_size", "<u4"),
+    ("wave_return_location", "<f4"), ("wave_dx", "<f4"), ("wave_dy", "<f4"), ("wave_dz", "<f4"),
+]
+RECORD_FIELDS = {
+    0: _LEGACY_BASE,
+    1: _LEGACY_BASE + _GPS,
+    2: _LEGACY_BASE + _RGB,
+    3: _LEGACY_BASE + _GPS + _RGB,
+    4: _LEGACY_BASE + _GPS + _WAVE,
+    5: _LEGACY_BASE + _GPS + _RGB + _WAVE,
+    6: _EXTENDED_BASE,
+    7: _EXTENDED_BASE + _RGB,
+    8: _EXTENDED_BASE + _RGB + _NIR,
+    9: _EXTENDED_BASE + _WAVE,
+    10: _EXTENDED_BASE + _RGB + _NIR + _WAVE,
+}
+
+
+class LasError(Exception):
+    pass
+
+
+@dataclass
+class LasHeader:
+    version: str
+    point_format: int
+    point_record_length: int
+    offset_to_point_data: int
+    number_of_vlrs: int
+    header_size: int
+    point_count: int
+    scale: tuple[float, float, float]
+    offset: tuple[float, float, float]
+    mins: tuple[float, float, float]
+    maxs: tuple[float, float, float]
+    compressed: bool
+    global_encoding: int = 0
+    start_of_evlrs: int = 0
+    number_of_evlrs: int = 0
+
+
+def parse_header(data: bytes) -> LasHeader:
+    # data: at least the first 375 bytes of the file (fewer for LAS < 1.4)
+    if len(data) < 227 or data[:4] != b"LASF":
+        raise LasError("Not a LAS file")
+    major, minor = data[24], data[25]
+    header_size, offset_to_points, number_of_vlrs = struct.unpack_from("<HII", data, 94)
+    format_byte, record_length, legacy_count = struct.unpack_from("<BHI", data, 104)
+    scale = struct.unpack_from("<3d", data, 131)
+    offset = struct.unpack_from("<3d", data, 155)
+    max_x, min_x, max_y, min_y, max_z, min_z = struct.unpack_from("<6d", data, 179)
+    point_count = legacy_count
+    start_of_evlrs = number_of_evlrs = 0
+    if (major, minor) >= (1, 4) and len(data) >= 255:
+        start_of_evlrs, number_of_evlrs, point_count_14 = struct.unpack_from("<QIQ", data, 235)
+        point_count = point_count_14 or legacy_count
+    point_format = format_byte & 0x3F
+    if point_format not in RECORD_FIELDS:
+        raise LasError(f"Unsupported point data format {point_format}")
+    return LasHeader(
+        version=f"{major}.{minor}",
+        point_format=point_format,
+        point_record_length=record_length,
+        offset_to_point_data=offset_to_points,
+        number_of_vlrs=number_of_vlrs,
+        header_size=header_size,
+        point_count=point_count,
+        scale=scale,
+        offset=offset,
+        mins=(min_x, min_y, min_z),
+        maxs=(max_x, max_y, max_z),
+        # LAZ sets the two high bits of the point format byte
+        compressed=bool(format_byte & 0xC0),
+        global_encoding=struct.unpack_from("<H", data, 6)[0],
+        start_of_evlrs=start_of_evlrs,
+        number_of_evlrs=number_of_evlrs,
+    )
+
+
+def read_header(path: str) -> LasHeader:
+    with open(path, "rb") as f:
+        return parse_header(f.read(375))
+
+
+def record_dtype(point_format: int, record_length: int) -> np.dtype:
+    # on-disk layout of one point record, including trailing extra bytes
+    dtype = np.dtype(RECORD_FIELDS[point_format])
+    if record_length < dtype.itemsize:
+        raise LasError("Point record length is shorter than its point format")
+    if record_length > dtype.itemsize:
+        dtype = np.dtype(RECORD_FIELDS[point_format] + [("extra_bytes", f"V{record_length - dtype.itemsize}")])
+    return dtype
+
+
+def to_points(records: np.ndarray) -> np.ndarray:
+    # converts raw records of any point format to POINT_DTYPE
+    points = np.zeros(len(records), dtype=POINT_DTYPE)
+    names = records.dtype.names
+    for name in ("X", "Y", "Z", "intensity"):
+        points[name] = records[name]
+    if "classification" in names:
+        points["classification"] = records["classification"]
+    else:
+        points["classification"] = records["class_bits"] & 0x1F
+    if "red" in names:
+        for name in ("red", "green", "blue"):
+            points[name] = records[name]
+    return points
+
+
+def is_laz(path: str, header: LasHeader | None = None) -> bool:
+    header = header or read_header(path)
+    return header.compressed or path.lower().endswith(".laz")
+
+
+def iter_records(path: str, chunk_points: int = DEFAULT_CHUNK_POINTS, header: LasHeader | None = None):
+    # raw point records of an uncompressed LAS file, chunk_points at a time
+    header = header or read_header(path)
+    dtype = record_dtype(header.point_format, header.point_record_length)
+    with open(path, "rb") as f:
+        f.seek(header.offset_to_point_data)
+        remaining = header.point_count
+        while remaining > 0:
+            records = np.fromfile(f, dtype=dtype, count=min(chunk_points, remaining))
+            if len(records) == 0:
+                break
+            remaining -= len(records)
+            yield records
+
+
+def import_laspy():
+    try:
+        import laspy
+    except ImportError:
+        raise LasError("Reading .laz files needs laspy with a LAZ backend (pip install 'laspy[lazrs]')")
+    return laspy
+
+
+def _iter_laz_points(path: str, chunk_points: int):
+    laspy = import_laspy()
+    with laspy.open(path) as reader:
+        for chunk in reader.chunk_iterator(chunk_points):
+            points = np.zeros(len(chunk), dtype=POINT_DTYPE)
+            points["X"], points["Y"], points["Z"] = chunk.X, chunk.Y, chunk.Z
+            points["intensity"] = chunk.intensity
+            points["classification"] = chunk.classification
+            if "red" in chunk.point_format.dimension_names:
+                points["red"], points["green"], points["blue"] = chunk.red, chunk.green, chunk.blue
+            yield points
+
+
+def iter_points(path: str, chunk_points: int = DEFAULT_CHUNK_POINTS):
+    # POINT_DTYPE chunks of a LAS or LAZ file; X/Y/Z stay as the scaled integers of the file
+    header = read_header(path)
+    if is_laz(path, header):
+        yield from _iter_laz_points(path, chunk_points)
+    else:
+        for records in iter_records(path, chunk_points, header):
+            yield to_points(records)
+
+
+### LAS <-> LAZ with byte-exact restore
+# LAZ keeps the point records losslessly, but a LAZ writer rewrites the header and VLRs. The envelope
+# is the LAS file with its point records cut out (header, VLRs, and EVLRs or anything else after the
+# points), so envelope + decompressed records give back the original file byte for byte.
+def point_data_span(header: LasHeader) -> tuple[int, int]:
+    start = header.offset_to_point_data
+    return start, start + header.point_count * header.point_record_length
+
+
+def _copy_range(source, start: int, stop: int, block_size: int = 1024 * 1024):
+    # bytes [start, stop) of an open file
+    source.seek(start)
+    remaining = stop - start
+    while remaining > 0:
+        data = source.read(min(block_size, remaining))
+        if not data:
+            raise LasError("File ends before its point data")
+        remaining -= len(data)
+        yield data
+
+
+def write_envelope(source: str, target: str) -> None:
+    header = read_header(source)
+    points_start, points_end = point_data_span(header)
+    with open(source, "rb") as f, open(target, "wb") as out:
+        size = os.fstat(f.fileno()).st_size
+        if size < points_end:
+            raise LasError("File ends before its point data")
+        for data in _copy_range(f, 0, points_start):
+            out.write(data)
+        for data in _copy_range(f, points_end, size):
+            out.write(data)
+
+
+def write_laz(source: str, target: str, chunk_points: int = DEFAULT_CHUNK_POINTS) -> None:
+    laspy = import_laspy()
+    with laspy.open(source) as reader:
+        with laspy.open(target, mode="w", header=reader.header, do_compress=True) as writer:
+            for chunk in reader.chunk_iterator(chunk_points):
+                writer.write_points(chunk)
+
+
+def _iter_laz_record_bytes(path: str, first: int, stop: int, record_length: int, chunk_points: int):
+    # bytes [first, stop) of the raw point records stored in a LAZ file
+    laspy = import_laspy()
+    with laspy.open(path) as reader:
+        index = first // record_length
+        reader.seek(index)
+        skip = first - index * record_length
+        remaining = stop - first
+        while remaining > 0:
+            chunk = reader.read_points(min(chunk_points, -(-(remaining + skip) // record_length)))
+            if len(chunk) == 0:
+                raise LasError("LAZ file ends before its point count")
+            data = memoryview(chunk.array.tobytes())
+            if len(data) != len(chunk) * record_length:
+                raise LasError("Decompressed point records don't match the record length of the file")
+            data = data[skip:skip + remaining]
+            skip = 0
+            remaining -= len(data)
+            yield bytes(data)
+
+
+def iter_restored_las(laz_path: str, envelope_path: str, start: int = 0, end: int | None = None,
+                      chunk_points: int = DEFAULT_CHUNK_POINTS):
+    # bytes [start, end] of the LAS file that laz_path and envelope_path were made from, streamed
+    with open(envelope_path, "rb") as envelope:
+        header = parse_header(envelope.read(375))
+        points_start, points_end = point_data_span(header)
+        points_size = points_end - points_start
+        size = os.fstat(envelope.fileno()).st_size + points_size
+        end = size - 1 if end is None else min(end, size - 1)
+        if start < points_start:
+            yield from _copy_range(envelope, start, min(end + 1, points_start))
+        if start < points_end and end >= points_start:
+            yield from _iter_laz_record_bytes(laz_path, max(start, points_start) - points_start,
+                                              min(end + 1, points_end) - points_start,
+                                              header.point_record_length, chunk_points)
+        if end >= points_end:
+            yield from _copy_range(envelope, max(start, points_end) - points_size, end + 1 - points_size)
+
+
+def compress_las(source: str, laz_path: str, envelope_path: str, sha256: str) -> int:
+    # worker side of LAS compression: writes the LAZ copy and the envelope, then checks that they
+    # restore content with the given hash; returns the LAZ size, leaves nothing behind on failure
+    try:
+        if read_header(source).compressed:
+            raise LasError("Already LAZ")
+        write_envelope(source, envelope_path)
+        write_laz(source, laz_path)
+        digest = hashlib.sha256()
+        for data in iter_restored_las(laz_path, envelope_path):
+            digest.update(data)
+        if digest.hexdigest() != sha256:
+            raise LasError("LAZ copy does not restore the original file")
+        return os.path.getsize(laz_path)
+    except BaseException:
+        for path in (laz_path, envelope_path):
+            if os.path.exists(path):
+                os.remove(path)
+        raise
+
+
+def las_header(point_count: int, scale, offset, mins, maxs) -> bytes:
+    # LAS 1.2 header for point format 2 records, no VLRs
+    header = bytearray(227)
+    header[:4] = b"LASF"
+    header[24:26] = bytes([1, 2])
+    struct.pack_into("<HII", header, 94, 227, 227, 0)
+    struct.pack_into("<BHI", header, 104, 2, 26, point_count)
+    struct.pack_into("<3d", header, 131, *scale)
+    struct.pack_into("<3d", header, 155, *offset)
+    struct.pack_into("<6d", header, 179, maxs[0], mins[0], maxs[1], mins[1], maxs[2], mins[2])
+    return bytes(header)
+
+
+def to_las_records(points: np.ndarray) -> np.ndarray:
+    # POINT_DTYPE -> point format 2 records
+    records = np.zeros(len(points), dtype=record_dtype(2, 26))
+    for name in ("X", "Y", "Z", "intensity", "red", "green", "blue"):
+        records[name] = points[name]
+    records["class_bits"] = points["classification"] & 0x1F
+    return records
+
+
+def write_las(path: str, points: np.ndarray, scale=(0.001, 0.001, 0.001), offset=(0.0, 0.0, 0.0)) -> None:
+    # small LAS 1.2 writer (point format 2), used for tests and benchmark fixtures
+    xyz = [points[axis].astype(np.float64) * scale[i] + offset[i] for i, axis in enumerate("XYZ")]
+    mins = [axis.min() if len(points) else 0.0 for axis in xyz]
+    maxs = [axis.max() if len(points) else 0.0 for axis in xyz]
+    with open(path, "wb") as f:
+        f.write(las_header(len(points), scale, offset, mins, maxs))
+        to_las_records(points).tofile(f)
+
+
+def test_write_and_read_las(tmp_path="."):
+    points = np.zeros(10, dtype=POINT_DTYPE)
+    points["X"] = np.arange(10)
+    points["classification"] = 2
+    path = os.path.join(tmp_path, "test_points.las")
+    write_las(path, points)
+    header = read_header(path)
+    assert header.point_count == 10 and header.point_format == 2
+    read_back = np.concatenate(list(iter_points(path, chunk_points=3)))
+    assert (read_back == points).all()
+    os.remove(path)
+
+
+def test_envelope_roundtrip(tmp_path="."):
+    points = np.zeros(5, dtype=POINT_DTYPE)
+    points["X"] = np.arange(5)
+    path = os.path.join(tmp_path, "test_envelope.las")
+    write_las(path, points)
+    with open(path, "ab") as f:
+        f.write(b"EVLR")
+    write_envelope(path, path + ".envelope")
+    with open(path, "rb") as f:
+        original = f.read()
+    with open(path + ".envelope", "rb") as f:
+        assert f.read() == original[:227] + b"EVLR"
+    os.remove(path)
+    os.remove(path + ".envelope")
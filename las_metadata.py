@@ -0,0 +1,176 @@
+### === LAS METADATA === ###
+# Header, CRS and a per-class summary of uploaded point clouds, extracted when the file is
+# ingested and stored in PointCloudMetadata (keyed by content hash, so copies and duplicates
+# share it). Only the header, the VLRs and a strided sample of the point records are touched,
+# all through mmap - a multi-GB file costs a few hundred page reads, not a full read.
+import json
+import mmap
+import re
+import struct
+
+import numpy as np
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import Session, select
+
+from db_connector import engine, async_session_maker
+from las_io import LasError, parse_header, record_dtype
+from models import PointCloudMetadata
+
+SAMPLE_POINTS = 100_000  # upper bound of point records read for the class summary
+VLR_HEADER = struct.Struct("<H16sHH32s")  # reserved, user id, record id, record length, description
+EVLR_HEADER = struct.Struct("<H16sHQ32s")
+GEOKEY_DIRECTORY, OGC_WKT = 34735, 2112  # record ids of the LASF_Projection VLRs
+PROJECTED_CRS_KEY, GEOGRAPHIC_CRS_KEY = 3072, 2048
+
+# ASPRS standard classes
+CLASS_NAMES = {
+    0: "never classified", 1: "unclassified", 2: "ground", 3: "low vegetation", 4: "medium vegetation",
+    5: "high vegetation", 6: "building", 7: "low point", 9: "water", 10: "rail", 11: "road surface",
+    13: "wire guard", 14: "wire conductor", 15: "transmission tower", 17: "bridge deck", 18: "high noise",
+}
+
+
+def iter_vlrs(data, header):
+    # (user id, record id, payload start, payload length) of the VLRs and, for LAS 1.4, the EVLRs;
+    # payloads are sliced by the caller, EVLRs may hold gigabytes of waveform data
+    position = header.header_size
+    for _ in range(header.number_of_vlrs):
+        if position + VLR_HEADER.size > len(data):
+            return
+        _, user_id, record_id, length, _ = VLR_HEADER.unpack_from(data, position)
+        position += VLR_HEADER.size
+        yield user_id.rstrip(b"\0").decode("ascii", "replace"), record_id, position, length
+        position += length
+    position = header.start_of_evlrs
+    for _ in range(header.number_of_evlrs if position else 0):
+        if position + EVLR_HEADER.size > len(data):
+            return
+        _, user_id, record_id, length, _ = EVLR_HEADER.unpack_from(data, position)
+        position += EVLR_HEADER.size
+        yield user_id.rstrip(b"\0").decode("ascii", "replace"), record_id, position, length
+        position += length
+
+
+def epsg_from_geokeys(payload: bytes) -> int | None:
+    keys = np.frombuffer(payload[:len(payload) // 2 * 2], dtype="<u2")
+    if len(keys) < 4:
+        return None
+    entries = keys[4:4 + 4 * int(keys[3])].reshape(-1, 4)
+    values = {int(key): int(value) for key, location, _, value in entries if location == 0}
+    code = values.get(PROJECTED_CRS_KEY) or values.get(GEOGRAPHIC_CRS_KEY)
+    return code if code and code < 32767 else None  # 32767: user-defined
+
+
+def epsg_from_wkt(wkt: str) -> int | None:
+    # the outermost authority is the last one in WKT1 (AUTHORITY[...]) and WKT2 (ID[...])
+    codes = re.findall(r'(?:AUTHORITY|ID)\[\s*"EPSG"\s*,\s*"?(\d+)"?\s*\]', wkt)
+    return int(codes[-1]) if codes else None
+
+
+def class_summary(data, header) -> tuple[dict[int, int], int]:
+    # estimated points per class from every n-th record, read through the memory map
+    dtype = record_dtype(header.point_format, header.point_record_length)
+    available = (len(data) - header.offset_to_point_data) // dtype.itemsize
+    count = min(header.point_count, available)
+    if count <= 0:
+        return {}, 0
+    records = np.frombuffer(data, dtype=dtype, count=count, offset=header.offset_to_point_data)
+    sample = records[::max(1, count // SAMPLE_POINTS)]
+    classes = sample["classification"] if "classification" in dtype.names else sample["class_bits"] & 0x1F
+    counts = np.bincount(classes)
+    del records, sample, classes  # the map can only be closed once no array points into it
+    scale = count / max(1, counts.sum())
+    return {int(c): int(round(n * scale)) for c, n in enumerate(counts) if n}, int(counts.sum())
+
+
+def extract_metadata(path: str) -> dict:
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        header = parse_header(data[:375])
+        crs_wkt, epsg = None, None
+        for user_id, record_id, start, length in iter_vlrs(data, header):
+            if user_id != "LASF_Projection" or record_id not in (OGC_WKT, GEOKEY_DIRECTORY):
+                continue
+            payload = data[start:start + length]
+            if record_id == OGC_WKT:
+                crs_wkt = payload.rstrip(b"\0").decode("utf-8", "replace")
+                epsg = epsg_from_wkt(crs_wkt) or epsg
+            elif record_id == GEOKEY_DIRECTORY and epsg is None:
+                epsg = epsg_from_geokeys(payload)
+        class_counts, sampled = ({}, 0) if header.compressed else class_summary(data, header)
+    return {
+        "version": header.version,
+        "point_format": header.point_format,
+        "point_count": header.point_count,
+        "bounds": [*header.mins, *header.maxs],
+        "scale": list(header.scale),
+        "offset": list(header.offset),
+        "crs": f"EPSG:{epsg}" if epsg else None,
+        "crs_wkt": crs_wkt,
+        "class_counts": class_counts,
+        "sampled_points": sampled,
+    }
+
+
+### Storage
+def ensure_metadata(path: str, sha256: str) -> PointCloudMetadata | None:
+    # blocking - call it through run_in_threadpool; reuses what is stored for identical content
+    with Session(engine) as session:
+        stored = session.get(PointCloudMetadata, sha256)
+        if stored is not None:
+            return stored
+        try:
+            metadata = extract_metadata(path)
+        except (LasError, ValueError) as e:
+            print(f"[metadata] {path}: {e}")
+            return None
+        stored = PointCloudMetadata(
+            sha256=sha256, version=metadata["version"], point_format=metadata["point_format"],
+            point_count=metadata["point_count"], bounds=json.dumps(metadata["bounds"]),
+            scale=json.dumps(metadata["scale"]), offset=json.dumps(metadata["offset"]),
+            crs=metadata["crs"], crs_wkt=metadata["crs_wkt"],
+            class_counts=json.dumps(metadata["class_counts"]), sampled_points=metadata["sampled_points"],
+        )
+        session.add(stored)
+        try:
+            session.commit()
+        except IntegrityError:  # the same content was ingested concurrently
+            session.rollback()
+            return session.get(PointCloudMetadata, sha256)
+        session.refresh(stored)
+        return stored
+
+
+async def metadata_for(sha256s: list[str]) -> dict[str, PointCloudMetadata]:
+    # one query for the files of a listing page
+    if not sha256s:
+        return {}
+    async with async_session_maker() as session:
+        rows = await session.exec(select(PointCloudMetadata).where(PointCloudMetadata.sha256.in_(sha256s)))
+        return {row.sha256: row for row in rows.all()}
+
+
+def describe(metadata: PointCloudMetadata) -> str:
+    # one line for listings: points, CRS and the largest classes
+    parts = [f"{metadata.point_count:,} points", f"LAS {metadata.version} format {metadata.point_format}"]
+    if metadata.crs:
+        parts.append(metadata.crs)
+    counts = {int(c): n for c, n in json.loads(metadata.class_counts or "{}").items()}
+    total = sum(counts.values())
+    if total:
+        top = sorted(counts.items(), key=lambda item: -item[1])[:3]
+        parts.append(", ".join(f"{CLASS_NAMES.get(c, f'class {c}')} {n / total:.0%}" for c, n in top))
+    return " · ".join(parts)
+
+
+def test_extract_metadata(tmp_path="."):
+    import os
+    from las_io import POINT_DTYPE, write_las
+    points = np.zeros(1000, dtype=POINT_DTYPE)
+    points["classification"][:250] = 2
+    points["classification"][250:] = 6
+    path = os.path.join(tmp_path, "test_metadata.las")
+    write_las(path, points)
+    metadata = extract_metadata(path)
+    assert metadata["point_count"] == 1000 and metadata["crs"] is None
+    assert metadata["class_counts"] == {2: 250, 6: 750}
+    os.remove(path)
@@ -1,5 +1,14 @@
 #!/usr/bin/env python3
 
+### === ENTRY POINT === ###
+# uvicorn imports the app by name, so the launching process stops here instead of building every page
+# twice; with LOTOGRAFIA_HEADLESS it serves api.fastapi_app and NiceGUI is never imported
+if __name__ == '__main__':
+    import uvicorn
+    from config import HEADLESS
+    uvicorn.run('api:fastapi_app' if HEADLESS else 'main:fastapi_app', host='127.0.0.1', port=8000, log_level='info')
+    raise SystemExit
+
 ### === IMPORTS === ###
 ### Standard library
 from datetime import datetime, timedelta
@@ -7,6 +16,7 @@ import os
 import time
 from typing import Annotated, Optional
 import functools
+import json
 
 ### Backend frameworks (FastAPI is built on Starlette)
 import uvicorn # ASGI server
@@ -23,101 +33,113 @@ from starlette.middleware.base import BaseHTTPMiddleware
 from auth import *
 from models import *
 from views import *
-from db_connector import create_db_and_tables, get_session, SessionDep, engine, DBConnector
+from api import fastapi_app # every API route; this module adds the NiceGUI pages
+from db_connector import create_db_and_tables, get_session, SessionDep, engine, async_session_maker, DBConnector
+from config import USER_PROJECTS_PATH, PARTIAL_UPLOADS_DIRNAME, UPLOAD_SPOOL_MAX_SIZE
+from blobs import HashingWriter
+from downloads import signed_file_url
+import tiling
+from ingest import ingest_file, discard_derived
+from las_metadata import metadata_for, describe
+from cloud_display import show_point_cloud
+from image_tiles import image_info, thumbnail_url
+from previews import has_preview, preview_url
+from image_display import show_image_tiles
+from table_display import PagedTable
+from pyramid import is_image
+import file_index
+from jobs import submit_job, cancel_job, list_jobs, FINISHED_STATUSES
+from processing import BACKENDS
+from trash import delete_project
+import usage
+from archives import ArchiveError, ArchiveExtractor, archive_kind
+from metrics import UPLOAD_BYTES, UPLOADS_IN_PROGRESS, timed_page
+import session_store
+import upload_governor
+from upload_governor import UploadRejected, governor
+from starlette.concurrency import run_in_threadpool
 # from db_connector import create_heroes
 
 ### === CONSTANTS AND SWITCHES === ###
-fastapi_app = FastAPI()
-MultiPartParser.spool_max_size = 1024 * 1024 * 1024 * 20  # 20 GiB
+MultiPartParser.spool_max_size = UPLOAD_SPOOL_MAX_SIZE  # larger form uploads go to the temp directory, see upload_governor.py
 
 db = DBConnector()
 
-USER_PROJECTS_PATH = os.path.join("user_projects") 
-
 @fastapi_app.on_event("startup")
-def on_startup():
-    create_db_and_tables()
-    if not os.path.exists(USER_PROJECTS_PATH):
-        os.makedirs(USER_PROJECTS_PATH)
-
-
-@fastapi_app.post("/token") # endpoint to obtain a JWT token needed to access protected routes
-async def login_for_access_token(
-    form_data: Annotated[OAuth2PasswordRequestForm, Depends()],
-) -> Token:
-    auth_result = authenticate_user(form_data.username, form_data.password)
-    if not auth_result:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Incorrect username or password",
-            headers={"WWW-Authenticate": "Bearer"}
-        )
-    user = db.get_user(form_data.username)
-    access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    access_token = create_access_token(
-        # "sub" stems from "subject" and is a standard defined in JWT docs
-        data = {"sub": user.username}, expires_delta=access_token_expires)
-    return Token(access_token=access_token, token_type="bearer")
-
-### WITH NO JWT (left here for learning purposes) ###
-# @fastapi_app.post("/token") # according to OAuth2 spec, this response must be a JSON object
-# async def login(form_data: Annotated[OAuth2PasswordRequestForm, Depends()]):
-#     user_dict = fake_users_db.get(form_data.username)
-#     if not user_dict:
-#         raise HTTPException(status_code=400, detail="Incorrect username or password")
-#     user = UserInDB(**user_dict)
-#     hashed_password = fake_hash_password(form_data.password)
-#     if not hashed_password == user.hashed_password:
-#         raise HTTPException(status_code=400, detail="Incorrect username or password")
-
-#     # this access token should be something unique and secret
-#     return {"access_token": user.username, "token_type": "bearer"}
-
-
-# @fastapi_app.get("/users/me/items/")
-# async def read_own_items(current_user):
-#     return [{"item_id": "Foo", "owner": current_user.username}]
-
-@fastapi_app.get("/users/me", response_model=UserPublic)
-async def read_users_me(
-    current_user: Annotated[User, Depends(get_current_active_user)]
-    ):
-    return current_user
-
-
-@fastapi_app.get("/users/me/items/")
-async def read_own_items(
-    current_user: Annotated[User, Depends(get_current_active_user)],
-):
-    return [{"item_id": "Foo", "owner": current_user.username}]
-
-
-@fastapi_app.get("/items/")
-async def read_items(token: Annotated[str, Depends(oauth2_scheme)]):
-    return {"token": token}
-
-
-### ROOT
-@fastapi_app.get('/')
-def get_root():
-    return {'message': 'Hello, FastAPI! Browse to /app to see the NiceGUI app.'}
+def on_startup_ui():
+    session_store.writer.start()
+
+
+@fastapi_app.on_event("shutdown")
+async def on_shutdown_ui():
+    await session_store.writer.stop()
 
 # APP LOGIC
-UPLOAD_DIR = Path.cwd() / 'uploads'
-UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
+UPLOAD_DIR = Path.cwd() / 'uploads' # form uploads outside of a project; created on first use
 
 ### Logic functions
-async def page_reload():
-    ui.run_javascript('location.reload();')
-
-async def handle_upload(e: events.UploadEventArguments, destination=""):
-    filename = f"{uuid.uuid4().hex}_{Path(e.file.name).name}"
-    dest = UPLOAD_DIR / filename
-    if len(destination)>0:
-        dest =os.path.join(destination, Path(e.file.name).name) 
-    await e.file.save(dest)
-    print(dest)
-    await page_reload()
+async def handle_upload(file: ui.upload.FileUpload, project_id: int | None = None, extract: bool = False):
+    name = Path(file.name).name
+    if project_id is None:
+        UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
+        await file.save(UPLOAD_DIR / f"{uuid.uuid4().hex}_{name}")
+        return
+    dest = os.path.join(file_index.project_dir(project_id), name)
+    user = await db.get_user_async(app.storage.user["username"])
+    # the body is already here (the governor admitted it); the project volume may still be short
+    try:
+        await governor.check_space(file_index.project_dir(project_id), file.size())
+    except UploadRejected as error:
+        ui.notify(f"{name}: {error.detail}", type="warning")
+        return
+    if extract and archive_kind(name):
+        await handle_archive_upload(file, project_id, user)
+        return
+    # the page limits the upload size to the remaining quota already; this covers concurrent uploads
+    if not await usage.admits(user, file.size()):
+        ui.notify(f"{name}: storage quota exceeded", type="negative")
+        return
+    # hashed while it is written, then renamed into place - indexing doesn't read it again
+    partial = os.path.join(file_index.project_dir(project_id), PARTIAL_UPLOADS_DIRNAME, uuid.uuid4().hex)
+    os.makedirs(os.path.dirname(partial), exist_ok=True)
+    writer = await run_in_threadpool(HashingWriter, partial)
+    UPLOADS_IN_PROGRESS.inc(kind="form")
+    try:
+        async for chunk in file.iterate():
+            await run_in_threadpool(writer.write, chunk)
+            UPLOAD_BYTES.inc(len(chunk), kind="form")
+    finally:
+        UPLOADS_IN_PROGRESS.dec(kind="form")
+    sha256 = await run_in_threadpool(writer.close)
+    os.replace(partial, dest)
+    await ingest_file(project_id, name, sha256)
+
+
+async def handle_uploads(e: events.MultiUploadEventArguments, project_id: int, on_done=None, extract: bool = False):
+    # one batch of files, one refresh of the page at the end
+    for file in e.files:
+        await handle_upload(file, project_id, extract)
+    if on_done is not None:
+        await on_done()
+
+
+async def handle_archive_upload(file: ui.upload.FileUpload, project_id: int, user: User) -> None:
+    # members go straight into the project, the archive itself is not written anywhere
+    extractor = ArchiveExtractor(project_id, archive_kind(file.name), await usage.remaining_bytes(user))
+    extractor.start()
+    try:
+        async for chunk in file.iterate():
+            await extractor.feed(chunk)
+            UPLOAD_BYTES.inc(len(chunk), kind="archive")
+        report = await extractor.finish()
+    except ArchiveError as error:
+        await extractor.abort()
+        ui.notify(f"{file.name}: {error}", type="negative")
+        return
+    message = f"{file.name}: {len(report['extracted'])} files extracted"
+    if report["skipped"]:
+        message += f", {len(report['skipped'])} skipped"
+    ui.notify(message, type="positive")
 
 
 def is_authenticated():
@@ -130,13 +152,10 @@ def check_if_authenticated():
         @functools.wraps(func)  # For preserving the metadata of func.
         def wrapper(*args, **kwargs):
             # Do stuff before func possibly using arg...
-            print("AUTH DECORATOR")
             if app.storage.user.get("authenticated") != True:
-                print("aaa")
                 ui.navigate.to("/login")
                 return
             else:  
-                print("bbb")
                 return  func(*args, **kwargs)
             # Do stuff after func possibly using arg...
             # return result
@@ -156,6 +175,7 @@ def navbar():
 
 ### WELCOME
 @ui.page('/')
+@timed_page
 async def show():
     navbar()
     ui.label("username").bind_text_from(app.storage.user, "username")
@@ -163,20 +183,24 @@ async def show():
     # NOTE dark mode will be persistent for each user across tabs and server restarts
     ui.dark_mode().bind_value(app.storage.user, 'dark_mode')
     ui.checkbox('dark mode').bind_value(app.storage.user, 'dark_mode')
-    ui.upload(multiple=True,on_upload=handle_upload).classes('max-w-full' )
+    ui.upload(multiple=True,on_upload=lambda e: handle_upload(e.file)).classes('max-w-full' )
 
 ### LOGIN
 @ui.page('/login')
+@timed_page
 def login(redirect_to: str = '/') -> Optional[RedirectResponse]:
     navbar()
-    def login():
+    async def login():
         if 'username' in app.storage.user.keys():
             if app.storage.user['username'] == username.value:
                 ui.notify('You are already logged in.', color='info')
                 return
         
-        
-        user = authenticate_user(username.value, password.value)
+        try:
+            user = await authenticate_user_async(username.value, password.value)
+        except HashingPoolBusy:
+            ui.notify('Server is busy, please try again in a moment.', color='warning')
+            return
         if not user:
             ui.notify('Login failed. Please check your credentials.', color='negative')
             return
@@ -206,34 +230,28 @@ def login(redirect_to: str = '/') -> Optional[RedirectResponse]:
 
 ### PROJECT CREATION
 @ui.page("/add-project")
+@timed_page
 def add_project():
     navbar()
-    def add_project_handler():
+    async def add_project_handler():
         ### Database section
-        with Session(engine) as session:
-            current_user = session.exec(
-                select(User).where(User.username == app.storage.user["username"])
-            ).one()
-            if current_user.projects != []: 
-                other_project_names = list(map(lambda project: project.name, current_user.projects))
-                print(other_project_names)
-                if project_name.value in other_project_names:
-                    raise ValueError("Project with this name already created for this user!")
-                
+        username = app.storage.user["username"]
+        if await db.project_name_taken_async(username, project_name.value):
+            raise ValueError("Project with this name already created for this user!")
+        current_user = await db.get_user_async(username)
+        async with async_session_maker() as session:
             new_project = Project(
                 name = project_name.value,
                 description = project_description.value,
-                user = current_user
+                user_id = current_user.id
             )
             session.add(new_project)
-            
+            await session.flush() # assigns the id
+
             ### Storage creation section
-            project_id = session.exec(
-                select(Project.id).where(Project.user == current_user, Project.name == project_name.value)
-            ).one()
-            project_path = os.path.join(USER_PROJECTS_PATH, str(project_id))
+            project_path = os.path.join(USER_PROJECTS_PATH, str(new_project.id))
             os.makedirs(project_path)
-            session.commit()
+            await session.commit()
 
     if not is_authenticated():
         ui.navigate.to("/login")
@@ -244,18 +262,17 @@ def add_project():
 
 
 ### PROJECT DELETION
-def handle_delete_project(project_to_delete) -> None:
-    def delete_project():
-        print("project deletion")
-        with Session(engine) as session:
-            session.delete(project_to_delete)
-            session.commit()
+def handle_delete_project(project_to_delete: Project, on_deleted=None) -> None:
+    async def delete_project_handler():
+        # hidden and moved to the trash right away, the files are removed in the background
+        await delete_project(project_to_delete.id, app.storage.user["username"])
         dialog.close()
-        ui.run_javascript('location.reload();')
-        
+        if on_deleted is not None:
+            await on_deleted()
+
     with ui.dialog() as dialog, ui.card():
         ui.label(f"Are you sure that you want to delete {project_to_delete.name}?")
-        ui.button("Yes", on_click=lambda: delete_project())
+        ui.button("Yes", on_click=delete_project_handler)
         ui.button("No", on_click=dialog.close)
     dialog.open()
 
@@ -263,91 +280,267 @@ def handle_delete_project(project_to_delete) -> None:
 ### PROJECT/project_id PAGE
 
 # file deletion
-async def handle_delete_file(file_entry: os.DirEntry) -> None:
-    os.remove(file_entry.path)
-    await page_reload()
+async def handle_delete_file(file_entry: ProjectFile, on_done=None) -> None:
+    await run_in_threadpool(os.remove, file_entry.path)
+    await run_in_threadpool(file_index.remove_file, file_entry.project_id, file_entry.name)
+    await run_in_threadpool(discard_derived, file_entry.project_id, file_entry.name)
+    if on_done is not None:
+        await on_done()
 
 
 # file download
-def handle_download(e: events.UploadEventArguments) -> None:
-    pass
+def handle_download(file_entry: ProjectFile) -> None:
+    # signed link to the ranged download route (lives on fastapi_app, outside the /app mount)
+    url = signed_file_url(file_entry.project_id, file_entry.name)
+    ui.run_javascript(f"window.location.assign({json.dumps(url)})")
 
 # file opening (.las, .tiff)
-def handle_open_file(file_entry: os.DirEntry) -> None:
-    print("OPENING FILE")
-    if file_entry.name[-3:].lower() in ["png", "jpg"]:
-        ui.image(file_entry.path)
+def handle_open_file(file_entry: ProjectFile) -> None:
+    if is_image(file_entry.name):
+        show_image_tiles(file_entry.sha256, image_info(file_entry.sha256, file_entry.path))
+    elif tiling.is_point_cloud(file_entry.name):
+        if tiling.has_octree(file_entry.project_id, file_entry.name):
+            show_point_cloud(tiling.octree_url(file_entry.project_id, file_entry.name), description=file_entry.name)
+        else:
+            ui.notify("This point cloud is still being prepared for viewing.", type="info")
     else:
         ui.notify("This file extension is not supported yet!", type="info")
-        print(file_entry.name[-3:].lower())
-# file move (to other project)
+# file move (to other project) - renames/hardlinks, the data is never copied
+async def handle_move_file(file_entry: ProjectFile, on_done=None) -> None:
+    projects = await db.get_projects_async(app.storage.user["username"])
+    targets = {project.id: project.name for project in projects if project.id != file_entry.project_id}
+    if not targets:
+        ui.notify("There is no other project to move this file to.", type="info")
+        return
+
+    async def transfer(operation) -> None:
+        if operation is file_index.copy_file and not await usage.admits(
+                await db.get_user_async(app.storage.user["username"]), file_entry.size):
+            ui.notify("Storage quota exceeded", type="negative")
+            return
+        try:
+            await run_in_threadpool(operation, file_entry.project_id, file_entry.name, target.value)
+        except FileExistsError:
+            ui.notify(f"{file_entry.name} already exists in {targets[target.value]}", type="warning")
+            return
+        dialog.close()
+        if on_done is not None:
+            await on_done()
 
+    with ui.dialog() as dialog, ui.card():
+        ui.label(f"Move or copy {file_entry.name} to:")
+        target = ui.select(targets, value=next(iter(targets)))
+        with ui.row():
+            ui.button("Move", on_click=lambda: transfer(file_index.relocate_file))
+            ui.button("Copy", on_click=lambda: transfer(file_index.copy_file))
+            ui.button("Cancel", on_click=dialog.close)
+    dialog.open()
 
-## file action menu
-def file_bar(file_entry: os.DirEntry) -> None:
+
+## file table (one page of the file index at a time)
+FILE_COLUMNS = [
+    {"name": "thumb", "label": "", "field": "thumb"},
+    {"name": "name", "label": "Name", "field": "name", "sortable": True, "align": "left"},
+    {"name": "size", "label": "Size", "field": "size_label", "sortable": True},
+    {"name": "created_at", "label": "Added", "field": "created_label", "sortable": True},
+    {"name": "details", "label": "Details", "field": "details", "align": "left"},
+    {"name": "actions", "label": "", "field": "id"},
+]
+FILE_ACTIONS = (("open", "visibility", "Open file"), ("download", "download", "Download file"),
+                ("delete", "delete", "Delete file"), ("move", "drive_file_move", "Move file"))
+
+
+def thumbnail(file_entry: ProjectFile) -> str:
+    if not file_entry.sha256:
+        return ""
+    if is_image(file_entry.name):
+        return thumbnail_url(file_entry.sha256)
+    if tiling.is_point_cloud(file_entry.name) and has_preview(file_entry.sha256):
+        return preview_url(file_entry.sha256)
+    return ""
+
+
+THUMBNAIL_SLOT = '''
+    <q-td :props="props"><q-img v-if="props.value" :src="props.value" fit="contain" style="width: 48px; height: 48px" /></q-td>
+'''
+
+
+def file_row(file_entry: ProjectFile, metadata: dict) -> dict:
+    # metadata: stored PointCloudMetadata of the page by sha256 - no file is opened while listing
+    return {
+        "id": file_entry.id,
+        "name": file_entry.name,
+        "size_label": f"{file_entry.size / 1024**2:.1f} MiB",
+        "created_label": file_entry.created_at.strftime("%Y-%m-%d %H:%M"),
+        "thumb": thumbnail(file_entry),
+        "details": describe(metadata[file_entry.sha256]) if file_entry.sha256 in metadata else "",
+    }
+
+
+def action_buttons_slot(actions) -> str:
+    buttons = "".join(
+        f'<q-btn flat dense round icon="{icon}" @click="() => $parent.$emit(\'{event}\', props.row)"><q-tooltip>{label}</q-tooltip></q-btn>'
+        for event, icon, label in actions
+    )
+    return f'<q-td :props="props">{buttons}</q-td>'
+
+
+def files_table(project: Project) -> PagedTable:
+    async def fetch(offset, limit, sort_by, descending, name_filter):
+        entries = await file_index.list_files_async(project.id, offset, limit, sort_by or "name", descending, name_filter)
+        metadata = await metadata_for([entry.sha256 for entry in entries if tiling.is_point_cloud(entry.name) and entry.sha256])
+        rows = [file_row(entry, metadata) for entry in entries]
+        return rows, await file_index.count_files_async(project.id, name_filter)
+
+    files = PagedTable(FILE_COLUMNS, fetch)
+    files.table.add_slot("body-cell-thumb", THUMBNAIL_SLOT)
+    files.table.add_slot("body-cell-actions", action_buttons_slot(FILE_ACTIONS))
+
+    async def with_entry(row: dict, action) -> None:
+        file_entry = await file_index.get_file_async(project.id, row["name"])
+        if file_entry is None:  # removed in the meantime
+            await files.refresh()
+            return
+        result = action(file_entry)
+        if result is not None:
+            await result
+
+    files.on_action("open", lambda row: with_entry(row, handle_open_file))
+    files.on_action("download", lambda row: with_entry(row, handle_download))
+    files.on_action("delete", lambda row: with_entry(row, lambda entry: handle_delete_file(entry, files.refresh)))
+    files.on_action("move", lambda row: with_entry(row, lambda entry: handle_move_file(entry, files.refresh)))
+    return files
+
+
+## processing jobs
+async def handle_start_job(project: Project, backend: str, on_change) -> None:
+    user = await db.get_user_async(app.storage.user["username"])
+    await submit_job(user.id, project.id, backend)
+    ui.notify("Processing job queued", type="info")
+    await on_change()
+
+
+async def handle_cancel_job(job: Job, on_change) -> None:
+    await cancel_job(job.id, job.user_id)
+    await on_change()
+
+
+def job_row(job: Job, on_change) -> None:
+    with ui.row().classes("items-center"):
+        ui.label(f"#{job.id} {job.backend}: {job.status}")
+        ui.linear_progress(value=job.progress, show_value=False).classes("w-48")
+        ui.label(job.message or "")
+        if job.status not in FINISHED_STATUSES:
+            ui.button("Cancel", on_click=lambda: handle_cancel_job(job, on_change))
+
+
+async def jobs_section(project: Project) -> None:
+    # one refreshable per page, so the polling timer only redraws this client's list
+    @ui.refreshable
+    async def jobs_panel() -> None:
+        for job in await list_jobs(project.id):
+            job_row(job, jobs_panel.refresh)
+
+    ui.label("Processing")
     with ui.row():
-        ui.label(file_entry.name)
-        ui.button("Open file", on_click=lambda: handle_open_file(file_entry))
-        ui.button("Download file", on_click=lambda e: ui.download.file(file_entry.path))
-        ui.button("Delete file", on_click=lambda: handle_delete_file(file_entry))
-        ui.button("Move file", on_click=lambda e: ui.notify("Not implemented yet!", type="info"))
+        backend = ui.select({name: b.description for name, b in BACKENDS.items()}, value="local")
+        ui.button("Start processing", on_click=lambda: handle_start_job(project, backend.value, jobs_panel.refresh))
+    await jobs_panel()
+    ui.timer(2.0, jobs_panel.refresh)
 
 
 @ui.page("/project/{project_id}")
+@timed_page
 @check_if_authenticated()
-def project_edit(project_id: int) -> None:
+async def project_edit(project_id: int) -> None:
     navbar()
     ### getting project data
-    with Session(engine) as session:
-        projects = session.exec(
-            select(User).where(User.username == app.storage.user["username"])
-        ).one().projects
-    project = list(filter(lambda project: project.id == int(project_id), projects))[0]
+    project = await db.get_project_async(int(project_id), app.storage.user["username"])
+    if project is None:
+        ui.label("Project not found")
+        return
     ui.label(f"Project name: {project.name}")
     ui.label(f"Project description: {project.description}")
     # ui.label(project_id)
 
     ### upload module
-    project_path = os.path.join(USER_PROJECTS_PATH, str(project_id))
-    ui.upload(multiple=True,on_upload=lambda e: handle_upload(e, destination = project_path)).classes('max-w-full' )
+    remaining = await usage.remaining_bytes(await db.get_user_async(app.storage.user["username"]))
+    # all selected files in one request (on_multi_upload), so the file list is refreshed once per batch
+    upload = ui.upload(multiple=True, max_total_size=max(0, remaining) if remaining is not None else None,
+                       on_multi_upload=lambda e: handle_uploads(e, project_id = project.id, on_done = files.refresh, extract = extract.value)).classes('max-w-full' )
+    extract = ui.switch("Extract ZIP/TAR archives into the project", value=True)
 
-    ### list files in dir
-    dir_generator = os.scandir(project_path)
-    for entry in dir_generator:
-        file_bar(entry)
-        # ui.label(entry.name)
+    ### list project files (from the file index, not the directory)
+    files = files_table(project)
+    await files.refresh()
+
+    ### processing jobs
+    await jobs_section(project)
 
 
 ### projects PAGE
-def project_bar(project: Project) -> None:
-    with ui.row():
-        ui.label(f"Project name: {project.name}")
-        ui.label(f"Number of files: {len(list(
-            os.scandir(os.path.join(USER_PROJECTS_PATH, str(project.id)))))}")
-        ui.button("Go to project", on_click= lambda: ui.navigate.to(f"/project/{project.id}"))
-        ui.button("Delete project", on_click=lambda e: handle_delete_project(e, project))
+PROJECT_COLUMNS = [
+    {"name": "thumb", "label": "", "field": "thumb"},
+    {"name": "name", "label": "Project name", "field": "name", "sortable": True, "align": "left"},
+    {"name": "description", "label": "Description", "field": "description", "align": "left"},
+    {"name": "files", "label": "Number of files", "field": "files"},
+    {"name": "size", "label": "Size", "field": "size_label"},
+    {"name": "actions", "label": "", "field": "id"},
+]
+PROJECT_ACTIONS = (("go", "folder_open", "Go to project"), ("delete", "delete", "Delete project"))
+
+
+def projects_table(username: str) -> PagedTable:
+    async def fetch(offset, limit, sort_by, descending, name_filter):
+        page = await db.get_projects_async(username, offset, limit, descending, name_filter)
+        stats = await file_index.project_stats_async([project.id for project in page])
+        # preview of the largest point cloud of each project
+        clouds = await file_index.largest_files_async([project.id for project in page], tiling.POINT_CLOUD_EXTENSIONS)
+        rows = []
+        for project in page:
+            file_count, total_size = stats.get(project.id, (0, 0))
+            sha256 = clouds.get(project.id)
+            rows.append({"id": project.id, "name": project.name, "description": project.description or "",
+                         "thumb": preview_url(sha256) if sha256 and has_preview(sha256) else "",
+                         "files": file_count, "size_label": f"{total_size / 1024**2:.1f} MiB"})
+        return rows, await db.count_projects_async(username, name_filter)
+
+    projects = PagedTable(PROJECT_COLUMNS, fetch)
+    projects.table.add_slot("body-cell-thumb", THUMBNAIL_SLOT)
+    projects.table.add_slot("body-cell-actions", action_buttons_slot(PROJECT_ACTIONS))
+
+    async def delete(row: dict) -> None:
+        project = await db.get_project_async(row["id"], username)
+        if project is not None:
+            handle_delete_project(project, projects.refresh)
+
+    projects.on_action("go", lambda row: ui.navigate.to(f"/project/{row['id']}"))
+    projects.on_action("delete", delete)
+    return projects
 
 
 @ui.page("/projects")
+@timed_page
 @check_if_authenticated()
-def projects() -> Optional[RedirectResponse]:
+async def projects() -> Optional[RedirectResponse]:
     navbar()
     # if app.storage.user.get("authenticated") != True:
     #     ui.navigate.to("/login")
     # else:
-    projects = db.get_projects(app.storage.user["username"])
     ui.button("Add project", on_click = lambda: ui.navigate.to("/add-project"))
-    for project in projects:
-        project_bar(project)      
+    user = await db.get_user_async(app.storage.user["username"])
+    used = await usage.get_user_usage(user.id)
+    quota = usage.quota_for(user)
+    ui.label(f"Storage used: {used.size / 1024**3:.2f} GiB in {used.files} files"
+             + (f" of {quota / 1024**3:.2f} GiB" if quota else ""))
+    await projects_table(app.storage.user["username"]).refresh()
 
 ### APP MOUNT WITH FASTAPI
+session_store.install(app) # app.storage.user in the database, shared by all workers
+upload_governor.install(app) # form uploads wait for a slot, or get 503/507 + Retry-After before their body is read
 ui.run_with(
     fastapi_app,
     mount_path='/app/',  # NOTE this can be omitted if you want the paths passed to @ui.page to be at the root
     storage_secret='pick your private secret here',  # NOTE setting a secret is optional but allows for persistent storage per user
 )
 
-
-### === FASTAPI MOUNT === ###
-if __name__ == '__main__':
-    uvicorn.run('main:fastapi_app', host='127.0.0.1', port=8000, log_level='info')
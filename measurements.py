@@ -0,0 +1,324 @@
+### === MEASUREMENTS === ###
+# POST /projects/{project_id}/files/{name}/measurements, in the coordinates of the point cloud:
+#   {"kind": "distance", "points": [[x, y, z], [x, y, z]]}
+#   {"kind": "polyline", "points": [[x, y, z], ...]}
+#   {"kind": "area",     "points": [[x, y], ...], "resolution": r}
+#   {"kind": "profile",  "points": [[x, y], ...], "width": w, "step": s}
+#   {"kind": "volume",   "points": [[x, y], ...], "resolution": r, "reference": z | [a, b, c]}
+# Vertices given without Z are put on the cloud (median Z of the points within "radius").
+# Areas and volumes bin the region into a grid of "resolution" sized cells (mean Z per cell); profiles
+# bin the points within width / 2 of the line by distance along it. Points come in chunks from the
+# memory-mapped spatial index (spatial_index.py), at most SAMPLES_PER_CELL per grid cell on average,
+# so time and memory depend on the grid, not on the size of the cloud.
+# The volume reference is the plane z = a * x + b * y + c (a number is a level plane); without one
+# it is fitted through the vertices of the outline. Results are cached next to the spatial index,
+# keyed by the request.
+import hashlib
+import json
+import math
+import os
+import uuid
+from typing import Annotated, Literal
+
+import numpy as np
+from fastapi import APIRouter, Depends, HTTPException
+from pydantic import BaseModel
+from starlette.concurrency import run_in_threadpool
+
+from auth import get_current_active_user
+from models import User
+from spatial import get_indexed_sha256, index_dir
+from spatial_index import SpatialIndex, points_in_polygon
+
+MAX_GRID = 1000  # grid cells per axis
+MAX_PROFILE_BINS = 10_000
+SAMPLES_PER_CELL = 32  # points read per grid cell (or profile bin) on average
+RESULT_VERSION = 1  # bump when results change for the same request
+
+router = APIRouter()
+
+
+### Geometry
+def point_spacing(index: SpatialIndex) -> float:
+    # average distance between neighbouring points
+    extent = np.subtract(index.info["maxs"][:2], index.info["mins"][:2])
+    return math.sqrt(max(float(np.prod(extent)), 1e-12) / max(index.info["point_count"], 1))
+
+
+def iter_xyz(index: SpatialIndex, **query):
+    for points in index.query(**query):
+        yield (points["X"] * index.scale[0] + index.offset[0],
+               points["Y"] * index.scale[1] + index.offset[1],
+               points["Z"] * index.scale[2] + index.offset[2])
+
+
+def surface_z(index: SpatialIndex, x: float, y: float, radius: float) -> float:
+    z = [chunk[2] for chunk in iter_xyz(index, bbox=[x - radius, y - radius, x + radius, y + radius], budget=10_000)]
+    if not z or not sum(map(len, z)):
+        raise ValueError(f"No points within {radius:g} of ({x:g}, {y:g})")
+    return float(np.median(np.concatenate(z)))
+
+
+def vertices_3d(index: SpatialIndex, vertices: np.ndarray, radius: float) -> np.ndarray:
+    # [[x, y, z]], Z taken from the cloud where it was not given
+    if vertices.shape[1] == 3:
+        return vertices
+    return np.column_stack([vertices, [surface_z(index, x, y, radius) for x, y in vertices]])
+
+
+def polygon_area(polygon: np.ndarray) -> float:
+    x, y = polygon[:, 0], polygon[:, 1]
+    return float(abs(np.dot(x, np.roll(y, -1)) - np.dot(y, np.roll(x, -1))) / 2)
+
+
+def fit_plane(points: np.ndarray) -> np.ndarray:
+    # least squares z = a * x + b * y + c
+    design = np.column_stack([points[:, 0], points[:, 1], np.ones(len(points))])
+    return np.linalg.lstsq(design, points[:, 2], rcond=None)[0]
+
+
+class Grid:
+    # mean Z per cell of a regular grid, filled chunk by chunk
+    def __init__(self, low: np.ndarray, high: np.ndarray, resolution: float):
+        self.resolution = max(resolution, float(np.max(high - low)) / MAX_GRID)
+        self.low = low
+        self.shape = tuple(int(max(math.ceil((high[axis] - low[axis]) / self.resolution), 1)) for axis in (1, 0))
+        self.count = np.zeros(self.shape[0] * self.shape[1], dtype=np.int64)
+        self.total = np.zeros(self.shape[0] * self.shape[1])
+
+    def add(self, x: np.ndarray, y: np.ndarray, z: np.ndarray) -> None:
+        column = np.floor((x - self.low[0]) / self.resolution).astype(np.int64)
+        row = np.floor((y - self.low[1]) / self.resolution).astype(np.int64)
+        inside = (column >= 0) & (column < self.shape[1]) & (row >= 0) & (row < self.shape[0])
+        cells = row[inside] * self.shape[1] + column[inside]
+        self.count += np.bincount(cells, minlength=len(self.count))
+        self.total += np.bincount(cells, weights=z[inside], minlength=len(self.total))
+
+    def mean(self) -> np.ndarray:
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return (self.total / self.count).reshape(self.shape)  # NaN where empty
+
+    def centers(self) -> tuple[np.ndarray, np.ndarray]:
+        columns = self.low[0] + (np.arange(self.shape[1]) + 0.5) * self.resolution
+        rows = self.low[1] + (np.arange(self.shape[0]) + 0.5) * self.resolution
+        return np.meshgrid(columns, rows)
+
+    def mask(self, polygon: np.ndarray) -> np.ndarray:
+        x, y = self.centers()
+        return points_in_polygon(x.ravel(), y.ravel(), polygon).reshape(self.shape)
+
+
+def polygon_grid(index: SpatialIndex, polygon: np.ndarray, resolution: float | None) -> Grid:
+    low, high = polygon.min(axis=0), polygon.max(axis=0)
+    grid = Grid(low, high, resolution or 2 * point_spacing(index))
+    bbox = [*low, *(low + np.array(grid.shape[::-1]) * grid.resolution)]
+    for x, y, z in iter_xyz(index, bbox=bbox, budget=grid.count.size * SAMPLES_PER_CELL):
+        grid.add(x, y, z)
+    return grid
+
+
+def json_list(values: np.ndarray) -> list:
+    return [None if np.isnan(value) else float(value) for value in values]
+
+
+### Measurements
+def measure_distance(index: SpatialIndex, vertices: np.ndarray, radius: float) -> dict:
+    if len(vertices) != 2:
+        raise ValueError("distance needs 2 points")
+    a, b = vertices_3d(index, vertices, radius)
+    return {
+        "distance": float(np.linalg.norm(b - a)),
+        "horizontal": float(np.linalg.norm(b[:2] - a[:2])),
+        "vertical": float(b[2] - a[2]),
+        "points": [a.tolist(), b.tolist()],
+    }
+
+
+def measure_polyline(index: SpatialIndex, vertices: np.ndarray, radius: float) -> dict:
+    vertices = vertices_3d(index, vertices, radius)
+    steps = np.diff(vertices, axis=0)
+    return {
+        "length": float(np.linalg.norm(steps, axis=1).sum()),
+        "horizontal_length": float(np.linalg.norm(steps[:, :2], axis=1).sum()),
+        "points": vertices.tolist(),
+    }
+
+
+def measure_area(index: SpatialIndex, polygon: np.ndarray, resolution: float | None) -> dict:
+    grid = polygon_grid(index, polygon, resolution)
+    z = grid.mean()
+    covered = grid.mask(polygon) & ~np.isnan(z)
+    # surface of the mean-Z grid: every cell tilted by the local gradient
+    tilt = np.ones(grid.shape)
+    if min(grid.shape) > 1:
+        dz_dy, dz_dx = np.gradient(np.where(np.isnan(z), np.nanmean(z) if covered.any() else 0, z), grid.resolution)
+        tilt = np.sqrt(1 + dz_dx ** 2 + dz_dy ** 2)
+    cell_area = grid.resolution ** 2
+    return {
+        "area": polygon_area(polygon),
+        "surface_area": float(tilt[covered].sum() * cell_area),
+        "covered_area": float(covered.sum() * cell_area),
+        "resolution": grid.resolution,
+    }
+
+
+def measure_volume(index: SpatialIndex, polygon: np.ndarray, resolution: float | None,
+                   reference: float | list[float] | None, radius: float) -> dict:
+    if reference is None:
+        plane = fit_plane(vertices_3d(index, polygon, radius))
+    elif isinstance(reference, list):
+        if len(reference) != 3:
+            raise ValueError("reference must be a height or [a, b, c] of z = a * x + b * y + c")
+        plane = np.array(reference, dtype=np.float64)
+    else:
+        plane = np.array([0, 0, reference], dtype=np.float64)
+    grid = polygon_grid(index, polygon[:, :2], resolution)
+    x, y = grid.centers()
+    height = grid.mean() - (plane[0] * x + plane[1] * y + plane[2])
+    inside = grid.mask(polygon[:, :2])
+    covered = inside & ~np.isnan(height)
+    cell_area = grid.resolution ** 2
+    above, below = np.clip(height[covered], 0, None), np.clip(height[covered], None, 0)
+    return {
+        "volume": float((above.sum() + below.sum()) * cell_area),
+        "cut": float(above.sum() * cell_area),  # material above the reference
+        "fill": float(abs(below.sum()) * cell_area),  # space below it
+        "area": polygon_area(polygon),
+        "covered_area": float(covered.sum() * cell_area),
+        "empty_area": float((inside & ~covered).sum() * cell_area),
+        "reference": plane.tolist(),
+        "resolution": grid.resolution,
+    }
+
+
+def measure_profile(index: SpatialIndex, line: np.ndarray, width: float, step: float | None) -> dict:
+    line = line[:, :2]
+    segments = np.diff(line, axis=0)
+    lengths = np.linalg.norm(segments, axis=1)
+    if not lengths.sum():
+        raise ValueError("profile line has no length")
+    starts = np.r_[0, np.cumsum(lengths)[:-1]]
+    total = float(lengths.sum())
+    step = max(step or total / 500, total / MAX_PROFILE_BINS)
+    bins = int(math.ceil(total / step))
+    count, z_sum = np.zeros(bins, dtype=np.int64), np.zeros(bins)
+    z_min, z_max = np.full(bins, np.inf), np.full(bins, -np.inf)
+    half = width / 2
+    low, high = line.min(axis=0) - half, line.max(axis=0) + half
+    for x, y, z in iter_xyz(index, bbox=[*low, *high], budget=bins * SAMPLES_PER_CELL):
+        # distance along the line (station) of every point within the corridor, from its nearest segment
+        station, offset = np.full(len(x), np.nan), np.full(len(x), np.inf)
+        for start, segment, length, first in zip(line, segments, lengths, starts):
+            if not length:
+                continue
+            t = np.clip(((x - start[0]) * segment[0] + (y - start[1]) * segment[1]) / length ** 2, 0, 1)
+            distance = np.hypot(x - start[0] - t * segment[0], y - start[1] - t * segment[1])
+            nearer = distance < offset
+            offset[nearer], station[nearer] = distance[nearer], first + t[nearer] * length
+        near = offset <= half
+        bin_ids = np.minimum((station[near] / step).astype(np.int64), bins - 1)
+        count += np.bincount(bin_ids, minlength=bins)
+        z_sum += np.bincount(bin_ids, weights=z[near], minlength=bins)
+        np.minimum.at(z_min, bin_ids, z[near])
+        np.maximum.at(z_max, bin_ids, z[near])
+    empty = count == 0
+    z_min[empty] = z_max[empty] = np.nan
+    with np.errstate(invalid="ignore", divide="ignore"):
+        z_mean = z_sum / count
+    return {
+        "length": total,
+        "step": step,
+        "station": json_list(np.minimum((np.arange(bins) + 0.5) * step, total)),
+        "z_min": json_list(z_min),
+        "z_mean": json_list(z_mean),
+        "z_max": json_list(z_max),
+        "count": count.tolist(),
+    }
+
+
+### Caching
+class MeasurementRequest(BaseModel):
+    kind: Literal["distance", "polyline", "area", "profile", "volume"]
+    points: list[list[float]]
+    resolution: float | None = None  # grid cell size of area and volume
+    width: float = 1.0  # corridor of a profile
+    step: float | None = None  # bin length of a profile
+    reference: float | list[float] | None = None  # volume reference plane
+    radius: float | None = None  # for putting vertices without Z on the cloud
+
+
+def measure(index_path: str, request: MeasurementRequest) -> dict:
+    # blocking; the cached result when the same request was answered before
+    key = hashlib.sha256(json.dumps([RESULT_VERSION, request.model_dump()], sort_keys=True).encode()).hexdigest()
+    cache_path = os.path.join(index_path, "measurements", f"{key}.json")
+    try:
+        with open(cache_path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        pass
+    vertices = np.array(request.points, dtype=np.float64)
+    if vertices.ndim != 2 or vertices.shape[1] not in (2, 3) or len(vertices) < 2:
+        raise ValueError("points must be at least 2 [x, y] or [x, y, z] vertices")
+    if request.kind in ("area", "volume") and len(vertices) < 3:
+        raise ValueError(f"{request.kind} needs a polygon of at least 3 vertices")
+    if min(request.resolution or 1, request.step or 1, request.width, request.radius or 1) <= 0:
+        raise ValueError("resolution, step, width and radius must be positive")
+    index = SpatialIndex(index_path)
+    radius = request.radius or 4 * point_spacing(index)
+    if request.kind == "distance":
+        result = measure_distance(index, vertices, radius)
+    elif request.kind == "polyline":
+        result = measure_polyline(index, vertices, radius)
+    elif request.kind == "area":
+        result = measure_area(index, vertices[:, :2], request.resolution)
+    elif request.kind == "profile":
+        result = measure_profile(index, vertices, request.width, request.step)
+    else:
+        result = measure_volume(index, vertices, request.resolution, request.reference, radius)
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    temporary = f"{cache_path}.{uuid.uuid4().hex}.tmp"
+    with open(temporary, "w") as f:
+        json.dump(result, f)
+    os.replace(temporary, cache_path)
+    return result
+
+
+### === ROUTES === ###
+@router.post("/projects/{project_id}/files/{name}/measurements")
+async def create_measurement(
+    project_id: int,
+    name: str,
+    request: MeasurementRequest,
+    current_user: Annotated[User, Depends(get_current_active_user)],
+):
+    sha256 = await get_indexed_sha256(project_id, name, current_user)
+    try:
+        return await run_in_threadpool(measure, index_dir(sha256), request)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+def test_volume_of_box(tmp_path="."):
+    import shutil
+    from las_io import POINT_DTYPE, write_las
+    from spatial_index import build_spatial_index
+    # 100 x 100 m at 0.5 m spacing, a 20 x 10 m block 3 m high on flat ground at z = 1
+    x, y = np.meshgrid(np.arange(0, 100, 0.5), np.arange(0, 100, 0.5))
+    z = np.where((x >= 40) & (x < 60) & (y >= 40) & (y < 50), 4.0, 1.0)
+    points = np.zeros(x.size, dtype=POINT_DTYPE)
+    points["X"], points["Y"], points["Z"] = x.ravel() * 1000, y.ravel() * 1000, z.ravel() * 1000
+    src, out = os.path.join(tmp_path, "test_measure.las"), os.path.join(tmp_path, "test_measure.index")
+    write_las(src, points)
+    try:
+        build_spatial_index(src, out)
+        outline = [[30, 30], [70, 30], [70, 60], [30, 60]]
+        result = measure(out, MeasurementRequest(kind="volume", points=outline, resolution=1.0))
+        assert abs(result["volume"] - 600) < 1 and abs(result["reference"][2] - 1) < 1e-6
+        assert measure(out, MeasurementRequest(kind="volume", points=outline, resolution=1.0)) == result  # cached
+        result = measure(out, MeasurementRequest(kind="distance", points=[[10, 10], [50, 45]]))
+        assert abs(result["vertical"] - 3) < 1e-6 and abs(result["horizontal"] - math.hypot(40, 35)) < 1e-6
+        result = measure(out, MeasurementRequest(kind="profile", points=[[0, 45], [100, 45]], step=5))
+        assert result["z_max"][8:12] == [4.0] * 4 and result["z_max"][0] == 1.0
+    finally:
+        os.remove(src)
+        shutil.rmtree(out, ignore_errors=True)
@@ -0,0 +1,257 @@
+### === METRICS === ###
+# In-process instrumentation exposed at /metrics in the Prometheus text format: request latency per
+# route, SQLite query timing (engine events), upload traffic, hashing pool and principal cache
+# state, and NiceGUI page render times. With LOTOGRAFIA_METRICS_SPAN_LOG set, every request also
+# writes one JSON line with its duration and the time it spent in the database.
+import bisect
+import contextvars
+import functools
+import inspect
+import json
+import logging
+import threading
+import time
+
+from fastapi import APIRouter, Header, HTTPException
+from fastapi.responses import PlainTextResponse
+from sqlalchemy import event
+
+from config import METRICS_SPAN_LOG, METRICS_TOKEN
+
+router = APIRouter(tags=["metrics"])
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+INF_BUCKET = 'le="+Inf"'
+
+
+### Metric types
+class Metric:
+    # one metric family; samples are keyed by their label values
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.lock = threading.Lock()  # DB events and threadpool code update metrics off the event loop
+        registry.append(self)
+
+    def key(self, labels: dict) -> tuple:
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def label_text(self, key: tuple, extra: str = "") -> str:
+        pairs = [f'{label}="{escape(value)}"' for label, value in zip(self.labels, key)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def samples(self) -> list[str]:
+        raise NotImplementedError
+
+    def render(self) -> list[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}", *self.samples()]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, documentation, labels)
+        self.values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self) -> list[str]:
+        with self.lock:
+            return [f"{self.name}{self.label_text(key)} {value}" for key, value in self.values.items()]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+
+class FunctionGauge(Metric):
+    # value read when /metrics is scraped, for state that already lives elsewhere (pool sizes, cache stats)
+    def __init__(self, name: str, documentation: str, function, kind: str = "gauge"):
+        super().__init__(name, documentation)
+        self.function = function
+        self.kind = kind
+
+    def samples(self) -> list[str]:
+        return [f"{self.name} {self.function()}"]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = (), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+        self.values: dict[tuple, list] = {}  # key -> [bucket counts..., count, sum]
+
+    def observe(self, value: float, **labels) -> None:
+        key = self.key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.setdefault(key, [0] * (len(self.buckets) + 2))
+            if index < len(self.buckets):
+                counts[index] += 1
+            counts[-2] += 1
+            counts[-1] += value
+
+    def samples(self) -> list[str]:
+        lines = []
+        with self.lock:
+            for key, counts in self.values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts):
+                    cumulative += count
+                    bucket = 'le="%s"' % bound
+                    lines.append(f"{self.name}_bucket{self.label_text(key, bucket)} {cumulative}")
+                lines.append(f"{self.name}_bucket{self.label_text(key, INF_BUCKET)} {counts[-2]}")
+                lines.append(f"{self.name}_count{self.label_text(key)} {counts[-2]}")
+                lines.append(f"{self.name}_sum{self.label_text(key)} {counts[-1]}")
+        return lines
+
+
+def escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+registry: list[Metric] = []
+
+
+def render() -> str:
+    return "\n".join(line for metric in registry for line in metric.render()) + "\n"
+
+
+### Metrics of the app
+REQUEST_LATENCY = Histogram("lotografia_http_request_duration_seconds", "HTTP request latency by route template.",
+                            ("method", "route", "status"))
+REQUESTS_IN_PROGRESS = Gauge("lotografia_http_requests_in_progress", "HTTP requests being handled.")
+DB_QUERY_LATENCY = Histogram("lotografia_db_query_duration_seconds", "SQLite statement execution time.",
+                             ("engine", "statement"), QUERY_BUCKETS)
+UPLOAD_BYTES = Counter("lotografia_upload_bytes_total", "Bytes written to disk by uploads.", ("kind",))
+UPLOADS_IN_PROGRESS = Gauge("lotografia_uploads_in_progress", "Uploads currently streaming to disk.", ("kind",))
+ARCHIVE_MEMBERS = Counter("lotografia_archive_members_total", "Members of uploaded archives, extracted or skipped.",
+                          ("outcome",))
+PAGE_RENDER = Histogram("lotografia_page_render_seconds", "Time spent building a NiceGUI page.", ("page",))
+
+
+### Request spans
+span_logger = logging.getLogger("lotografia.spans")
+if METRICS_SPAN_LOG:
+    span_logger.addHandler(logging.FileHandler(METRICS_SPAN_LOG))
+    span_logger.setLevel(logging.INFO)
+    span_logger.propagate = False
+
+# DB time of the request being handled; a mutable list so threadpool and greenlet copies of the context add to it
+current_span: contextvars.ContextVar[list | None] = contextvars.ContextVar("current_span", default=None)
+
+
+def route_label(scope: dict) -> str:
+    # the route template keeps the label set small (/project/{project_id}, not one label per id)
+    route = scope.get("route")
+    path = getattr(route, "path_format", None) or getattr(route, "path", None)
+    if path is None:
+        return "unmatched"
+    return scope.get("root_path", "").rstrip("/") + path
+
+
+class MetricsMiddleware:
+    # plain ASGI middleware: doesn't buffer streaming responses (downloads, uploads)
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        status = 500
+        span = [0, 0.0]  # queries, seconds
+        token = current_span.set(span)
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        REQUESTS_IN_PROGRESS.inc()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            duration = time.perf_counter() - start
+            REQUESTS_IN_PROGRESS.dec()
+            current_span.reset(token)
+            route = route_label(scope)
+            REQUEST_LATENCY.observe(duration, method=scope["method"], route=route, status=status)
+            if METRICS_SPAN_LOG:
+                span_logger.info(json.dumps({
+                    "time": time.time(), "method": scope["method"], "path": scope["path"], "route": route,
+                    "status": status, "duration_ms": round(duration * 1000, 3),
+                    "db_queries": span[0], "db_ms": round(span[1] * 1000, 3),
+                }))
+
+
+### Database
+def instrument_engine(engine, name: str) -> None:
+    # times every statement from cursor execute to result, labelled by its leading keyword
+    def before(connection, cursor, statement, parameters, context, executemany):
+        connection.info.setdefault("query_start", []).append(time.perf_counter())
+
+    def after(connection, cursor, statement, parameters, context, executemany):
+        duration = time.perf_counter() - connection.info["query_start"].pop()
+        keyword = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "OTHER"
+        DB_QUERY_LATENCY.observe(duration, engine=name, statement=keyword)
+        span = current_span.get()
+        if span is not None:
+            span[0] += 1
+            span[1] += duration
+
+    event.listen(engine, "before_cursor_execute", before)
+    event.listen(engine, "after_cursor_execute", after)
+
+
+### Pages
+def timed_page(func):
+    # records how long a @ui.page function takes to build its page
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            result = func(*args, **kwargs)
+            if inspect.isawaitable(result):
+                result = await result
+            return result
+        finally:
+            PAGE_RENDER.observe(time.perf_counter() - start, page=func.__name__)
+    return wrapper
+
+
+### Endpoint
+@router.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics(authorization: str | None = Header(default=None)):
+    if METRICS_TOKEN and authorization != f"Bearer {METRICS_TOKEN}":
+        raise HTTPException(status_code=401, detail="Invalid metrics token")
+    return PlainTextResponse(render(), media_type="text/plain; version=0.0.4")
+
+
+def test_histogram_render():
+    histogram = Histogram("test_seconds", "Test.", ("route",), buckets=(0.1, 1))
+    histogram.observe(0.05, route="/a")
+    histogram.observe(5, route="/a")
+    registry.remove(histogram)
+    lines = histogram.samples()
+    assert 'test_seconds_bucket{route="/a",le="0.1"} 1' in lines
+    assert 'test_seconds_bucket{route="/a",le="1"} 1' in lines
+    assert 'test_seconds_bucket{route="/a",le="+Inf"} 2' in lines
+    assert 'test_seconds_sum{route="/a"} 5.05' in lines
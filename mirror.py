@@ -0,0 +1,101 @@
+### === BLOB MIRROR === ###
+# With a storage backend (storage.py), the content of every uploaded file is copied to it by the
+# background workers as blobs/<sha256> - the original bytes, also for LAS blobs that are stored as LAZ
+# locally (compression.py), and only after their hash was checked again. Blob.mirrored_at marks the
+# finished copies. Downloads of mirrored files are redirected to a presigned URL when the backend
+# has them, so the bytes never pass through the app. The local blob store stays the working copy:
+# tiling, indexes and previews read it.
+import hashlib
+import os
+from concurrent.futures import Future
+
+from sqlmodel import Session
+
+import blobs
+from db_connector import async_session_maker, engine
+from file_index import get_file
+from las_io import iter_restored_las
+from models import Blob, ProjectFile, utcnow
+from storage import CHUNK_SIZE, get_storage
+from workers import submit
+
+_mirroring: set[str] = set()  # sha256 of copies in progress
+
+
+def iter_content(sha256: str):
+    # the original bytes of a blob, checked against its hash at the end
+    path = blobs.blob_path(sha256)
+    digest = hashlib.sha256()
+    if blobs.stored_encoding(path, sha256) == "laz":
+        chunks = iter_restored_las(path, blobs.envelope_path(sha256))
+    else:
+        def read_chunks():
+            with open(path, "rb") as f:
+                while chunk := f.read(CHUNK_SIZE):
+                    yield chunk
+        chunks = read_chunks()
+    for chunk in chunks:
+        digest.update(chunk)
+        yield chunk
+    if digest.hexdigest() != sha256:
+        raise ValueError(f"Blob {sha256[:12]} changed while it was copied")
+
+
+def mirror_blob(sha256: str, size: int) -> str:
+    # runs in a worker process; a second try covers a blob recompressed (compression.swap_in) under the first
+    storage = get_storage()
+    key = blobs.blob_key(sha256)
+    if storage.size(key) == size:
+        return "already stored"
+    for attempt in (1, 2):
+        try:
+            storage.write(key, iter_content(sha256))
+            return f"{size / 1024**2:.1f} MiB stored"
+        except ValueError:
+            if attempt == 2:
+                raise
+
+
+### Scheduling
+def schedule_mirror(project_id: int, name: str) -> Future | None:
+    if get_storage() is None:
+        return None
+    record = get_file(project_id, name)
+    if record is None or not record.sha256 or record.sha256 in _mirroring:
+        return None
+    with Session(engine) as session:
+        blob = session.get(Blob, record.sha256)
+        if blob is None or blob.mirrored_at is not None:
+            return None
+        size = blob.size
+    sha256 = record.sha256
+    _mirroring.add(sha256)
+    return submit(f"mirror {project_id}/{name}", mirror_blob, sha256, size,
+                  on_done=lambda done: mark_mirrored(sha256, done))
+
+
+def mark_mirrored(sha256: str, done: Future) -> None:
+    _mirroring.discard(sha256)
+    if done.exception() is not None:
+        return
+    with Session(engine) as session:
+        blob = session.get(Blob, sha256)
+        if blob is None:  # deleted while it was copied
+            get_storage().delete(blobs.blob_key(sha256))
+            return
+        blob.mirrored_at = utcnow()
+        session.add(blob)
+        session.commit()
+
+
+### Downloads
+async def mirrored_url(record: ProjectFile) -> str | None:
+    # presigned URL of the stored copy, None when downloads have to go through the app
+    storage = get_storage()
+    if storage is None or not storage.presigns or not record.sha256:
+        return None
+    async with async_session_maker() as session:
+        blob = await session.get(Blob, record.sha256)
+    if blob is None or blob.mirrored_at is None:
+        return None
+    return storage.url(blobs.blob_key(record.sha256), record.name)
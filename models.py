@@ -1,6 +1,15 @@
+import os
+from datetime import datetime, timezone
+
 from pydantic import BaseModel # data validation library
+from sqlalchemy import UniqueConstraint
 from sqlmodel import Field, Session, Relationship, SQLModel, create_engine, select
 
+from config import USER_PROJECTS_PATH
+
+def utcnow() -> datetime:
+    return datetime.now(timezone.utc)
+
 ### === SECURITY AND AUTH DATA MODELS === ###
 class Token(BaseModel):
     access_token: str
@@ -26,6 +35,7 @@ class User(UserBase, SQLModel, table=True): # define a user model using Pydantic
     full_name: str | None = Field(default=None)
     disabled: bool | None = Field(default=False)
     hashed_password: str | None = Field(default=None, index=True)
+    storage_quota: int | None = Field(default=None) # bytes; None -> USER_QUOTA_BYTES
 
     projects: list["Project"] = Relationship(back_populates="user")
 
@@ -34,6 +44,13 @@ class User(UserBase, SQLModel, table=True): # define a user model using Pydantic
 
     
 
+class UserSession(SQLModel, table=True): # NiceGUI app.storage.user of one browser session (see session_store.py)
+    id: str = Field(primary_key=True)
+    data: str = Field(default="{}") # JSON
+    version: int = Field(default=0) # bumped by every write, so other workers know to reload
+    updated_at: datetime = Field(default_factory=utcnow, index=True)
+
+
 class UserPublic(UserBase):
     id: int
     username: str
@@ -56,10 +73,146 @@ class Project(SQLModel, table=True):
     id: int | None = Field(default=None, primary_key=True)
     name: str = Field(index=True)
     description: str | None = Field(default=None)
+    deleted_at: datetime | None = Field(default=None, index=True) # set -> hidden, storage reclaimed in the background
     
     user_id: int | None = Field(default=None, foreign_key="user.id")
     user: User | None = Relationship(back_populates="projects")
 
+
+class ProjectUsage(SQLModel, table=True): # counters kept with every ProjectFile change (see usage.py)
+    project_id: int = Field(foreign_key="project.id", primary_key=True)
+    files: int = Field(default=0)
+    size: int = Field(default=0) # bytes
+
+
+class UserUsage(SQLModel, table=True): # sum of the user's projects that are not deleted
+    user_id: int = Field(foreign_key="user.id", primary_key=True)
+    files: int = Field(default=0)
+    size: int = Field(default=0) # bytes
+
+
+class ProjectDeletion(SQLModel, table=True): # background reclamation of a deleted project's storage
+    id: int | None = Field(default=None, primary_key=True)
+    project_id: int = Field(foreign_key="project.id", index=True)
+    trash_path: str # where the project directory was moved to
+    removed_files: int = Field(default=0)
+    reclaimed_bytes: int = Field(default=0) # disk space actually freed (content shared with other projects is not)
+    created_at: datetime = Field(default_factory=utcnow)
+    finished_at: datetime | None = Field(default=None, index=True)
+    owner: str | None = Field(default=None) # uvicorn worker reclaiming it
+    heartbeat_at: datetime | None = Field(default=None) # renewed by the owner after every batch
+
+
+class ScheduledRun(SQLModel, table=True): # periodic background task that one worker runs for all of them
+    name: str = Field(primary_key=True)
+    owner: str | None = Field(default=None) # worker that took the last run
+    next_run_at: datetime
+
+
+### PROJECT FILE
+class ProjectFile(SQLModel, table=True): # index of the files stored in user_projects/<project_id>
+    __table_args__ = (UniqueConstraint("project_id", "name"),)
+    id: int | None = Field(default=None, primary_key=True)
+    project_id: int = Field(foreign_key="project.id", index=True)
+    name: str = Field(index=True)
+    size: int = Field(default=0)
+    mtime: float = Field(default=0)
+    content_type: str | None = Field(default=None)
+    sha256: str | None = Field(default=None, index=True)
+    encoding: str | None = Field(default=None) # "laz": stored compressed, size and sha256 are those of the LAS
+    stored_size: int | None = Field(default=None) # bytes on disk when the file is stored compressed
+    created_at: datetime = Field(default_factory=utcnow)
+
+    @property
+    def path(self) -> str:
+        return os.path.join(USER_PROJECTS_PATH, str(self.project_id), self.name)
+
+
+class Blob(SQLModel, table=True): # content-addressed copy of file data, shared by identical project files
+    sha256: str = Field(primary_key=True)
+    size: int = Field(default=0)
+    refcount: int = Field(default=0) # ProjectFile rows with this content
+    created_at: datetime = Field(default_factory=utcnow)
+    mirrored_at: datetime | None = Field(default=None) # when the content was copied to the storage backend (mirror.py)
+
+
+class PointCloudMetadata(SQLModel, table=True): # LAS/LAZ header summary, keyed by content like the blob it describes
+    sha256: str = Field(primary_key=True)
+    version: str
+    point_format: int
+    point_count: int
+    bounds: str # JSON [min_x, min_y, min_z, max_x, max_y, max_z]
+    scale: str # JSON [x, y, z]
+    offset: str # JSON [x, y, z]
+    crs: str | None = Field(default=None) # "EPSG:<code>" when the file names one
+    crs_wkt: str | None = Field(default=None)
+    class_counts: str | None = Field(default=None) # JSON {class: points}, estimated from a strided sample
+    sampled_points: int = Field(default=0) # 0 for compressed files (no sample)
+    created_at: datetime = Field(default_factory=utcnow)
+
+
+### UPLOAD
+class UploadSession(SQLModel, table=True): # state of a resumable (tus-style) upload
+    id: str = Field(primary_key=True)
+    project_id: int = Field(foreign_key="project.id", index=True)
+    user_id: int = Field(foreign_key="user.id", index=True)
+    filename: str
+    length: int # total size declared by the client
+    offset: int = Field(default=0) # number of bytes committed to disk
+    crc32: int = Field(default=0) # rolling checksum of the committed bytes
+    expected_crc32: int | None = Field(default=None)
+    created_at: datetime = Field(default_factory=utcnow)
+    active_at: datetime | None = Field(default_factory=utcnow, index=True) # last chunk; idle uploads expire
+    completed: bool = Field(default=False)
+    extract: bool | None = Field(default=None) # archive unpacked into the project while it arrives, never stored
+    # direct uploads (direct_uploads.py): parts go to this storage object, not through the app
+    storage_key: str | None = Field(default=None)
+    multipart_id: str | None = Field(default=None) # None once the parts were put together
+    part_size: int | None = Field(default=None)
+    error: str | None = Field(default=None) # why the object could not be imported
+    import_slot: str | None = Field(default=None) # UploadSlot of the worker importing the object
+
+
+class UploadSlot(SQLModel, table=True): # an upload body admitted by the upload governor, seen by every worker
+    id: str = Field(primary_key=True)
+    user: str = Field(index=True)
+    device: int = Field(index=True) # st_dev of the volume the body is written to
+    size: int = Field(default=0) # bytes reserved on that volume
+    owner: str = Field(index=True) # process streaming the body
+    heartbeat_at: datetime = Field(default_factory=utcnow)
+
+### JOB
+class Job(SQLModel, table=True): # long-running processing task, executed outside the web process
+    id: int | None = Field(default=None, primary_key=True)
+    user_id: int = Field(foreign_key="user.id", index=True)
+    project_id: int = Field(foreign_key="project.id", index=True)
+    backend: str = Field(default="local")
+    status: str = Field(default="queued", index=True) # queued, running, cancelling, cancelled, failed, done
+    priority: int = Field(default=0) # higher runs first
+    progress: float = Field(default=0) # 0..1
+    message: str | None = Field(default=None)
+    params: str = Field(default="{}") # JSON
+    result: str | None = Field(default=None) # JSON
+    created_at: datetime = Field(default_factory=utcnow)
+    started_at: datetime | None = Field(default=None)
+    finished_at: datetime | None = Field(default=None)
+    owner: str | None = Field(default=None) # scheduler (uvicorn worker) running the job
+    heartbeat_at: datetime | None = Field(default=None) # renewed by the owner while the job runs
+
+
+class JobPublic(BaseModel):
+    id: int
+    project_id: int
+    backend: str
+    status: str
+    priority: int
+    progress: float
+    message: str | None
+    created_at: datetime
+    started_at: datetime | None
+    finished_at: datetime | None
+
+
 # class ProjectPublic(Project):
 #     id: int 
 
@@ -0,0 +1,223 @@
+### === POTREE 2.0 OCTREE BUILDER === ###
+# Converts a LAS/LAZ file into the Potree 2.0 format (metadata.json + hierarchy.bin + octree.bin)
+# that PotreeMap / Potree loads level by level. Memory stays bounded: the source is read in
+# chunks, points are bucketed into leaf files on disk, and the levels of detail are built
+# bottom-up by sampling one point per grid cell from the children of every node.
+#   pass 1: count points per cell of a 2^GRID_DEPTH grid  -> octree layout
+#   pass 2: append every point to the bucket file of its leaf
+#   pass 3: post-order sampling, nodes are written to octree.bin once they are final
+import json
+import os
+import shutil
+import struct
+
+import numpy as np
+
+from las_io import POINT_DTYPE, read_header, iter_points, is_laz
+
+GRID_DEPTH = 7  # counting grid of 128^3 cells
+MAX_POINTS_PER_LEAF = 100_000
+SAMPLING_RESOLUTION = 128  # cells per axis used to pick the points of an inner node
+HIERARCHY_NODE = struct.Struct("<BBIqq")  # type, child mask, points, byte offset, byte size
+NODE_TYPE_NORMAL, NODE_TYPE_LEAF = 0, 1
+ASSETS = ("metadata.json", "hierarchy.bin", "octree.bin")
+
+
+def child_index(dx: int, dy: int, dz: int) -> int:
+    # Potree's child numbering: bit 2 = x, bit 1 = y, bit 0 = z
+    return (dx << 2) | (dy << 1) | dz
+
+
+class OctreeBuilder:
+    def __init__(self, src: str, out_dir: str, chunk_points: int = 1_000_000):
+        self.src = src
+        self.out_dir = out_dir
+        self.chunk_points = chunk_points
+        self.header = read_header(src)
+        self.scale = np.array(self.header.scale)
+        self.offset = np.array(self.header.offset)
+        self.cube_min = np.array(self.header.mins)
+        self.cube_size = max(float(np.max(np.array(self.header.maxs) - self.cube_min)), 1e-6)
+        self.has_color = is_laz(src, self.header) or self.header.point_format in (2, 3, 5, 7, 8, 10)
+        self.grid = 1 << GRID_DEPTH
+        self.work_dir = out_dir + ".tmp"
+        self.nodes: dict[str, tuple[int, int, int, int]] = {}  # name -> (level, cx, cy, cz)
+        self.written: dict[str, tuple[int, int, int]] = {}  # name -> (points, byte offset, byte size)
+        self.attribute_ranges = {}
+        self.rng = np.random.default_rng(0)
+
+    ### Grid helpers
+    def coordinates(self, points: np.ndarray) -> np.ndarray:
+        return np.stack([points[axis] * self.scale[i] + self.offset[i] for i, axis in enumerate("XYZ")], axis=1)
+
+    def cells(self, points: np.ndarray, origin: np.ndarray, size: float, resolution: int) -> np.ndarray:
+        cell = ((self.coordinates(points) - origin) * (resolution / size)).astype(np.int64)
+        np.clip(cell, 0, resolution - 1, out=cell)
+        return (cell[:, 0] * resolution + cell[:, 1]) * resolution + cell[:, 2]
+
+    def node_bounds(self, name: str) -> tuple[np.ndarray, float]:
+        level, cx, cy, cz = self.nodes[name]
+        size = self.cube_size / (1 << level)
+        return self.cube_min + np.array([cx, cy, cz]) * size, size
+
+    def bucket_path(self, name: str) -> str:
+        return os.path.join(self.work_dir, "buckets", name + ".bin")
+
+    def pending_path(self, name: str) -> str:
+        return os.path.join(self.work_dir, "pending", name + ".bin")
+
+    ### Pass 1
+    def count_cells(self) -> np.ndarray:
+        counts = np.zeros(self.grid ** 3, dtype=np.int64)
+        intensity_range = [np.inf, -np.inf]
+        class_range = [np.inf, -np.inf]
+        for points in iter_points(self.src, self.chunk_points):
+            if len(points) == 0:
+                continue
+            counts += np.bincount(self.cells(points, self.cube_min, self.cube_size, self.grid), minlength=counts.size)
+            intensity_range = [min(intensity_range[0], points["intensity"].min()), max(intensity_range[1], points["intensity"].max())]
+            class_range = [min(class_range[0], points["classification"].min()), max(class_range[1], points["classification"].max())]
+        self.attribute_ranges = {"intensity": intensity_range, "classification": class_range}
+        return counts.reshape(self.grid, self.grid, self.grid)
+
+    def layout(self, counts: np.ndarray) -> np.ndarray:
+        # splits nodes top-down until they fit MAX_POINTS_PER_LEAF; returns cell -> leaf lookup
+        pyramid = [counts]
+        while pyramid[0].shape[0] > 1:
+            g = pyramid[0].shape[0] // 2
+            pyramid.insert(0, pyramid[0].reshape(g, 2, g, 2, g, 2).sum(axis=(1, 3, 5)))
+        lookup = np.zeros(counts.shape, dtype=np.int32)
+        self.leaves: list[str] = []
+
+        def split(name: str, level: int, cx: int, cy: int, cz: int) -> None:
+            self.nodes[name] = (level, cx, cy, cz)
+            if level == GRID_DEPTH or pyramid[level][cx, cy, cz] <= MAX_POINTS_PER_LEAF:
+                shift = GRID_DEPTH - level
+                lookup[cx << shift:(cx + 1) << shift, cy << shift:(cy + 1) << shift, cz << shift:(cz + 1) << shift] = len(self.leaves)
+                self.leaves.append(name)
+                return
+            for dx in (0, 1):
+                for dy in (0, 1):
+                    for dz in (0, 1):
+                        x, y, z = 2 * cx + dx, 2 * cy + dy, 2 * cz + dz
+                        if pyramid[level + 1][x, y, z] > 0:
+                            split(name + str(child_index(dx, dy, dz)), level + 1, x, y, z)
+
+        split("r", 0, 0, 0, 0)
+        return lookup.ravel()
+
+    ### Pass 2
+    def distribute(self, lookup: np.ndarray) -> None:
+        os.makedirs(os.path.join(self.work_dir, "buckets"))
+        max_intensity = max(float(self.attribute_ranges["intensity"][1]), 1.0)
+        for points in iter_points(self.src, self.chunk_points):
+            if len(points) == 0:
+                continue
+            if not self.has_color:  # grey from intensity, otherwise the cloud renders black
+                grey = (points["intensity"] * (65535.0 / max_intensity)).astype(np.uint16)
+                points["red"] = points["green"] = points["blue"] = grey
+            leaf = lookup[self.cells(points, self.cube_min, self.cube_size, self.grid)]
+            order = np.argsort(leaf, kind="stable")
+            points, leaf = points[order], leaf[order]
+            starts = np.flatnonzero(np.diff(leaf, prepend=-1))
+            ends = np.append(starts[1:], len(leaf))
+            for start, end in zip(starts, ends):
+                with open(self.bucket_path(self.leaves[leaf[start]]), "ab") as f:
+                    points[start:end].tofile(f)
+
+    ### Pass 3
+    def children(self, name: str) -> list[str]:
+        return [name + str(i) for i in range(8) if name + str(i) in self.nodes]
+
+    def write_node(self, octree, name: str, points: np.ndarray) -> None:
+        offset = octree.tell()
+        points.tofile(octree)
+        self.written[name] = (len(points), offset, octree.tell() - offset)
+
+    def build_node(self, octree, name: str) -> str:
+        # returns the file with the points the parent may still take from this node
+        children = self.children(name)
+        if not children:
+            if not os.path.exists(self.bucket_path(name)):  # empty cloud
+                open(self.bucket_path(name), "wb").close()
+            return self.bucket_path(name)
+        child_points = [np.fromfile(self.build_node(octree, child), dtype=POINT_DTYPE) for child in children]
+        points = np.concatenate(child_points)
+        owner = np.repeat(np.arange(len(children)), [len(p) for p in child_points])
+        # random order, so the sample is spread over the node instead of following the scan lines
+        order = self.rng.permutation(len(points))
+        origin, size = self.node_bounds(name)
+        _, first = np.unique(self.cells(points[order], origin, size, SAMPLING_RESOLUTION), return_index=True)
+        selected = np.zeros(len(points), dtype=bool)
+        selected[order[first]] = True
+        for k, child in enumerate(children):
+            self.write_node(octree, child, points[(owner == k) & ~selected])
+        path = self.pending_path(name)
+        points[selected].tofile(path)
+        return path
+
+    def write_hierarchy(self, path: str) -> int:
+        order = ["r"]
+        for name in order:  # breadth first, children in index order - the order Potree parses
+            order.extend(self.children(name))
+        with open(path, "wb") as f:
+            for name in order:
+                mask = sum(1 << int(child[-1]) for child in self.children(name))
+                points, offset, size = self.written[name]
+                f.write(HIERARCHY_NODE.pack(NODE_TYPE_LEAF if mask == 0 else NODE_TYPE_NORMAL, mask, points, offset, size))
+        return len(order) * HIERARCHY_NODE.size
+
+    def write_metadata(self, path: str, hierarchy_size: int) -> None:
+        cube_max = self.cube_min + self.cube_size
+        def attribute(name, size, elements, element_size, kind, low, high):
+            return {"name": name, "description": "", "size": size, "numElements": elements,
+                    "elementSize": element_size, "type": kind, "min": low, "max": high}
+        metadata = {
+            "version": "2.0",
+            "name": os.path.basename(self.src),
+            "description": "",
+            "points": self.header.point_count,
+            "projection": "",
+            "hierarchy": {
+                "firstChunkSize": hierarchy_size,
+                "stepSize": 4,
+                "depth": max(level for level, *_ in self.nodes.values()),
+            },
+            "offset": self.offset.tolist(),
+            "scale": self.scale.tolist(),
+            "spacing": self.cube_size / SAMPLING_RESOLUTION,
+            "boundingBox": {"min": self.cube_min.tolist(), "max": cube_max.tolist()},
+            "encoding": "DEFAULT",
+            "attributes": [
+                attribute("position", 12, 3, 4, "int32", list(self.header.mins), list(self.header.maxs)),
+                attribute("intensity", 2, 1, 2, "uint16", [float(self.attribute_ranges["intensity"][0])], [float(self.attribute_ranges["intensity"][1])]),
+                attribute("classification", 1, 1, 1, "uint8", [float(self.attribute_ranges["classification"][0])], [float(self.attribute_ranges["classification"][1])]),
+                attribute("rgb", 6, 3, 2, "uint16", [0, 0, 0], [65535, 65535, 65535]),
+            ],
+        }
+        with open(path, "w") as f:
+            json.dump(metadata, f, indent=1)
+
+    def build(self) -> dict:
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+        os.makedirs(os.path.join(self.work_dir, "pending"))
+        try:
+            lookup = self.layout(self.count_cells())
+            self.distribute(lookup)
+            with open(os.path.join(self.work_dir, "octree.bin"), "wb") as octree:
+                root_points = np.fromfile(self.build_node(octree, "r"), dtype=POINT_DTYPE)
+                self.write_node(octree, "r", root_points)
+            hierarchy_size = self.write_hierarchy(os.path.join(self.work_dir, "hierarchy.bin"))
+            self.write_metadata(os.path.join(self.work_dir, "metadata.json"), hierarchy_size)
+            shutil.rmtree(os.path.join(self.work_dir, "buckets"))
+            shutil.rmtree(os.path.join(self.work_dir, "pending"))
+            shutil.rmtree(self.out_dir, ignore_errors=True)
+            os.replace(self.work_dir, self.out_dir)
+        except BaseException:
+            shutil.rmtree(self.work_dir, ignore_errors=True)
+            raise
+        return {"points": self.header.point_count, "nodes": len(self.nodes)}
+
+
+def build_potree_octree(src: str, out_dir: str) -> dict:
+    return OctreeBuilder(src, out_dir).build()
@@ -0,0 +1,69 @@
+### === POINT CLOUD PREVIEWS === ###
+# Top-down previews of point clouds (see cloud_preview.py), rendered by the background workers after
+# upload and kept in PREVIEW_CACHE_PATH/<sha256>/. They are a few kB per file and are only removed
+# with the content (blobs.discard). Listings link them only once they exist, so showing a project
+# never reads point data:
+#   GET /previews/{sha256}/{kind}.jpg   kind: thumb, dem, intensity, rgb
+import os
+import re
+from concurrent.futures import Future
+
+from fastapi import APIRouter, HTTPException, Request
+from starlette.concurrency import run_in_threadpool
+
+from cloud_preview import PREVIEW_KINDS, render_cloud_previews
+from config import PREVIEW_CACHE_PATH
+from downloads import ranged_file_response
+from file_index import find_by_hash, get_file
+from tiling import is_point_cloud
+from workers import submit
+
+SHA256_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+IMMUTABLE = "private, max-age=31536000, immutable"
+
+router = APIRouter()
+
+_rendering: dict[str, Future] = {}  # sha256 -> render in progress
+
+
+def preview_dir(sha256: str) -> str:
+    return os.path.join(PREVIEW_CACHE_PATH, sha256)
+
+
+def has_preview(sha256: str) -> bool:
+    return os.path.exists(os.path.join(preview_dir(sha256), "thumb.jpg"))
+
+
+def preview_url(sha256: str, kind: str = "thumb") -> str:
+    return f"/previews/{sha256}/{kind}.jpg"
+
+
+### Scheduling
+def schedule_cloud_preview(project_id: int, name: str) -> Future | None:
+    record = get_file(project_id, name)
+    if record is None or not record.sha256 or not is_point_cloud(name):
+        return None
+    if has_preview(record.sha256) or record.sha256 in _rendering:
+        return None  # same content already rendered
+    sha256 = record.sha256
+    _rendering[sha256] = submit(f"preview {project_id}/{name}", render_cloud_previews, record.path, preview_dir(sha256),
+                                on_done=lambda done: _rendering.pop(sha256, None))
+    return _rendering[sha256]
+
+
+def schedule_missing_preview(sha256: str) -> None:
+    # blocking - call it through run_in_threadpool
+    if not has_preview(sha256) and (record := find_by_hash(sha256)) is not None:
+        schedule_cloud_preview(record.project_id, record.name)  # e.g. uploaded before previews existed
+
+
+### === ROUTES === ###
+@router.get("/previews/{sha256}/{kind}.jpg")
+async def get_preview(sha256: str, kind: str, request: Request):
+    if not SHA256_PATTERN.match(sha256) or kind not in ("thumb", *PREVIEW_KINDS):
+        raise HTTPException(status_code=404, detail="Not found")
+    path = os.path.join(preview_dir(sha256), f"{kind}.jpg")
+    if not os.path.exists(path):
+        await run_in_threadpool(schedule_missing_preview, sha256)
+        raise HTTPException(status_code=404, detail="Not found")
+    return ranged_file_response(request, path, etag=f'"{sha256}/{kind}"', content_type="image/jpeg", cache_control=IMMUTABLE)
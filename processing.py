@@ -0,0 +1,119 @@
+### === PROCESSING BACKENDS === ###
+# Interface between the job scheduler (jobs.py) and whatever turns photos into a dense
+# point cloud. A backend runs inside a job worker process, reads the project files and
+# writes its outputs to the job directory, reporting progress through the JobContext.
+import json
+import os
+import time
+
+from sqlmodel import Session
+
+from db_connector import engine
+from file_index import derived_dir, list_files
+from models import Job, utcnow
+from pyramid import is_image
+
+PROGRESS_WRITE_INTERVAL = 1.0  # seconds between progress updates written to the database
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class JobContext:
+    def __init__(self, job: Job):
+        self.job_id = job.id
+        self.project_id = job.project_id
+        self.params = json.loads(job.params or "{}")
+        self.output_dir = derived_dir(job.project_id, f"job-{job.id}")
+        self._last_write = 0.0
+
+    def report(self, progress: float, message: str | None = None, force: bool = False) -> None:
+        # stores progress (throttled) and raises JobCancelled once the job was asked to stop
+        now = time.monotonic()
+        if not force and now - self._last_write < PROGRESS_WRITE_INTERVAL:
+            return
+        self._last_write = now
+        with Session(engine) as session:
+            job = session.get(Job, self.job_id)
+            if job.status == "cancelling":
+                raise JobCancelled()
+            job.progress = min(max(progress, 0.0), 1.0)
+            if message is not None:
+                job.message = message
+            session.add(job)
+            session.commit()
+
+
+class ProcessingBackend:
+    name = ""
+    description = ""
+
+    def run(self, context: JobContext) -> dict:
+        # returns a JSON-serialisable summary stored as Job.result
+        raise NotImplementedError
+
+
+class LocalBackend(ProcessingBackend):
+    # stand-in for a real photogrammetry engine: walks through the usual stages and checks the
+    # project photos, so the scheduling, progress and cancellation paths can be used end to end
+    name = "local"
+    description = "Local stand-in (no reconstruction)"
+    stages = ("feature extraction", "matching", "sparse reconstruction", "dense reconstruction")
+    step_seconds = 0.1  # pause per photo and stage; not a job parameter, a client could hold a worker with it
+
+    def run(self, context: JobContext) -> dict:
+        photos = [record for record in list_files(context.project_id) if is_image(record.name)]
+        os.makedirs(context.output_dir, exist_ok=True)
+        steps = max(1, len(photos)) * len(self.stages)
+        done = 0
+        for stage in self.stages:
+            for photo in photos or [None]:
+                context.report(done / steps, f"{stage}: {photo.name}" if photo else stage)
+                if photo is not None:
+                    os.stat(photo.path)
+                time.sleep(self.step_seconds)
+                done += 1
+        context.report(1.0, "writing report", force=True)
+        report = {"backend": self.name, "photos": [photo.name for photo in photos], "stages": list(self.stages)}
+        with open(os.path.join(context.output_dir, "report.json"), "w") as f:
+            json.dump(report, f, indent=1)
+        return {"photos": len(photos), "output": context.output_dir}
+
+
+BACKENDS: dict[str, ProcessingBackend] = {}
+
+
+def register_backend(backend: ProcessingBackend) -> None:
+    BACKENDS[backend.name] = backend
+
+
+register_backend(LocalBackend())
+
+
+def run_job(job_id: int, owner: str | None = None) -> str:
+    # entry point in the worker process; stores the outcome itself (unless the job was taken over
+    # by another scheduler meanwhile) and returns the final status
+    with Session(engine) as session:
+        job = session.get(Job, job_id)
+    context = JobContext(job)
+    status, message, result = "done", "Finished", None
+    try:
+        result = BACKENDS[job.backend].run(context)
+    except JobCancelled:
+        status, message = "cancelled", "Cancelled"
+    except Exception as e:
+        status, message = "failed", repr(e)
+    with Session(engine) as session:
+        job = session.get(Job, job_id)
+        if owner is not None and job.owner != owner:
+            return "taken over"
+        job.status = status
+        job.message = message
+        job.finished_at = utcnow()
+        if status == "done":
+            job.progress = 1.0
+            job.result = json.dumps(result)
+        session.add(job)
+        session.commit()
+    return status
@@ -0,0 +1,210 @@
+### === IMAGE PYRAMIDS === ###
+# Thumbnails and 256 px XYZ tile pyramids of project images (Leaflet numbering:
+# zoom 0 fits the whole image into one tile, max_zoom is full resolution).
+# Layout of a pyramid directory:  info.json, thumb.jpg, {z}/{x}/{y}.jpg, levels/{z}.npy
+# The source image is decoded once, into levels/{max_zoom}.npy; every other level is halved from
+# the level below it in blocks of rows. Tiles are cut from memory-mapped levels, so a tile that
+# was evicted from the cache is rendered again without decoding the source image. A full build
+# keeps only the levels up to KEEP_LEVEL_PIXELS; larger ones (~120 MB for a 40 MP photo) are
+# removed once their tiles are written and remade on demand.
+import json
+import math
+import os
+import shutil
+import uuid
+
+import numpy as np
+from PIL import Image
+
+from config import IMAGE_MAX_PIXELS
+
+TILE_SIZE = 256
+THUMBNAIL_SIZE = 256
+JPEG_QUALITY = 85
+BACKGROUND = (0, 0, 0)
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".tif", ".tiff")
+LEVEL_BLOCK_ROWS = 256  # rows of a level made at a time
+KEEP_LEVEL_PIXELS = 1024 * 1024  # larger levels are not kept after a full build
+
+# orthophotos are legitimately large, but a decoded image has to fit into a worker's memory
+Image.MAX_IMAGE_PIXELS = IMAGE_MAX_PIXELS
+
+
+def is_image(name: str) -> bool:
+    return name.lower().endswith(IMAGE_EXTENSIONS)
+
+
+def max_zoom(width: int, height: int) -> int:
+    return max(0, math.ceil(math.log2(max(width, height) / TILE_SIZE)))
+
+
+def image_size(src: str) -> tuple[int, int]:
+    with Image.open(src) as img:  # reads the header only
+        return img.size
+
+
+def open_image(src: str) -> Image.Image:
+    img = Image.open(src)
+    if img.width * img.height > IMAGE_MAX_PIXELS:
+        img.close()
+        raise ValueError(f"Image larger than {IMAGE_MAX_PIXELS} pixels")
+    return img
+
+
+def to_rgb(img: Image.Image) -> Image.Image:
+    if img.mode in ("I;16", "I;16B", "I", "F"):
+        # 16 bit / float rasters (e.g. GeoTIFF DEMs): stretch to 8 bit
+        data = np.asarray(img, dtype=np.float64)
+        low, high = np.nanpercentile(data, [1, 99]) if data.size else (0, 1)
+        data = np.clip((data - low) / max(high - low, 1e-12) * 255, 0, 255)
+        img = Image.fromarray(np.nan_to_num(data).astype(np.uint8))
+    return img if img.mode == "RGB" else img.convert("RGB")
+
+
+def save_tile(img: Image.Image, path: str) -> None:
+    if img.size != (TILE_SIZE, TILE_SIZE):  # edge tile, Leaflet expects full tiles
+        tile = Image.new("RGB", (TILE_SIZE, TILE_SIZE), BACKGROUND)
+        tile.paste(img, (0, 0))
+        img = tile
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    img.save(path, "JPEG", quality=JPEG_QUALITY)
+
+
+def save_thumbnail(img: Image.Image, path: str) -> None:
+    thumb = img.copy()
+    thumb.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    thumb.save(path, "JPEG", quality=JPEG_QUALITY)
+
+
+def write_info(out_dir: str, width: int, height: int) -> dict:
+    info = {"width": width, "height": height, "tile_size": TILE_SIZE, "max_zoom": max_zoom(width, height)}
+    with open(os.path.join(out_dir, "info.json"), "w") as f:
+        json.dump(info, f)
+    return info
+
+
+### Levels
+def level_path(out_dir: str, z: int) -> str:
+    return os.path.join(out_dir, "levels", f"{z}.npy")
+
+
+def write_level(path: str, height: int, width: int, fill) -> None:
+    # fill(level, top, bottom) writes rows [top, bottom) of the new level
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        level = np.lib.format.open_memmap(temporary, mode="w+", dtype=np.uint8, shape=(height, width, 3))
+        for top in range(0, height, LEVEL_BLOCK_ROWS):
+            fill(level, top, min(top + LEVEL_BLOCK_ROWS, height))
+        level.flush()
+        del level
+        os.replace(temporary, path)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+
+
+def decode_level(src: str, path: str) -> None:
+    # the only place the source image is decoded
+    with open_image(src) as img:
+        rgb = to_rgb(img)
+
+        def fill(level, top, bottom):
+            level[top:bottom] = np.asarray(rgb.crop((0, top, rgb.width, bottom)))
+
+        write_level(path, rgb.height, rgb.width, fill)
+
+
+def halve_level(below: np.ndarray, path: str) -> None:
+    # mean of 2x2 blocks, odd edges repeated like Image.reduce(2) sizes them
+    height, width = (below.shape[0] + 1) // 2, (below.shape[1] + 1) // 2
+
+    def fill(level, top, bottom):
+        block = below[2 * top:2 * bottom].astype(np.uint16)
+        block = np.pad(block, ((0, 2 * (bottom - top) - block.shape[0]), (0, 2 * width - block.shape[1]), (0, 0)), mode="edge")
+        block = block.reshape(bottom - top, 2, width, 2, 3).sum(axis=(1, 3))
+        level[top:bottom] = ((block + 2) // 4).astype(np.uint8)
+
+    write_level(path, height, width, fill)
+
+
+def load_level(src: str, out_dir: str, z: int, zoom: int) -> np.ndarray:
+    # read-only memmap of the image at zoom z; a missing level is made from the level below it
+    path = level_path(out_dir, z)
+    if os.path.exists(path):
+        os.utime(path)  # recently used, for the cache eviction
+    elif z == zoom:
+        decode_level(src, path)
+    else:
+        halve_level(load_level(src, out_dir, z + 1, zoom), path)
+    return np.load(path, mmap_mode="r")
+
+
+def level_tile(level: np.ndarray, x: int, y: int) -> Image.Image:
+    return Image.fromarray(np.ascontiguousarray(level[y * TILE_SIZE:(y + 1) * TILE_SIZE, x * TILE_SIZE:(x + 1) * TILE_SIZE]))
+
+
+def build_pyramid(src: str, out_dir: str) -> dict:
+    # full build after upload, from the full resolution level up; builds of the same content in other
+    # processes each have their own work dir
+    work_dir = f"{out_dir}.{uuid.uuid4().hex}.tmp"
+    os.makedirs(work_dir)
+    try:
+        with open_image(src) as img:  # refuses oversized images before anything is decoded
+            info = write_info(work_dir, *img.size)
+        zoom = info["max_zoom"]
+        above = None  # shape of the level the current one is made from
+        for z in range(zoom, -1, -1):
+            level = load_level(src, work_dir, z, zoom)
+            if above is not None and above[0] * above[1] > KEEP_LEVEL_PIXELS:
+                os.remove(level_path(work_dir, z + 1))  # its tiles are written and it is no longer needed
+            for x in range(math.ceil(level.shape[1] / TILE_SIZE)):
+                for y in range(math.ceil(level.shape[0] / TILE_SIZE)):
+                    save_tile(level_tile(level, x, y), os.path.join(work_dir, str(z), str(x), f"{y}.jpg"))
+            if z == min(1, zoom):  # at most 512 px on the longer side
+                save_thumbnail(Image.fromarray(np.asarray(level)), os.path.join(work_dir, "thumb.jpg"))
+            above = level.shape
+            del level
+        shutil.rmtree(out_dir, ignore_errors=True)
+        try:
+            os.replace(work_dir, out_dir)
+        except OSError:
+            if not os.path.exists(os.path.join(out_dir, "info.json")):
+                raise
+            shutil.rmtree(work_dir, ignore_errors=True)  # another build of the same content finished first
+    except BaseException:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        raise
+    return info
+
+
+### Single assets (cache misses after eviction)
+def render_tile(src: str, out_dir: str, z: int, x: int, y: int) -> str:
+    zoom = max_zoom(*image_size(src))
+    if not 0 <= z <= zoom:
+        raise ValueError("Tile out of range")
+    level = load_level(src, out_dir, z, zoom)
+    if not (0 <= x < math.ceil(level.shape[1] / TILE_SIZE) and 0 <= y < math.ceil(level.shape[0] / TILE_SIZE)):
+        raise ValueError("Tile out of range")
+    path = os.path.join(out_dir, str(z), str(x), f"{y}.jpg")
+    save_tile(level_tile(level, x, y), path)
+    return path
+
+
+def render_thumbnail(src: str, out_dir: str) -> str:
+    width, height = image_size(src)
+    level = level_path(out_dir, min(1, max_zoom(width, height)))
+    if os.path.exists(level):
+        rgb = Image.fromarray(np.load(level))
+    else:
+        with open_image(src) as img:
+            img.draft("RGB", (THUMBNAIL_SIZE, THUMBNAIL_SIZE))  # JPEG: decode at reduced size
+            rgb = to_rgb(img)
+            rgb.load()
+    path = os.path.join(out_dir, "thumb.jpg")
+    save_thumbnail(rgb, path)
+    if not os.path.exists(os.path.join(out_dir, "info.json")):
+        write_info(out_dir, width, height)
+    return path
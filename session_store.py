@@ -0,0 +1,168 @@
+### === USER SESSION STORAGE === ###
+# NiceGUI keeps app.storage.user in one JSON file per browser session (.nicegui/storage-user-*.json),
+# rewritten on every change and only seen by the process that wrote it. With SESSION_STORE = "sqlite"
+# it lives in the UserSession table instead:
+# - changes only mark the session dirty; the writer stores every dirty session in one transaction
+#   at most every SESSION_FLUSH_INTERVAL (and on shutdown),
+# - every write bumps UserSession.version, and each UI request first reloads its session if another
+#   worker wrote a newer version (one primary-key read),
+# so uvicorn can run several workers against the same sessions.
+import asyncio
+import json
+from datetime import timedelta
+
+from nicegui.persistence import PersistentDict
+from nicegui.storage import Storage, USER_PREFIX
+from sqlalchemy import delete
+from sqlalchemy.dialects.sqlite import insert
+from sqlmodel import Session, select
+
+from config import SESSION_FLUSH_INTERVAL, SESSION_MAX_AGE, SESSION_STORE
+from db_connector import async_session_maker, engine
+from models import UserSession, utcnow
+
+
+class SQLitePersistentDict(PersistentDict):
+    def __init__(self, session_id: str):
+        self.session_id = session_id
+        self.version = 0
+        self.loading = False
+        super().__init__(data={}, on_change=self.mark_dirty)
+
+    def load(self, row: UserSession | None) -> None:
+        # replaces the content with what is stored, without writing it back
+        data = json.loads(row.data) if row is not None else {}
+        self.loading = True
+        try:
+            for key in set(self) - data.keys():
+                del self[key]
+            self.update(data)
+        finally:
+            self.loading = False
+        self.version = row.version if row is not None else 0
+
+    async def initialize(self) -> None:
+        async with async_session_maker() as session:
+            self.load(await session.get(UserSession, self.session_id))
+
+    def initialize_sync(self) -> None:
+        with Session(engine) as session:
+            self.load(session.get(UserSession, self.session_id))
+
+    async def refresh(self) -> None:
+        # picks up writes of other workers; local changes that are not written yet win
+        if self.session_id in writer.dirty:
+            return
+        async with async_session_maker() as session:
+            version = (await session.exec(
+                select(UserSession.version).where(UserSession.id == self.session_id)
+            )).first()
+            if version is not None and version != self.version:
+                self.load(await session.get(UserSession, self.session_id))
+
+    def mark_dirty(self) -> None:
+        if not self.loading:
+            writer.dirty[self.session_id] = self
+            writer.wake()
+
+
+### Batched writes
+async def prune_sessions() -> int:
+    async with async_session_maker() as session:
+        result = await session.execute(
+            delete(UserSession).where(UserSession.updated_at < utcnow() - timedelta(seconds=SESSION_MAX_AGE))
+        )
+        await session.commit()
+    return result.rowcount
+
+
+class SessionWriter:
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.dirty: dict[str, SQLitePersistentDict] = {}  # session id -> storage
+        self.task: asyncio.Task | None = None
+        self.wake_event: asyncio.Event | None = None
+
+    def start(self) -> None:
+        self.wake_event = asyncio.Event()
+        if self.dirty:
+            self.wake_event.set()
+        self.task = asyncio.create_task(self.loop())
+
+    async def stop(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+        await self.flush()
+
+    def wake(self) -> None:
+        if self.wake_event is not None:
+            self.wake_event.set()
+
+    async def loop(self) -> None:
+        try:
+            if removed := await prune_sessions():
+                print(f"[sessions] removed {removed} expired sessions")
+        except Exception as e:
+            print(f"[sessions] removing expired sessions failed: {e!r}")
+        while True:
+            await self.wake_event.wait()
+            await asyncio.sleep(self.interval)  # collect what else changes meanwhile
+            self.wake_event.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"[sessions] writing sessions failed: {e!r}")
+
+    async def flush(self) -> None:
+        if not self.dirty:
+            return
+        sessions, self.dirty = self.dirty, {}
+        try:
+            async with async_session_maker() as session:
+                for storage in sessions.values():
+                    statement = insert(UserSession).values(
+                        id=storage.session_id, data=json.dumps(storage), version=1, updated_at=utcnow(),
+                    )
+                    statement = statement.on_conflict_do_update(index_elements=[UserSession.id], set_={
+                        "data": statement.excluded.data,
+                        "version": UserSession.version + 1,
+                        "updated_at": statement.excluded.updated_at,
+                    }).returning(UserSession.version)
+                    storage.version = (await session.execute(statement)).scalar_one()
+                await session.commit()
+        except BaseException:
+            self.dirty = {**sessions, **self.dirty}  # retried with the next flush
+            raise
+
+
+writer = SessionWriter(SESSION_FLUSH_INTERVAL)
+
+
+### NiceGUI integration
+class SessionRefreshMiddleware:
+    # runs inside NiceGUI's RequestTrackingMiddleware, which has created app.storage.user for the request
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        from nicegui import app as nicegui_app
+        if scope["type"] == "http" and "session" in scope and "/_nicegui/" not in scope["path"]:  # not for static assets
+            storage = nicegui_app.storage._users.get(scope["session"].get("id"))
+            if isinstance(storage, SQLitePersistentDict):
+                await storage.refresh()
+        await self.app(scope, receive, send)
+
+
+def install(nicegui_app) -> None:
+    # call before ui.run_with: NiceGUI adds its session middlewares outside of the ones already registered
+    if SESSION_STORE != "sqlite":
+        return
+    create_default = Storage._create_persistent_dict
+
+    def create_persistent_dict(id: str) -> PersistentDict:
+        if id.startswith(USER_PREFIX):
+            return SQLitePersistentDict(id.removeprefix(USER_PREFIX))
+        return create_default(id)
+
+    Storage._create_persistent_dict = staticmethod(create_persistent_dict)
+    nicegui_app.add_middleware(SessionRefreshMiddleware)
@@ -0,0 +1,127 @@
+### === SPATIAL QUERIES === ###
+# POST /projects/{project_id}/files/{name}/points
+#   {"bbox": [min_x, min_y, max_x, max_y] (or with min_z/max_z), "polygon": [[x, y], ...], "budget": n, "format": "binary" | "las"}
+# Returns the points of a point cloud inside the region, thinned evenly to at most budget points when
+# one is given, from the grid index of the file (spatial_index.py). The index is built by the workers
+# after ingest; until it exists the route answers 503 with Retry-After.
+# "binary" is the bare POINT_DTYPE records (X-Point-Dtype), raw integers to be scaled with
+# X-Point-Scale/X-Point-Offset; "las" is a LAS 1.2 file of the same points.
+import os
+from concurrent.futures import Future
+from typing import Annotated, Literal
+from urllib.parse import quote
+
+import numpy as np
+from fastapi import APIRouter, Depends, HTTPException
+from pydantic import BaseModel
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import StreamingResponse
+
+from auth import get_current_active_user
+from config import SPATIAL_INDEX_PATH
+from db_connector import DBConnector
+from file_index import get_file, get_file_async
+from las_io import POINT_DTYPE, las_header, to_las_records
+from models import User
+from spatial_index import SpatialIndex, build_spatial_index
+from tiling import is_point_cloud
+from workers import submit
+
+router = APIRouter()
+db = DBConnector()
+
+_building: dict[str, Future] = {}  # sha256 -> build in progress
+
+
+def index_dir(sha256: str) -> str:
+    return os.path.join(SPATIAL_INDEX_PATH, sha256)
+
+
+def has_index(sha256: str) -> bool:
+    return os.path.exists(os.path.join(index_dir(sha256), "index.json"))
+
+
+### Scheduling
+def schedule_spatial_index(project_id: int, name: str) -> Future | None:
+    record = get_file(project_id, name)
+    if record is None or not record.sha256 or has_index(record.sha256) or record.sha256 in _building:
+        return None
+    os.makedirs(SPATIAL_INDEX_PATH, exist_ok=True)
+    sha256 = record.sha256
+    _building[sha256] = submit(f"spatial index {project_id}/{name}", build_spatial_index, record.path, index_dir(sha256),
+                               on_done=lambda done: _building.pop(sha256, None))
+    return _building[sha256]
+
+
+### Streaming
+def point_dtype_header() -> str:
+    return ",".join(f"{name}:{POINT_DTYPE.fields[name][0].str}" for name in POINT_DTYPE.names)
+
+
+def iter_binary(index: SpatialIndex, query: dict):
+    for points in index.query(**query):
+        yield points.tobytes()
+
+
+def iter_las(index: SpatialIndex, query: dict):
+    # the selection is deterministic: one pass for the header (count, bounds), one for the records
+    count, low, high = 0, np.full(3, np.iinfo(np.int32).max), np.full(3, np.iinfo(np.int32).min)
+    for points in index.query(**query):
+        count += len(points)
+        for axis, field in enumerate(("X", "Y", "Z")):
+            low[axis] = min(low[axis], points[field].min())
+            high[axis] = max(high[axis], points[field].max())
+    if count == 0:
+        low = high = np.zeros(3)
+    yield las_header(count, index.scale, index.offset, low * index.scale + index.offset, high * index.scale + index.offset)
+    for points in index.query(**query):
+        yield to_las_records(points).tobytes()
+
+
+### === ROUTES === ###
+async def get_indexed_sha256(project_id: int, name: str, user: User) -> str:
+    # content hash of a point cloud of the user whose spatial index is ready
+    if await db.get_project_async(project_id, user.username) is None:
+        raise HTTPException(status_code=404, detail="Project not found")
+    record = await get_file_async(project_id, name)
+    if record is None or not is_point_cloud(name):
+        raise HTTPException(status_code=404, detail="Point cloud not found")
+    if not record.sha256 or not has_index(record.sha256):
+        await run_in_threadpool(schedule_spatial_index, project_id, name)
+        raise HTTPException(status_code=503, detail="Spatial index is being built", headers={"Retry-After": "10"})
+    return record.sha256
+
+
+class PointQuery(BaseModel):
+    bbox: list[float] | None = None
+    polygon: list[tuple[float, float]] | None = None
+    budget: int | None = None
+    format: Literal["binary", "las"] = "binary"
+
+
+@router.post("/projects/{project_id}/files/{name}/points")
+async def query_points(
+    project_id: int,
+    name: str,
+    query: PointQuery,
+    current_user: Annotated[User, Depends(get_current_active_user)],
+):
+    if query.bbox is None and query.polygon is None:
+        raise HTTPException(status_code=400, detail="bbox or polygon required")
+    if query.bbox is not None and len(query.bbox) not in (4, 6):
+        raise HTTPException(status_code=400, detail="bbox must have 4 or 6 values")
+    if query.polygon is not None and len(query.polygon) < 3:
+        raise HTTPException(status_code=400, detail="polygon must have at least 3 vertices")
+    if query.budget is not None and query.budget < 1:
+        raise HTTPException(status_code=400, detail="budget must be positive")
+    index = SpatialIndex(index_dir(await get_indexed_sha256(project_id, name, current_user)))
+    selection = {"bbox": query.bbox, "polygon": query.polygon, "budget": query.budget}
+    if query.format == "las":
+        download_name = os.path.splitext(name)[0] + ".subset.las"
+        return StreamingResponse(iter_las(index, selection), media_type="application/octet-stream",
+                                 headers={"Content-Disposition": f"attachment; filename*=UTF-8''{quote(download_name)}"})
+    return StreamingResponse(iter_binary(index, selection), media_type="application/octet-stream", headers={
+        "X-Point-Dtype": point_dtype_header(),
+        "X-Point-Scale": ",".join(map(str, index.info["scale"])),
+        "X-Point-Offset": ",".join(map(str, index.info["offset"])),
+    })
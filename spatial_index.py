@@ -0,0 +1,278 @@
+### === SPATIAL INDEX === ###
+# A copy of a point cloud sorted into a 2D grid over XY, so region queries read only the cells they
+# cover. Layout of an index directory (SPATIAL_INDEX_PATH/<sha256>/):
+#   index.json   grid size and cell size, bounds, scale/offset of the source, point count
+#   offsets.npy  CSR offsets: the points of cell c (row-major, x fastest) are points[offsets[c]:offsets[c + 1]]
+#   zrange.npy   lowest and highest raw Z of every cell
+#   points.bin   every point as a POINT_DTYPE record, grouped by cell and shuffled within the cell,
+#                so the first k points of a cell are a uniform sample: a point budget is a prefix read
+# Built in bounded memory by the background workers (pass 1: count per cell, pass 2: scatter into
+# points.bin, pass 3: shuffle each cell). Queries memory-map points.bin and filter with NumPy.
+import json
+import math
+import os
+import shutil
+import uuid
+
+import numpy as np
+
+from las_io import POINT_DTYPE, iter_points, read_header
+
+CELL_POINTS = 4096  # average points per grid cell
+MAX_GRID = 2048  # cells per axis
+QUERY_CHUNK_POINTS = 1_000_000  # points gathered and filtered at a time
+COVERAGE_SAMPLE_POINTS = 64  # first points of a partly covered cell read to size a point budget
+
+
+def grid_layout(header) -> dict:
+    mins, maxs = np.array(header.mins[:2]), np.array(header.maxs[:2])
+    extent = np.maximum(maxs - mins, 1e-6)
+    cells = max(1, header.point_count // CELL_POINTS)
+    cell_size = math.sqrt(extent[0] * extent[1] / cells)
+    grid = [int(min(max(math.ceil(extent[axis] / cell_size), 1), MAX_GRID)) for axis in (0, 1)]
+    return {
+        "grid": grid,
+        "cell_size": [float(extent[0] / grid[0]), float(extent[1] / grid[1])],
+        "mins": list(header.mins), "maxs": list(header.maxs),
+        "scale": list(header.scale), "offset": list(header.offset),
+        "point_count": header.point_count,
+    }
+
+
+def column_of(x: np.ndarray, info: dict, axis: int) -> np.ndarray:
+    # grid column (axis 0) or row (axis 1) of coordinates; points outside the header bounds go to the border cells
+    cell = np.floor((x - info["mins"][axis]) / info["cell_size"][axis]).astype(np.int64)
+    return np.clip(cell, 0, info["grid"][axis] - 1)
+
+
+def cell_ids(points: np.ndarray, info: dict) -> np.ndarray:
+    x = points["X"] * info["scale"][0] + info["offset"][0]
+    y = points["Y"] * info["scale"][1] + info["offset"][1]
+    return column_of(y, info, 1) * info["grid"][0] + column_of(x, info, 0)
+
+
+### Building
+def build_spatial_index(src: str, out_dir: str, chunk_points: int = 1_000_000) -> dict:
+    if os.path.exists(os.path.join(out_dir, "index.json")):
+        return {"points": None, "cached": True}
+    info = grid_layout(read_header(src))
+    cells = info["grid"][0] * info["grid"][1]
+    work_dir = f"{out_dir}.{uuid.uuid4().hex}.tmp"
+    os.makedirs(work_dir)
+    try:
+        counts = np.zeros(cells, dtype=np.int64)
+        for points in iter_points(src, chunk_points):
+            counts += np.bincount(cell_ids(points, info), minlength=cells)
+        offsets = np.zeros(cells + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        total = int(offsets[-1])
+        info["point_count"] = total
+        zrange = np.empty((cells, 2), dtype=np.int32)
+        zrange[:, 0], zrange[:, 1] = np.iinfo(np.int32).max, np.iinfo(np.int32).min
+        points_path = os.path.join(work_dir, "points.bin")
+        if total == 0:
+            open(points_path, "wb").close()
+        else:
+            out = np.memmap(points_path, dtype=POINT_DTYPE, mode="w+", shape=(total,))
+            scatter(src, out, offsets, zrange, info, chunk_points)
+            shuffle_cells(out, offsets, counts, chunk_points)
+            out.flush()
+            del out
+        np.save(os.path.join(work_dir, "offsets.npy"), offsets)
+        np.save(os.path.join(work_dir, "zrange.npy"), zrange)
+        with open(os.path.join(work_dir, "index.json"), "w") as f:
+            json.dump(info, f)
+        try:
+            os.rename(work_dir, out_dir)
+        except OSError:  # built concurrently for the same content
+            shutil.rmtree(work_dir, ignore_errors=True)
+    except BaseException:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        raise
+    return {"points": total, "grid": info["grid"]}
+
+
+def scatter(src: str, out: np.ndarray, offsets: np.ndarray, zrange: np.ndarray, info: dict, chunk_points: int) -> None:
+    # pass 2: every point to the next free slot of its cell
+    cursor = offsets[:-1].copy()
+    for points in iter_points(src, chunk_points):
+        ids = cell_ids(points, info)
+        order = np.argsort(ids, kind="stable")
+        ids, points = ids[order], points[order]
+        starts = np.flatnonzero(np.r_[True, ids[1:] != ids[:-1]])
+        sizes = np.diff(np.r_[starts, len(ids)])
+        group_cells = ids[starts]
+        if np.any(cursor[group_cells] + sizes > offsets[group_cells + 1]):
+            raise ValueError(f"{src} changed while it was being indexed")
+        out[cursor[ids] + np.arange(len(ids)) - np.repeat(starts, sizes)] = points
+        cursor[group_cells] += sizes
+        zrange[group_cells, 0] = np.minimum(zrange[group_cells, 0], np.minimum.reduceat(points["Z"], starts))
+        zrange[group_cells, 1] = np.maximum(zrange[group_cells, 1], np.maximum.reduceat(points["Z"], starts))
+    if np.any(cursor != offsets[1:]):
+        raise ValueError(f"{src} changed while it was being indexed")
+
+
+def shuffle_cells(out: np.ndarray, offsets: np.ndarray, counts: np.ndarray, chunk_points: int) -> None:
+    # pass 3: random order within every cell, a block of whole cells at a time
+    rng = np.random.default_rng(0)
+    cells = len(counts)
+    first = 0
+    while first < cells:
+        last = int(np.searchsorted(offsets, offsets[first] + chunk_points, side="right")) - 1
+        last = min(max(last, first + 1), cells)
+        start, stop = offsets[first], offsets[last]
+        if stop - start > 1:
+            owner = np.repeat(np.arange(first, last), counts[first:last])
+            order = np.lexsort((rng.random(stop - start), owner))
+            out[start:stop] = np.asarray(out[start:stop])[order]
+        first = last
+
+
+### Queries
+def points_in_polygon(x: np.ndarray, y: np.ndarray, polygon: np.ndarray) -> np.ndarray:
+    # even-odd rule, vectorized over the points
+    inside = np.zeros(len(x), dtype=bool)
+    previous = polygon[-1]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for vertex in polygon:
+            (xi, yi), (xj, yj) = vertex, previous
+            inside ^= ((yi > y) != (yj > y)) & (x < (xj - xi) * (y - yi) / (yj - yi) + xi)
+            previous = vertex
+    return inside
+
+
+def prefix_index(starts: np.ndarray, sizes: np.ndarray) -> np.ndarray:
+    # positions of the first sizes[i] points of every cell, one sorted array so pages are read in order
+    return np.repeat(starts - np.cumsum(sizes) + sizes, sizes) + np.arange(sizes.sum())
+
+
+class SpatialIndex:
+    def __init__(self, directory: str):
+        with open(os.path.join(directory, "index.json")) as f:
+            self.info = json.load(f)
+        self.offsets = np.load(os.path.join(directory, "offsets.npy"), mmap_mode="r")
+        self.zrange = np.load(os.path.join(directory, "zrange.npy"), mmap_mode="r")
+        if self.info["point_count"]:
+            self.points = np.memmap(os.path.join(directory, "points.bin"), dtype=POINT_DTYPE, mode="r")
+        else:
+            self.points = np.zeros(0, dtype=POINT_DTYPE)
+        self.scale = np.array(self.info["scale"])
+        self.offset = np.array(self.info["offset"])
+
+    def inside(self, points: np.ndarray, low: np.ndarray, high: np.ndarray, polygon: np.ndarray | None) -> np.ndarray:
+        x = points["X"] * self.scale[0] + self.offset[0]
+        y = points["Y"] * self.scale[1] + self.offset[1]
+        z = points["Z"] * self.scale[2] + self.offset[2]
+        mask = (x >= low[0]) & (x <= high[0]) & (y >= low[1]) & (y <= high[1]) & (z >= low[2]) & (z <= high[2])
+        if polygon is not None:
+            mask[mask] = points_in_polygon(x[mask], y[mask], polygon)
+        return mask
+
+    def query(self, bbox: list[float] | None = None, polygon: list | None = None, budget: int | None = None,
+              chunk_points: int = QUERY_CHUNK_POINTS, seed: int = 0):
+        # POINT_DTYPE chunks of the points inside bbox ([min_x, min_y, max_x, max_y] or with Z:
+        # [min_x, min_y, min_z, max_x, max_y, max_z]) and/or polygon ([[x, y], ...]), thinned evenly
+        # to at most budget points; the same arguments and seed select the same points
+        info = self.info
+        low, high = np.full(3, -np.inf), np.full(3, np.inf)
+        if bbox is not None:
+            dims = len(bbox) // 2
+            low[:dims], high[:dims] = bbox[:dims], bbox[dims:]
+        if polygon is not None:
+            polygon = np.asarray(polygon, dtype=np.float64)
+            low[:2], high[:2] = np.maximum(low[:2], polygon.min(axis=0)), np.minimum(high[:2], polygon.max(axis=0))
+        if np.any(low > high) or len(self.points) == 0:
+            return
+        region_low = np.maximum(low[:2], info["mins"][:2])
+        region_high = np.minimum(high[:2], info["maxs"][:2])
+        columns = np.arange(column_of(region_low[0], info, 0), column_of(region_high[0], info, 0) + 1)
+        rows = np.arange(column_of(region_low[1], info, 1), column_of(region_high[1], info, 1) + 1)
+        cells = (rows[:, None] * info["grid"][0] + columns[None, :]).ravel()
+
+        # cells whose Z range misses the query are skipped without reading them
+        raw_low = np.floor((low[2] - self.offset[2]) / self.scale[2]) if np.isfinite(low[2]) else -np.inf
+        raw_high = np.ceil((high[2] - self.offset[2]) / self.scale[2]) if np.isfinite(high[2]) else np.inf
+        zrange = self.zrange[cells]
+        cells = cells[(zrange[:, 1] >= raw_low) & (zrange[:, 0] <= raw_high)]
+        starts = np.asarray(self.offsets[cells])
+        counts = np.asarray(self.offsets[cells + 1]) - starts
+        take = counts
+        if budget is not None:
+            # expected points in the region: cell counts weighted by how much of each cell it covers
+            cell_low = np.stack([cells % info["grid"][0], cells // info["grid"][0]], axis=1) * info["cell_size"] + info["mins"][:2]
+            overlap = np.clip(np.minimum(cell_low + info["cell_size"], region_high) - np.maximum(cell_low, region_low), 0, None)
+            covered = np.clip(np.prod(overlap / info["cell_size"], axis=1), 0, 1)
+            partial = np.flatnonzero(covered < 1)
+            if len(partial):
+                # the points of a partly covered cell need not be spread evenly over it: measure its share
+                # inside the region on the first points of the cell, which are a uniform sample
+                sizes = np.minimum(counts[partial], COVERAGE_SAMPLE_POINTS)
+                hits = np.bincount(np.repeat(np.arange(len(partial)), sizes), minlength=len(partial),
+                                   weights=self.inside(self.points[prefix_index(starts[partial], sizes)], low, high, polygon))
+                covered[partial] = hits / np.maximum(sizes, 1)
+            expected = float(np.sum(counts * covered))
+            if expected > budget:
+                rng = np.random.default_rng(seed)
+                wanted = counts * (budget / expected)
+                take = np.minimum(counts, np.floor(wanted + rng.random(len(cells))).astype(np.int64))
+        remaining = budget if budget is not None else None
+        bounds = np.cumsum(take)
+        first = 0
+        while first < len(cells) and (remaining is None or remaining > 0):
+            last = max(int(np.searchsorted(bounds, bounds[first] - take[first] + chunk_points, side="right")), first + 1)
+            sizes = take[first:last]
+            if sizes.sum():
+                points = self.points[prefix_index(starts[first:last], sizes)]
+                points = points[self.inside(points, low, high, polygon)]
+                if remaining is not None:
+                    if len(points) > remaining:  # the estimate fell short: thin the block evenly, not its last cells
+                        points = points[np.linspace(0, len(points) - 1, remaining).astype(np.int64)]
+                    remaining -= len(points)
+                if len(points):
+                    yield points
+            first = last
+
+
+def test_query_budget_and_polygon(tmp_path="."):
+    from las_io import write_las
+    rng = np.random.default_rng(1)
+    points = np.zeros(50_000, dtype=POINT_DTYPE)
+    points["X"], points["Y"] = rng.integers(0, 100_000, len(points)), rng.integers(0, 100_000, len(points))
+    points["Z"] = rng.integers(0, 1000, len(points))
+    src, out = os.path.join(tmp_path, "test_spatial.las"), os.path.join(tmp_path, "test_spatial.index")
+    write_las(src, points)
+    try:
+        build_spatial_index(src, out, chunk_points=7_000)
+        index = SpatialIndex(out)
+        x, y = points["X"] * 0.001, points["Y"] * 0.001
+        inside = (x >= 10) & (x <= 40) & (y >= 20) & (y <= 30)
+        found = np.concatenate(list(index.query(bbox=[10, 20, 40, 30], chunk_points=500)))
+        assert len(found) == inside.sum()
+        assert len(np.concatenate(list(index.query(bbox=[10, 20, 40, 30], budget=300)))) <= 300
+        triangle = [[0, 0], [100, 0], [0, 100]]
+        found = np.concatenate(list(index.query(polygon=triangle)))
+        assert abs(len(found) - np.sum(x + y < 100)) <= 5  # points on the edge
+    finally:
+        os.remove(src)
+        shutil.rmtree(out, ignore_errors=True)
+
+
+def test_query_budget_keeps_whole_region(tmp_path="."):
+    # a dense strip along the edge of the region, in cells it only partly covers, must not use up the
+    # budget before the cells on the far side of the region are read
+    from las_io import write_las
+    rng = np.random.default_rng(2)
+    points = np.zeros(200_000, dtype=POINT_DTYPE)
+    points["X"], points["Y"] = rng.integers(0, 100_000, len(points)), rng.integers(0, 100_000, len(points))
+    points["X"][:100_000], points["Y"][:100_000] = rng.integers(10_000, 40_000, 100_000), rng.integers(20_000, 21_000, 100_000)
+    src, out = os.path.join(tmp_path, "test_spatial_budget.las"), os.path.join(tmp_path, "test_spatial_budget.index")
+    write_las(src, points)
+    try:
+        build_spatial_index(src, out)
+        found = np.concatenate(list(SpatialIndex(out).query(bbox=[10, 20, 40, 60], budget=2000)))
+        y = found["Y"] * 0.001
+        assert 1600 <= len(found) <= 2000
+        assert np.sum(y > 50) >= 20  # the top of the region is thinned like the rest (~50 points), not cut off
+    finally:
+        os.remove(src)
+        shutil.rmtree(out, ignore_errors=True)
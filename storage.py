@@ -0,0 +1,297 @@
+### === OBJECT STORAGE === ###
+# Streaming key/value storage for file contents, behind one interface:
+#   LocalStorage  a directory (STORAGE_PATH), e.g. a mounted network share
+#   S3Storage     an S3-compatible bucket (AWS, MinIO, Ceph, ...), needs boto3; presigned GET URLs
+#                 and multipart uploads let clients transfer large files without going through the app
+# LOTOGRAFIA_STORAGE_BACKEND selects one ("" keeps everything on the local blob store only, see mirror.py).
+import os
+import shutil
+import uuid
+from typing import Iterable, Iterator
+
+from config import (
+    MULTIPART_PART_SIZE, S3_BUCKET, S3_ENDPOINT_URL, S3_PREFIX, S3_REGION, STORAGE_BACKEND, STORAGE_PATH,
+    STORAGE_URL_EXPIRES,
+)
+
+CHUNK_SIZE = 1024 * 1024  # 1 MiB
+
+
+class StorageError(Exception):
+    pass
+
+
+class ObjectStorage:
+    name = ""
+    presigns = False  # url() and part_url() return URLs clients can use directly
+
+    def open(self, key: str, start: int = 0, end: int | None = None) -> Iterator[bytes]:
+        # chunks of bytes [start, end) of an object
+        raise NotImplementedError
+
+    def write(self, key: str, chunks: Iterable[bytes]) -> int:
+        # stores the object; returns its size. A failing iterable leaves nothing behind
+        raise NotImplementedError
+
+    def write_file(self, key: str, path: str) -> int:
+        def chunks():
+            with open(path, "rb") as f:
+                while chunk := f.read(CHUNK_SIZE):
+                    yield chunk
+        return self.write(key, chunks())
+
+    def list_objects(self, prefix: str = "") -> Iterator[tuple[str, int]]:
+        # (key, size) of every object under the prefix
+        raise NotImplementedError
+
+    def size(self, key: str) -> int | None:
+        # None when there is no such object
+        raise NotImplementedError
+
+    def delete(self, key: str) -> None:
+        raise NotImplementedError
+
+    def copy(self, source: str, target: str) -> None:
+        self.write(target, self.open(source))
+
+    ### Direct transfers (presigning backends only)
+    def url(self, key: str, download_name: str | None = None, expires: int = STORAGE_URL_EXPIRES) -> str | None:
+        return None
+
+    def create_multipart(self, key: str) -> str:
+        raise StorageError(f"{self.name} storage has no multipart uploads")
+
+    def part_url(self, key: str, upload_id: str, number: int, expires: int = STORAGE_URL_EXPIRES) -> str:
+        raise StorageError(f"{self.name} storage has no multipart uploads")
+
+    def complete_multipart(self, key: str, upload_id: str, parts: list[tuple[int, str]]) -> None:
+        raise StorageError(f"{self.name} storage has no multipart uploads")
+
+    def abort_multipart(self, key: str, upload_id: str) -> None:
+        raise StorageError(f"{self.name} storage has no multipart uploads")
+
+
+class LocalStorage(ObjectStorage):
+    name = "local"
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def path(self, key: str) -> str:
+        path = os.path.normpath(os.path.join(self.root, key))
+        if not path.startswith(os.path.normpath(self.root) + os.sep):
+            raise StorageError(f"Invalid key {key!r}")
+        return path
+
+    def open(self, key: str, start: int = 0, end: int | None = None) -> Iterator[bytes]:
+        try:
+            f = open(self.path(key), "rb")
+        except FileNotFoundError:
+            raise StorageError(f"No object {key!r}")
+        with f:
+            f.seek(start)
+            remaining = end - start if end is not None else None
+            while remaining is None or remaining > 0:
+                chunk = f.read(CHUNK_SIZE if remaining is None else min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                if remaining is not None:
+                    remaining -= len(chunk)
+                yield chunk
+
+    def write(self, key: str, chunks: Iterable[bytes]) -> int:
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = os.path.join(os.path.dirname(path), f".{uuid.uuid4().hex}.tmp")
+        size = 0
+        try:
+            with open(temporary, "wb") as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    size += len(chunk)
+            os.replace(temporary, path)
+        except BaseException:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            raise
+        return size
+
+    def write_file(self, key: str, path: str) -> int:
+        target = self.path(key)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        temporary = os.path.join(os.path.dirname(target), f".{uuid.uuid4().hex}.tmp")
+        shutil.copyfile(path, temporary)
+        os.replace(temporary, target)
+        return os.path.getsize(target)
+
+    def list_objects(self, prefix: str = "") -> Iterator[tuple[str, int]]:
+        for root, _, names in os.walk(self.root):
+            for name in names:
+                key = os.path.relpath(os.path.join(root, name), self.root).replace(os.sep, "/")
+                if key.startswith(prefix) and not name.startswith("."):
+                    yield key, os.path.getsize(os.path.join(root, name))
+
+    def size(self, key: str) -> int | None:
+        try:
+            return os.path.getsize(self.path(key))
+        except FileNotFoundError:
+            return None
+
+    def delete(self, key: str) -> None:
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+
+class S3Storage(ObjectStorage):
+    name = "s3"
+    presigns = True
+
+    def __init__(self, bucket: str, prefix: str = "", endpoint_url: str | None = None, region: str | None = None,
+                 part_size: int = MULTIPART_PART_SIZE):
+        try:
+            import boto3
+            from botocore.config import Config
+            from botocore.exceptions import ClientError
+        except ImportError:
+            raise StorageError("S3 storage needs boto3 (pip install boto3)")
+        # credentials come from the usual AWS_* environment variables / config files
+        self.client = boto3.client("s3", endpoint_url=endpoint_url or None, region_name=region or None, config=Config(
+            signature_version="s3v4",
+            s3={"addressing_style": "path"} if endpoint_url else {},  # MinIO-style servers have no bucket subdomains
+        ))
+        self.ClientError = ClientError
+        self.bucket = bucket
+        self.prefix = prefix
+        self.part_size = max(part_size, 5 * 1024**2)  # S3 minimum for all parts but the last
+
+    def _missing(self, error) -> bool:
+        return error.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound")
+
+    def open(self, key: str, start: int = 0, end: int | None = None) -> Iterator[bytes]:
+        params = {"Bucket": self.bucket, "Key": self.prefix + key}
+        if start or end is not None:
+            params["Range"] = f"bytes={start}-{'' if end is None else end - 1}"
+        try:
+            body = self.client.get_object(**params)["Body"]
+        except self.ClientError as e:
+            if self._missing(e):
+                raise StorageError(f"No object {key!r}")
+            raise
+        try:
+            yield from body.iter_chunks(CHUNK_SIZE)
+        finally:
+            body.close()
+
+    def write(self, key: str, chunks: Iterable[bytes]) -> int:
+        # one PUT for small objects, a multipart upload of part_size parts otherwise
+        key = self.prefix + key
+        buffer, size, parts, upload_id = bytearray(), 0, [], None
+        try:
+            for chunk in chunks:
+                buffer += chunk
+                size += len(chunk)
+                while len(buffer) >= self.part_size:
+                    if upload_id is None:
+                        upload_id = self.client.create_multipart_upload(Bucket=self.bucket, Key=key)["UploadId"]
+                    parts.append(self._upload_part(key, upload_id, len(parts) + 1, bytes(buffer[:self.part_size])))
+                    del buffer[:self.part_size]
+            if upload_id is None:
+                self.client.put_object(Bucket=self.bucket, Key=key, Body=bytes(buffer))
+                return size
+            if buffer:
+                parts.append(self._upload_part(key, upload_id, len(parts) + 1, bytes(buffer)))
+            self.client.complete_multipart_upload(Bucket=self.bucket, Key=key, UploadId=upload_id,
+                                                  MultipartUpload={"Parts": parts})
+        except BaseException:
+            if upload_id is not None:
+                self.client.abort_multipart_upload(Bucket=self.bucket, Key=key, UploadId=upload_id)
+            raise
+        return size
+
+    def _upload_part(self, key: str, upload_id: str, number: int, data: bytes) -> dict:
+        etag = self.client.upload_part(Bucket=self.bucket, Key=key, UploadId=upload_id, PartNumber=number, Body=data)["ETag"]
+        return {"PartNumber": number, "ETag": etag}
+
+    def write_file(self, key: str, path: str) -> int:
+        from boto3.s3.transfer import TransferConfig
+        self.client.upload_file(path, self.bucket, self.prefix + key, Config=TransferConfig(
+            multipart_threshold=self.part_size, multipart_chunksize=self.part_size))
+        return os.path.getsize(path)
+
+    def list_objects(self, prefix: str = "") -> Iterator[tuple[str, int]]:
+        for page in self.client.get_paginator("list_objects_v2").paginate(Bucket=self.bucket, Prefix=self.prefix + prefix):
+            for item in page.get("Contents", []):
+                yield item["Key"][len(self.prefix):], item["Size"]
+
+    def size(self, key: str) -> int | None:
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=self.prefix + key)["ContentLength"]
+        except self.ClientError as e:
+            if self._missing(e):
+                return None
+            raise
+
+    def delete(self, key: str) -> None:
+        self.client.delete_object(Bucket=self.bucket, Key=self.prefix + key)
+
+    def copy(self, source: str, target: str) -> None:
+        # server side; managed, so objects over 5 GiB are copied in parts
+        self.client.copy({"Bucket": self.bucket, "Key": self.prefix + source}, self.bucket, self.prefix + target)
+
+    def url(self, key: str, download_name: str | None = None, expires: int = STORAGE_URL_EXPIRES) -> str | None:
+        params = {"Bucket": self.bucket, "Key": self.prefix + key}
+        if download_name is not None:
+            from urllib.parse import quote
+            params["ResponseContentDisposition"] = f"attachment; filename*=UTF-8''{quote(download_name)}"
+        return self.client.generate_presigned_url("get_object", Params=params, ExpiresIn=expires)
+
+    def create_multipart(self, key: str) -> str:
+        return self.client.create_multipart_upload(Bucket=self.bucket, Key=self.prefix + key)["UploadId"]
+
+    def part_url(self, key: str, upload_id: str, number: int, expires: int = STORAGE_URL_EXPIRES) -> str:
+        return self.client.generate_presigned_url("upload_part", ExpiresIn=expires, Params={
+            "Bucket": self.bucket, "Key": self.prefix + key, "UploadId": upload_id, "PartNumber": number,
+        })
+
+    def complete_multipart(self, key: str, upload_id: str, parts: list[tuple[int, str]]) -> None:
+        try:
+            self.client.complete_multipart_upload(
+                Bucket=self.bucket, Key=self.prefix + key, UploadId=upload_id,
+                MultipartUpload={"Parts": [{"PartNumber": number, "ETag": etag} for number, etag in sorted(parts)]},
+            )
+        except self.ClientError as e:
+            raise StorageError(e.response.get("Error", {}).get("Message") or str(e))
+
+    def abort_multipart(self, key: str, upload_id: str) -> None:
+        self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.prefix + key, UploadId=upload_id)
+
+
+_storage: ObjectStorage | None = None
+
+
+def get_storage() -> ObjectStorage | None:
+    # the configured backend, None when there is none
+    global _storage
+    if _storage is None and STORAGE_BACKEND:
+        if STORAGE_BACKEND == "local":
+            _storage = LocalStorage(STORAGE_PATH)
+        elif STORAGE_BACKEND == "s3":
+            _storage = S3Storage(S3_BUCKET, S3_PREFIX, S3_ENDPOINT_URL, S3_REGION)
+        else:
+            raise StorageError(f"Unknown storage backend {STORAGE_BACKEND!r}")
+    return _storage
+
+
+def test_local_storage(tmp_path="."):
+    storage = LocalStorage(os.path.join(tmp_path, "test_storage"))
+    try:
+        assert storage.write("a/b.bin", [b"abc", b"def"]) == 6
+        assert b"".join(storage.open("a/b.bin", 1, 4)) == b"bcd"
+        storage.copy("a/b.bin", "c.bin")
+        assert sorted(storage.list_objects()) == [("a/b.bin", 6), ("c.bin", 6)] and storage.size("d.bin") is None
+        storage.delete("a/b.bin")
+        assert list(storage.list_objects("a/")) == [] and storage.url("c.bin") is None
+    finally:
+        shutil.rmtree(storage.root, ignore_errors=True)
@@ -0,0 +1,48 @@
+### === PAGED TABLES === ###
+# ui.table in Quasar's server-side mode: only the visible page is queried and sent to the
+# browser, sorting/filtering happen in the database, and refresh() re-reads the current page
+# in place (after uploads, deletes, ...) instead of rebuilding the whole NiceGUI page.
+from typing import Awaitable, Callable
+
+from nicegui import ui
+
+# fetch(offset, limit, sort_by, descending, name_filter) -> (rows of the page, total number of rows)
+Fetch = Callable[[int, int, str | None, bool, str], Awaitable[tuple[list[dict], int]]]
+
+
+class PagedTable:
+    def __init__(self, columns: list[dict], fetch: Fetch, sort_by: str = "name", rows_per_page: int = 25):
+        self.fetch = fetch
+        self.name_filter = ""
+        self.table = ui.table(columns=columns, rows=[], row_key="id", pagination={
+            "page": 1, "rowsPerPage": rows_per_page, "sortBy": sort_by, "descending": False, "rowsNumber": 0,
+        }).classes("w-full").props("binary-state-sort :rows-per-page-options=[10,25,50,100]")
+        self.table.on("request", self.handle_request, ["pagination"])
+        with self.table.add_slot("top-right"):
+            ui.input(placeholder="Filter by name", on_change=self.handle_filter).props("dense clearable debounce=300")
+
+    def on_action(self, event: str, handler: Callable[[dict], object]) -> None:
+        # action buttons in slots call $parent.$emit(event, props.row)
+        self.table.on(event, lambda e: handler(e.args))
+
+    async def handle_request(self, e) -> None:
+        pagination = dict(self.table.pagination)
+        pagination.update(e.args["pagination"])
+        await self.refresh(pagination)
+
+    async def handle_filter(self, e) -> None:
+        self.name_filter = e.value or ""
+        await self.refresh({**self.table.pagination, "page": 1})
+
+    async def refresh(self, pagination: dict | None = None) -> None:
+        pagination = dict(pagination or self.table.pagination)
+        per_page = pagination["rowsPerPage"] or 0
+        offset = (pagination["page"] - 1) * per_page
+        rows, total = await self.fetch(offset, per_page or None, pagination.get("sortBy"),
+                                       bool(pagination.get("descending")), self.name_filter)
+        if not rows and total and pagination["page"] > 1:  # the last row of the last page is gone
+            pagination["page"] = max(1, -(-total // per_page))
+            return await self.refresh(pagination)
+        pagination["rowsNumber"] = total
+        self.table.pagination = pagination
+        self.table.rows = rows
@@ -0,0 +1,55 @@
+### === POINT CLOUD TILING === ###
+# Uploaded .las/.laz files are converted to a Potree 2.0 octree (see potree.py) on a
+# process pool, stored in user_projects/<id>/.derived/<name>/potree, and served to the
+# viewer through signed links:  GET /clouds/{token}/{name}/metadata.json (+ hierarchy.bin, octree.bin)
+import os
+from concurrent.futures import Future
+from urllib.parse import quote
+
+from fastapi import APIRouter, HTTPException, Request
+
+from auth import create_file_token, decode_file_token
+from downloads import ranged_file_response
+from file_index import derived_dir, project_dir
+from potree import ASSETS, build_potree_octree
+from workers import submit
+
+POINT_CLOUD_EXTENSIONS = (".las", ".laz")
+ASSET_CONTENT_TYPES = {"metadata.json": "application/json"}
+
+router = APIRouter()
+
+
+def is_point_cloud(name: str) -> bool:
+    return name.lower().endswith(POINT_CLOUD_EXTENSIONS)
+
+
+def octree_dir(project_id: int, name: str) -> str:
+    return os.path.join(derived_dir(project_id, name), "potree")
+
+
+def has_octree(project_id: int, name: str) -> bool:
+    return os.path.exists(os.path.join(octree_dir(project_id, name), "metadata.json"))
+
+
+def octree_url(project_id: int, name: str) -> str:
+    return f"/clouds/{create_file_token(project_id, name)}/{quote(name)}/metadata.json"
+
+
+### Scheduling
+def schedule_tiling(project_id: int, name: str) -> Future:
+    src = os.path.join(project_dir(project_id), name)
+    return submit(f"tiling {project_id}/{name}", build_potree_octree, src, octree_dir(project_id, name))
+
+
+### === ROUTES === ###
+@router.api_route("/clouds/{token}/{name}/{asset}", methods=["GET", "HEAD"])
+async def get_octree_asset(token: str, name: str, asset: str, request: Request):
+    project_id, token_name = decode_file_token(token)
+    if token_name != name or asset not in ASSETS:
+        raise HTTPException(status_code=404, detail="Not found")
+    return ranged_file_response(
+        request, os.path.join(octree_dir(project_id, name), asset),
+        content_type=ASSET_CONTENT_TYPES.get(asset),
+        cache_control="private, max-age=3600",
+    )
@@ -0,0 +1,245 @@
+### === PROJECT DELETION === ###
+# Deleting a project happens in two phases so it never blocks on the size of the project:
+# 1. delete_project() hides it (Project.deleted_at), records a ProjectDeletion and renames the
+#    project directory into user_projects/.trash - constant time, whatever the project holds.
+# 2. The reclaimer drops the index rows and files of deleted projects in batches in the background,
+#    pausing between batches to stay under TRASH_RECLAIM_BYTES_PER_SECOND. Unfinished deletions are
+#    picked up again after a restart (the ProjectDeletion rows are the queue). Every uvicorn worker runs
+#    a reclaimer; a deletion is claimed by one of them (ProjectDeletion.owner) and taken over by another
+#    when its owner stops renewing heartbeat_at for TRASH_RECLAIM_LEASE.
+#   DELETE /projects/{project_id}
+import asyncio
+import os
+import socket
+import uuid
+from datetime import timedelta
+from typing import Annotated
+
+from fastapi import APIRouter, Depends, HTTPException
+from sqlalchemy import or_, update
+from sqlmodel import select
+from starlette.concurrency import run_in_threadpool
+
+from auth import get_current_active_user
+from config import (USER_PROJECTS_PATH, TRASH_DIRNAME, TRASH_RECLAIM_BATCH, TRASH_RECLAIM_BYTES_PER_SECOND,
+                    TRASH_RECLAIM_LEASE)
+from db_connector import async_session_maker, DBConnector
+import file_index
+from jobs import cancel_job, ACTIVE_STATUSES
+from metrics import Counter
+from models import Job, Project, ProjectDeletion, UploadSession, User, utcnow
+import usage
+
+router = APIRouter()
+db = DBConnector()
+
+RECLAIMED_BYTES = Counter("lotografia_trash_reclaimed_bytes_total", "Disk space freed by deleting projects.")
+RECLAIMED_FILES = Counter("lotografia_trash_removed_files_total", "Files removed by deleting projects.")
+
+
+def trash_dir() -> str:
+    return os.path.join(USER_PROJECTS_PATH, TRASH_DIRNAME)
+
+
+def move_to_trash(deletion: ProjectDeletion) -> None:
+    # blocking but constant time (a rename on the same filesystem); safe to repeat after a crash
+    source = file_index.project_dir(deletion.project_id)
+    if os.path.isdir(source) and not os.path.exists(deletion.trash_path):
+        os.makedirs(trash_dir(), exist_ok=True)
+        os.rename(source, deletion.trash_path)
+
+
+def unlink_counting(path: str) -> int:
+    # bytes freed by removing path - none while another link (blob store, other project) keeps the data
+    try:
+        stat = os.lstat(path)
+        os.unlink(path)
+    except FileNotFoundError:
+        return 0
+    return stat.st_size if stat.st_nlink == 1 else 0
+
+
+def reclaim_batch(deletion: ProjectDeletion) -> tuple[int, int, bool]:
+    # blocking; removes up to TRASH_RECLAIM_BATCH files, returns (files, bytes freed, finished)
+    names = file_index.remove_batch(deletion.project_id, TRASH_RECLAIM_BATCH)
+    if names:  # indexed files first, so their blobs are released before the data is unlinked
+        freed = sum(unlink_counting(os.path.join(deletion.trash_path, name)) for name in names)
+        return len(names), freed, False
+    # then whatever is left in the directory (derived artifacts, partial uploads)
+    removed, freed = 0, 0
+    for root, dirs, files in os.walk(deletion.trash_path, topdown=False):
+        for name in files:
+            freed += unlink_counting(os.path.join(root, name))
+            removed += 1
+            if removed >= TRASH_RECLAIM_BATCH:
+                return removed, freed, False
+        for name in dirs:
+            try:
+                os.rmdir(os.path.join(root, name))
+            except OSError:  # not empty yet (files beyond this batch), or a symlink
+                if os.path.islink(os.path.join(root, name)):
+                    os.unlink(os.path.join(root, name))
+    if os.path.isdir(deletion.trash_path):
+        os.rmdir(deletion.trash_path)
+    return removed, freed, True
+
+
+### Phase 1: logical delete
+async def delete_project(project_id: int, username: str) -> ProjectDeletion | None:
+    project = await db.get_project_async(project_id, username)
+    if project is None:
+        return None
+    async with async_session_maker() as session:
+        project = await session.get(Project, project_id)
+        project.deleted_at = utcnow()
+        session.add(project)
+        await usage.detach_project(session, project_id)
+        deletion = ProjectDeletion(project_id=project_id,
+                                   trash_path=os.path.join(trash_dir(), f"{project_id}-{uuid.uuid4().hex}"))
+        session.add(deletion)
+        for upload in (await session.exec(select(UploadSession).where(UploadSession.project_id == project_id))).all():
+            await session.delete(upload)
+        jobs = (await session.exec(
+            select(Job).where(Job.project_id == project_id, Job.status.in_(("queued", *ACTIVE_STATUSES)))
+        )).all()
+        await session.commit()
+    for job in jobs:
+        await cancel_job(job.id, job.user_id)
+    await run_in_threadpool(move_to_trash, deletion)
+    reclaimer.wake()
+    return deletion
+
+
+### Phase 2: background reclamation
+class Reclaimer:
+    def __init__(self, bytes_per_second: int):
+        self.bytes_per_second = bytes_per_second
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.task: asyncio.Task | None = None
+        self.wake_event: asyncio.Event | None = None
+
+    def start(self) -> None:
+        self.wake_event = asyncio.Event()
+        self.task = asyncio.create_task(self.loop())
+
+    async def stop(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+
+    def wake(self) -> None:
+        if self.wake_event is not None:
+            self.wake_event.set()
+
+    async def loop(self) -> None:
+        while True:
+            self.wake_event.clear()
+            try:
+                async with async_session_maker() as session:
+                    pending = (await session.exec(
+                        select(ProjectDeletion).where(ProjectDeletion.finished_at.is_(None)).order_by(ProjectDeletion.id)
+                    )).all()
+                for deletion in pending:
+                    if await self.claim(deletion.id):
+                        await self.reclaim(deletion)
+            except Exception as e:
+                print(f"[trash] reclaiming failed: {e!r}")
+                await asyncio.sleep(60)  # e.g. permissions - retry later instead of spinning
+                continue
+            try:  # look again after a lease, for deletions left behind by a worker that stopped
+                await asyncio.wait_for(self.wake_event.wait(), TRASH_RECLAIM_LEASE)
+            except asyncio.TimeoutError:
+                pass
+
+    async def claim(self, deletion_id: int) -> bool:
+        # one statement, so two workers cannot both reclaim the same project
+        now = utcnow()
+        async with async_session_maker() as session:
+            result = await session.execute(update(ProjectDeletion).where(
+                ProjectDeletion.id == deletion_id,
+                ProjectDeletion.finished_at.is_(None),
+                or_(ProjectDeletion.owner.is_(None), ProjectDeletion.owner == self.owner,
+                    ProjectDeletion.heartbeat_at < now - timedelta(seconds=TRASH_RECLAIM_LEASE)),
+            ).values(owner=self.owner, heartbeat_at=now).execution_options(synchronize_session=False))
+            await session.commit()
+        return result.rowcount == 1
+
+    async def reclaim(self, deletion: ProjectDeletion) -> None:
+        await run_in_threadpool(move_to_trash, deletion)  # in case the server stopped between the phases
+        finished = False
+        while not finished:
+            removed, freed, finished = await run_in_threadpool(reclaim_batch, deletion)
+            RECLAIMED_FILES.inc(removed)
+            RECLAIMED_BYTES.inc(freed)
+            async with async_session_maker() as session:
+                result = await session.execute(update(ProjectDeletion).where(
+                    ProjectDeletion.id == deletion.id, ProjectDeletion.owner == self.owner,
+                ).values(
+                    removed_files=ProjectDeletion.removed_files + removed,
+                    reclaimed_bytes=ProjectDeletion.reclaimed_bytes + freed,
+                    heartbeat_at=utcnow(),
+                    finished_at=utcnow() if finished else None,
+                ).execution_options(synchronize_session=False))
+                await session.commit()
+                if result.rowcount != 1:
+                    print(f"[trash] project {deletion.project_id}: taken over by another worker")
+                    return
+                deletion = await session.get(ProjectDeletion, deletion.id)
+            await asyncio.sleep(freed / self.bytes_per_second)
+        print(f"[trash] project {deletion.project_id}: removed {deletion.removed_files} files, "
+              f"reclaimed {deletion.reclaimed_bytes / 1024**2:.1f} MiB")
+
+
+reclaimer = Reclaimer(TRASH_RECLAIM_BYTES_PER_SECOND)
+
+
+### === ROUTES === ###
+@router.delete("/projects/{project_id}", status_code=202)
+async def delete_project_route(
+    project_id: int,
+    current_user: Annotated[User, Depends(get_current_active_user)],
+) -> ProjectDeletion:
+    deletion = await delete_project(project_id, current_user.username)
+    if deletion is None:
+        raise HTTPException(status_code=404, detail="Project not found")
+    return deletion
+
+
+def test_reclaim():
+    from sqlmodel import Session
+    from db_connector import create_db_and_tables, engine
+    from models import Blob, ProjectFile, ProjectUsage, UserUsage
+    assert "lotografia-test-" in USER_PROJECTS_PATH, "run it through pytest (conftest.py), it deletes projects"
+    create_db_and_tables()
+    with Session(engine) as session:
+        user = User(username=f"trash-test-{uuid.uuid4().hex}")
+        session.add(user)
+        session.commit()
+        kept, doomed = Project(name="kept", user_id=user.id), Project(name="doomed", user_id=user.id)
+        session.add_all((kept, doomed))
+        session.commit()
+        user_id, username, kept_id, doomed_id = user.id, user.username, kept.id, doomed.id
+    shared, unique = uuid.uuid4().bytes * 64, uuid.uuid4().bytes * 128
+    for project_id, name, content in ((kept_id, "a.bin", shared), (doomed_id, "b.bin", shared), (doomed_id, "c.bin", unique)):
+        os.makedirs(file_index.project_dir(project_id), exist_ok=True)
+        with open(os.path.join(file_index.project_dir(project_id), name), "wb") as f:
+            f.write(content)
+        file_index.index_file(project_id, name)
+    os.makedirs(file_index.derived_dir(doomed_id, "c.bin"))
+
+    async def scenario():
+        deletion = await delete_project(doomed_id, username)
+        worker, other = Reclaimer(TRASH_RECLAIM_BYTES_PER_SECOND), Reclaimer(TRASH_RECLAIM_BYTES_PER_SECOND)
+        assert await worker.claim(deletion.id) and not await other.claim(deletion.id)
+        await worker.reclaim(deletion)
+        return deletion
+
+    deletion = asyncio.run(scenario())
+    assert not os.path.exists(deletion.trash_path) and not os.path.exists(file_index.project_dir(doomed_id))
+    with Session(engine) as session:
+        assert session.get(ProjectDeletion, deletion.id).finished_at is not None
+        assert not session.exec(select(ProjectFile).where(ProjectFile.project_id == doomed_id)).all()
+        counters = session.get(ProjectUsage, doomed_id)
+        assert (counters.files, counters.size) == (0, 0)
+        counters = session.get(UserUsage, user_id)
+        assert (counters.files, counters.size) == (1, len(shared))  # only the kept project counts
+        assert session.get(Blob, file_index.get_file(kept_id, "a.bin").sha256).refcount == 1
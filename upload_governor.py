@@ -0,0 +1,373 @@
+### === UPLOAD GOVERNOR === ###
+# Admission control for upload bodies: resumable chunks (PATCH /uploads/{id}) and NiceGUI form posts.
+# - at most UPLOAD_MAX_CONCURRENT bodies stream at the same time, UPLOAD_USER_CONCURRENCY per user;
+#   others wait up to UPLOAD_QUEUE_TIMEOUT for a slot, handed out to the waiting users in turn so a
+#   batch of one user doesn't hold everyone else back, and are then turned away with 503
+# - a body is only accepted when its volume keeps UPLOAD_MIN_FREE_BYTES free after it and the bodies
+#   already admitted there; otherwise 507
+# - token buckets cap the body bytes read per second, overall and per user
+# Rejections carry Retry-After and happen before the body is read. Resumable clients lose nothing,
+# they send the chunk again from the committed offset.
+# Slots and disk reservations are UploadSlot rows, so the limits hold for all uvicorn workers together:
+# a slot is taken with one conditional INSERT that checks both limits and the free space. The turn
+# order of waiting users and the token buckets are kept by each worker, so the rate limits apply per
+# worker. Slots of a worker that stopped renewing them (SLOT_TIMEOUT) are removed.
+import asyncio
+import contextlib
+import os
+import re
+import shutil
+import socket
+import tempfile
+import time
+import uuid
+from collections import deque
+from datetime import timedelta
+
+from sqlalchemy import delete, func, insert, literal, update
+from sqlmodel import select
+
+from config import (
+    UPLOAD_MAX_BYTES_PER_SECOND, UPLOAD_MAX_CONCURRENT, UPLOAD_MIN_FREE_BYTES, UPLOAD_QUEUE_TIMEOUT,
+    UPLOAD_USER_BYTES_PER_SECOND, UPLOAD_USER_CONCURRENCY,
+)
+from db_connector import async_session_maker
+from metrics import Counter, FunctionGauge
+from models import UploadSlot, utcnow
+
+BUSY_RETRY_AFTER = 10  # seconds
+DISK_RETRY_AFTER = 60
+POLL_INTERVAL = 0.5  # seconds between tries of a waiting body, for slots freed by other workers
+SLOT_HEARTBEAT = 10  # seconds between renewals of the slots of this worker
+SLOT_TIMEOUT = 60  # slots not renewed for this long belong to a stopped worker
+# NiceGUI upload routes; the body is spooled to the temp directory and copied once more there by NiceGUI
+FORM_UPLOAD_PATH = re.compile(r"/_nicegui/client/[^/]+/upload/")
+FORM_SPOOL_COPIES = 2
+
+UPLOADS_REJECTED = Counter("lotografia_uploads_rejected_total", "Upload bodies turned away before they were read.",
+                           ("reason",))
+
+
+class UploadRejected(Exception):
+    def __init__(self, status_code: int, detail: str, retry_after: int):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.retry_after = retry_after
+
+    @property
+    def headers(self) -> dict[str, str]:
+        return {"Retry-After": str(self.retry_after)}
+
+
+def parse_content_length(value: str | bytes | None) -> int | None:
+    # None without the header; ValueError unless it is a plain non-negative number
+    if value is None:
+        return None
+    value = value.decode("latin-1") if isinstance(value, bytes) else value
+    if not value.strip().isdigit():
+        raise ValueError(f"Invalid Content-Length {value!r}")
+    return int(value)
+
+
+class TokenBucket:
+    # rate bytes per second with bursts of up to one second; 0 = unlimited
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+
+    def take(self, amount: int) -> float:
+        # takes amount tokens, going into debt if needed; returns the seconds until the debt is paid
+        if not self.rate:
+            return 0.0
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= amount
+        return max(0.0, -self.tokens / self.rate)
+
+
+def volume(path: str) -> tuple[int, int]:
+    # (st_dev, free bytes) of the volume path is on
+    while not os.path.exists(path):  # the directory of a first upload may not exist yet
+        path = os.path.dirname(os.path.abspath(path))
+    return os.stat(path).st_dev, shutil.disk_usage(path).free
+
+
+class Waiter:
+    def __init__(self, size: int, path: str):
+        self.size = size
+        self.path = path
+        self.future = asyncio.get_running_loop().create_future()  # result: the slot id
+
+
+class UploadGovernor:
+    def __init__(self, max_concurrent: int, per_user: int, queue_timeout: float, min_free: int,
+                 rate: float = 0, user_rate: float = 0):
+        self.max_concurrent = max_concurrent
+        self.per_user = per_user
+        self.queue_timeout = queue_timeout
+        self.min_free = min_free
+        self.user_rate = user_rate
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.active: dict[str, int] = {}  # user -> bodies streaming in this worker
+        self.slots: set[str] = set()  # ids of the slots of these bodies
+        self.waiting: dict[str, deque[Waiter]] = {}  # user -> waiters; dict order is the turn order
+        self.dispatching: asyncio.Lock | None = None
+        self.renewer: asyncio.Task | None = None
+        self.bucket = TokenBucket(rate)
+        self.user_buckets: dict[str, TokenBucket] = {}
+
+    @property
+    def in_use(self) -> int:
+        return sum(self.active.values())
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(len(waiters) for waiters in self.waiting.values())
+
+    ### Shared slots (UploadSlot rows)
+    async def claim(self, user: str, size: int, path: str) -> str:
+        # the id of a new slot, or the reason there is none: "busy", "user" or "disk"
+        device, free = volume(path)
+        slot_id = uuid.uuid4().hex
+        count = select(func.count(UploadSlot.id))
+        reserved = select(func.coalesce(func.sum(UploadSlot.size), 0)).where(UploadSlot.device == device)
+        conditions = [literal(free) - reserved.scalar_subquery() - size >= self.min_free]
+        if self.max_concurrent:
+            conditions.append(count.scalar_subquery() < self.max_concurrent)
+        if self.per_user:
+            conditions.append(count.where(UploadSlot.user == user).scalar_subquery() < self.per_user)
+        async with async_session_maker() as session:
+            result = await session.execute(insert(UploadSlot).from_select(
+                ["id", "user", "device", "size", "owner", "heartbeat_at"],
+                select(literal(slot_id), literal(user), literal(device), literal(size), literal(self.owner),
+                       literal(utcnow(), UploadSlot.__table__.c.heartbeat_at.type)).where(*conditions),
+            ))
+            if result.rowcount:
+                await session.commit()
+                return slot_id
+            total = (await session.exec(count)).one()
+            mine = (await session.exec(count.where(UploadSlot.user == user))).one()
+            taken = (await session.exec(reserved)).one()
+        if free - taken - size < self.min_free:
+            return "disk"
+        return "user" if self.per_user and mine >= self.per_user and total < self.max_concurrent else "busy"
+
+    async def free_slot(self, slot_id: str) -> None:
+        async with async_session_maker() as session:
+            await session.execute(delete(UploadSlot).where(UploadSlot.id == slot_id))
+            await session.commit()
+
+    async def renew(self) -> None:
+        # keeps the slots of this worker alive and removes the ones of stopped workers
+        while True:
+            try:
+                now = utcnow()
+                async with async_session_maker() as session:
+                    if self.slots:
+                        await session.execute(update(UploadSlot).where(UploadSlot.id.in_(list(self.slots)))
+                                              .values(heartbeat_at=now))
+                    await session.execute(delete(UploadSlot).where(
+                        UploadSlot.heartbeat_at < now - timedelta(seconds=SLOT_TIMEOUT)))
+                    await session.commit()
+            except Exception as e:
+                print(f"[uploads] renewing upload slots failed: {e!r}")
+            await asyncio.sleep(SLOT_HEARTBEAT)
+
+    ### Turns
+    async def dispatch(self) -> None:
+        # tries the waiting users in turn: the one with the fewest bodies streaming here first, ties in
+        # turn order; a served user goes to the back of the line
+        if self.dispatching is None:
+            self.dispatching = asyncio.Lock()
+        async with self.dispatching:
+            skipped = set()  # users at their own limit
+            while True:
+                candidates = [user for user in self.waiting if user not in skipped]
+                if not candidates:
+                    return
+                user = min(candidates, key=lambda user: self.active.get(user, 0))
+                waiter = self.waiting[user][0]
+                outcome = await self.claim(user, waiter.size, waiter.path)
+                if outcome == "busy":
+                    return
+                if outcome == "user":
+                    skipped.add(user)
+                    continue
+                waiters = self.waiting.pop(user)
+                waiters.popleft()
+                if waiters:
+                    self.waiting[user] = waiters
+                if outcome == "disk":  # another body took the space while this one waited
+                    UPLOADS_REJECTED.inc(reason="disk")
+                    waiter.future.set_exception(UploadRejected(
+                        507, "Not enough free disk space for this upload, try again later", DISK_RETRY_AFTER))
+                    continue
+                self.active[user] = self.active.get(user, 0) + 1
+                self.slots.add(outcome)
+                waiter.future.set_result(outcome)
+
+    def forget(self, user: str, waiter: Waiter) -> None:
+        waiters = self.waiting.get(user)
+        if waiters is not None and waiter in waiters:
+            waiters.remove(waiter)
+            if not waiters:
+                del self.waiting[user]
+
+    async def acquire(self, user: str, size: int, path: str) -> str:
+        if self.renewer is None:
+            self.renewer = asyncio.create_task(self.renew())
+        waiter = Waiter(size, path)
+        self.waiting.setdefault(user, deque()).append(waiter)
+        deadline = time.monotonic() + self.queue_timeout
+        try:
+            await self.dispatch()
+            while not waiter.future.done() and time.monotonic() < deadline:
+                await asyncio.wait((waiter.future,), timeout=min(POLL_INTERVAL, deadline - time.monotonic()))
+                if not waiter.future.done():
+                    await self.dispatch()  # a worker may have freed a slot
+        except BaseException:  # the client went away while it waited, or the database failed
+            self.forget(user, waiter)
+            if waiter.future.done() and not waiter.future.exception():
+                await asyncio.shield(self.release(user, waiter.future.result()))
+            raise
+        if not waiter.future.done():
+            self.forget(user, waiter)
+            UPLOADS_REJECTED.inc(reason="busy")
+            raise UploadRejected(503, "Too many uploads in progress, try again later", BUSY_RETRY_AFTER)
+        return waiter.future.result()
+
+    async def release(self, user: str, slot_id: str) -> None:
+        try:
+            await self.free_slot(slot_id)
+        finally:  # a slot that could not be freed is no longer renewed and expires
+            self.slots.discard(slot_id)
+            self.active[user] -= 1
+            if not self.active[user]:
+                del self.active[user]
+                self.user_buckets.pop(user, None)
+        await self.dispatch()
+
+    ### Disk space
+    async def check_space(self, path: str, size: int) -> None:
+        # raises unless the volume of path has room for size more bytes next to the admitted bodies
+        device, free = volume(path)
+        async with async_session_maker() as session:
+            reserved = (await session.exec(select(func.coalesce(func.sum(UploadSlot.size), 0))
+                                           .where(UploadSlot.device == device))).one()
+        if free - reserved - size < self.min_free:
+            UPLOADS_REJECTED.inc(reason="disk")
+            raise UploadRejected(507, "Not enough free disk space for this upload, try again later", DISK_RETRY_AFTER)
+
+    @contextlib.asynccontextmanager
+    async def admit(self, user: str, size: int, path: str):
+        # a slot for one body of (at most) size bytes that is written to the volume of path
+        await self.check_space(path, size)  # no point in queueing for a full disk
+        slot_id = await self.acquire(user, size, path)
+        try:
+            yield slot_id
+        finally:
+            await asyncio.shield(self.release(user, slot_id))
+
+    ### Rate limits (per worker)
+    async def throttle(self, user: str, amount: int) -> None:
+        # call for every piece of body read
+        bucket = self.user_buckets.get(user)
+        if bucket is None:
+            bucket = self.user_buckets[user] = TokenBucket(self.user_rate)
+        delay = max(self.bucket.take(amount), bucket.take(amount))
+        if delay:
+            await asyncio.sleep(delay)
+
+
+governor = UploadGovernor(UPLOAD_MAX_CONCURRENT, UPLOAD_USER_CONCURRENCY, UPLOAD_QUEUE_TIMEOUT, UPLOAD_MIN_FREE_BYTES,
+                          UPLOAD_MAX_BYTES_PER_SECOND, UPLOAD_USER_BYTES_PER_SECOND)
+FunctionGauge("lotografia_upload_slots_in_use", "Upload bodies admitted and streaming.", lambda: governor.in_use)
+FunctionGauge("lotografia_upload_queue_depth", "Upload bodies waiting for a slot.", lambda: governor.queue_depth)
+
+
+### NiceGUI integration
+class FormUploadMiddleware:
+    # runs inside NiceGUI's session middleware, so the user of a form upload is known before its body is read
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or not FORM_UPLOAD_PATH.search(scope["path"]):
+            await self.app(scope, receive, send)
+            return
+        from fastapi.responses import JSONResponse
+        from nicegui import app as nicegui_app
+        session_id = scope.get("session", {}).get("id")
+        user = (nicegui_app.storage._users.get(session_id) or {}).get("username") or f"session:{session_id}"
+        try:
+            size = parse_content_length(dict(scope["headers"]).get(b"content-length"))
+        except ValueError:
+            await JSONResponse({"detail": "Invalid Content-Length"}, status_code=400)(scope, receive, send)
+            return
+        if size is None:  # a chunked body could fill the disk unchecked
+            await JSONResponse({"detail": "Content-Length required"}, status_code=411)(scope, receive, send)
+            return
+
+        async def throttled_receive():
+            message = await receive()
+            if message["type"] == "http.request":
+                await governor.throttle(user, len(message.get("body", b"")))
+            return message
+
+        try:
+            async with governor.admit(user, size * FORM_SPOOL_COPIES, tempfile.gettempdir()):
+                await self.app(scope, throttled_receive, send)
+        except UploadRejected as e:
+            await JSONResponse({"detail": e.detail}, status_code=e.status_code, headers=e.headers)(scope, receive, send)
+
+
+def install(nicegui_app) -> None:
+    # call before ui.run_with, like session_store.install
+    nicegui_app.add_middleware(FormUploadMiddleware)
+
+
+def test_fair_slots(tmp_path="."):
+    from db_connector import create_db_and_tables
+    create_db_and_tables()
+
+    async def scenario():
+        governor = UploadGovernor(2, 2, 2, 0)
+        order = []
+
+        async def upload(user: str):
+            async with governor.admit(user, 0, tmp_path):
+                order.append(user)
+                await asyncio.sleep(0.2)
+
+        async def late(user: str):
+            await asyncio.sleep(0.1)
+            await upload(user)
+
+        # a queues four bodies before b arrives; b still gets the first slot that frees up
+        await asyncio.gather(*(upload(user) for user in "aaaa"), late("b"))
+        assert order.index("b") == 2 and governor.in_use == 0 and not governor.waiting
+
+        governor.queue_timeout = 0.01
+        async with governor.admit("a", 0, tmp_path), governor.admit("a", 0, tmp_path):
+            try:
+                await upload("c")
+                assert False, "no free slot"
+            except UploadRejected as e:
+                assert e.status_code == 503 and e.retry_after == BUSY_RETRY_AFTER
+        assert parse_content_length(b"12") == 12 and parse_content_length(None) is None
+        for value in ("-1", "1e3", "", b"12, 12"):
+            try:
+                parse_content_length(value)
+                assert False, value
+            except ValueError:
+                pass
+        try:
+            await governor.check_space(tmp_path, shutil.disk_usage(tmp_path).free + 1)
+            assert False, "not enough space"
+        except UploadRejected as e:
+            assert e.status_code == 507
+
+    asyncio.run(scenario())
@@ -0,0 +1,541 @@
+### === RESUMABLE UPLOADS === ###
+# tus-style protocol (https://tus.io/protocols/resumable-upload) on top of fastapi_app:
+#   POST   /projects/{project_id}/uploads  -> create an upload, returns its Location
+#   HEAD   /uploads/{upload_id}            -> ask for the committed offset
+#   PATCH  /uploads/{upload_id}            -> append a chunk at Upload-Offset
+#   DELETE /uploads/{upload_id}            -> abort the upload
+#   GET    /uploads                        -> the user's unfinished uploads
+# Chunks are streamed straight from the request body into the project directory
+# (no multipart spooling) and renamed to their final name once the last byte arrives.
+# With ?extract=true (or an "extract" Upload-Metadata key) a ZIP/TAR upload is unpacked into the
+# project while it arrives instead (archives.py).
+# Every chunk goes through the upload governor (upload_governor.py): when it is busy or the disk is
+# short, the PATCH is answered 503/507 with Retry-After before its body is read.
+# Uploads that get no chunk for UPLOAD_EXPIRES_AFTER are deleted with their partial file, which
+# releases the quota they reserve (Upload-Expires tells the client when).
+import base64
+import hashlib
+import os
+import uuid
+import zlib
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+from pathlib import Path
+from typing import Annotated
+
+from fastapi import APIRouter, Depends, Header, HTTPException, Request, Response, status
+from starlette.concurrency import run_in_threadpool
+from sqlalchemy import func
+from sqlmodel import select
+from starlette.requests import ClientDisconnect
+
+from auth import get_current_active_user
+from config import (
+    PARTIAL_UPLOADS_DIRNAME, SERVER_WORKERS, UPLOAD_EXPIRES_AFTER, UPLOAD_STICKY_ROUTING, UPLOAD_WRITE_BUFFER_SIZE,
+)
+from db_connector import async_session_maker, DBConnector
+from file_index import project_dir
+from ingest import ingest_file
+from archives import ArchiveError, ArchiveExtractor, archive_kind
+from metrics import UPLOAD_BYTES, UPLOADS_IN_PROGRESS
+from models import User, UploadSession, utcnow
+from storage import get_storage
+from upload_governor import UploadRejected, governor, parse_content_length
+import usage
+
+TUS_VERSION = "1.0.0"
+# algorithms accepted in the Upload-Checksum header of a single chunk
+CHUNK_CHECKSUM_ALGORITHMS = {"crc32", "md5", "sha1", "sha256"}
+
+router = APIRouter()
+db = DBConnector()
+
+# ids of uploads with a PATCH in progress - one chunk at a time per upload
+_active_uploads: set[str] = set()
+# upload id -> (offset, sha256 of the bytes before it): the file hash is built while streaming,
+# so completing an upload needs no second read; after a restart the prefix is hashed once
+_upload_digests: dict[str, tuple] = {}
+# upload id -> extractor of an archive upload (extract mode); in memory only, so an archive
+# upload interrupted by a restart, or a chunk that reaches another worker, has to start over
+_extractors: dict[str, ArchiveExtractor] = {}
+
+
+### Paths
+def partial_path(upload: UploadSession) -> str:
+    return os.path.join(project_dir(upload.project_id), PARTIAL_UPLOADS_DIRNAME, upload.id)
+
+
+def final_path(upload: UploadSession) -> str:
+    return os.path.join(project_dir(upload.project_id), upload.filename)
+
+
+def clean_filename(filename: str) -> str:
+    name = Path(filename.replace("\\", "/")).name
+    if not name or name.startswith("."):
+        raise HTTPException(status_code=400, detail="Invalid file name")
+    return name
+
+
+### Header helpers
+def parse_upload_metadata(header: str | None) -> dict[str, str]:
+    # "key base64value,key2 base64value2"
+    metadata = {}
+    if not header:
+        return metadata
+    for pair in header.split(","):
+        parts = pair.strip().split(" ", 1)
+        if not parts[0]:
+            continue
+        try:
+            value = base64.b64decode(parts[1], validate=True).decode() if len(parts) == 2 else ""
+        except ValueError:  # binascii.Error and UnicodeDecodeError
+            raise HTTPException(status_code=400, detail=f"Malformed Upload-Metadata value for {parts[0]!r}")
+        metadata[parts[0]] = value
+    return metadata
+
+
+class ChunkChecksum:
+    # verifies the optional Upload-Checksum header ("<algorithm> <base64 digest>") of one PATCH
+    def __init__(self, header: str):
+        try:
+            algorithm, digest = header.strip().split(" ", 1)
+            self.expected = base64.b64decode(digest)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Malformed Upload-Checksum header")
+        if algorithm not in CHUNK_CHECKSUM_ALGORITHMS:
+            raise HTTPException(status_code=400, detail="Unsupported checksum algorithm")
+        self.algorithm = algorithm
+        self.crc = 0
+        self.hasher = None if algorithm == "crc32" else hashlib.new(algorithm)
+
+    def update(self, data: bytes) -> None:
+        if self.hasher is None:
+            self.crc = zlib.crc32(data, self.crc)
+        else:
+            self.hasher.update(data)
+
+    def matches(self) -> bool:
+        if self.hasher is None:
+            return self.crc.to_bytes(4, "big") == self.expected
+        return self.hasher.digest() == self.expected
+
+
+def expires_at(upload: UploadSession) -> datetime:
+    active_at = upload.active_at or upload.created_at
+    if active_at.tzinfo is None:  # read back from SQLite
+        active_at = active_at.replace(tzinfo=timezone.utc)
+    return active_at + timedelta(seconds=UPLOAD_EXPIRES_AFTER)
+
+
+def upload_headers(upload: UploadSession) -> dict[str, str]:
+    headers = {
+        "Tus-Resumable": TUS_VERSION,
+        "Upload-Offset": str(upload.offset),
+        "Upload-Length": str(upload.length),
+        "Upload-Crc32": f"{upload.crc32:08x}",
+        "Cache-Control": "no-store",
+    }
+    if not upload.completed:
+        headers["Upload-Expires"] = format_datetime(expires_at(upload), usegmt=True)
+    return headers
+
+
+async def get_upload_for_user(upload_id: str, user: User) -> UploadSession:
+    async with async_session_maker() as session:
+        upload = await session.get(UploadSession, upload_id)
+    if upload is None or upload.user_id != user.id:
+        raise HTTPException(status_code=404, detail="Upload not found")
+    return upload
+
+
+### Disk helpers (run in the threadpool)
+def _write_at(path: str, offset: int, data: bytes) -> None:
+    with open(path, "r+b") as f:
+        f.seek(offset)
+        f.write(data)
+
+
+def _hash_prefix(path: str, length: int):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while length > 0:
+            data = f.read(min(UPLOAD_WRITE_BUFFER_SIZE, length))
+            if not data:
+                break
+            digest.update(data)
+            length -= len(data)
+    return digest
+
+
+async def upload_digest(upload: UploadSession):
+    # a copy of the running sha256 at the committed offset
+    offset, digest = _upload_digests.get(upload.id, (None, None))
+    if offset != upload.offset:
+        digest = await run_in_threadpool(_hash_prefix, partial_path(upload), upload.offset)
+        _upload_digests[upload.id] = (upload.offset, digest)
+    return digest.copy()
+
+
+def _finish(upload: UploadSession) -> None:
+    # same directory tree -> a rename, not a copy
+    os.replace(partial_path(upload), final_path(upload))
+
+
+class ChunkWriter:
+    # buffers the request body and writes it at the committed offset of the partial file,
+    # keeping the rolling crc32 and sha256 of the whole upload up to date
+    def __init__(self, upload: UploadSession, digest, checksum: ChunkChecksum | None = None):
+        self.path = partial_path(upload)
+        self.offset = upload.offset
+        self.crc32 = upload.crc32
+        self.digest = digest
+        self.length = upload.length
+        self.checksum = checksum
+        self.buffer = bytearray()
+
+    async def write(self, data: bytes) -> None:
+        if self.offset + len(self.buffer) + len(data) > self.length:
+            raise HTTPException(status_code=413, detail="Chunk exceeds Upload-Length")
+        self.buffer += data
+        if len(self.buffer) >= UPLOAD_WRITE_BUFFER_SIZE:
+            await self.flush()
+
+    async def flush(self) -> None:
+        if not self.buffer:
+            return
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        await run_in_threadpool(_write_at, self.path, self.offset, data)
+        UPLOAD_BYTES.inc(len(data), kind="resumable")
+        self.crc32 = zlib.crc32(data, self.crc32)
+        self.digest.update(data)
+        if self.checksum:
+            self.checksum.update(data)
+        self.offset += len(data)
+
+
+class ArchiveWriter:
+    # ChunkWriter for extract mode: the data goes to the archive extractor instead of a partial file
+    def __init__(self, upload: UploadSession, extractor: ArchiveExtractor, checksum: ChunkChecksum | None = None):
+        self.extractor = extractor
+        self.offset = upload.offset
+        self.crc32 = upload.crc32
+        self.digest = None
+        self.length = upload.length
+        self.checksum = checksum
+
+    async def write(self, data: bytes) -> None:
+        if self.offset + len(data) > self.length:
+            raise HTTPException(status_code=413, detail="Chunk exceeds Upload-Length")
+        UPLOAD_BYTES.inc(len(data), kind="archive")
+        self.crc32 = zlib.crc32(data, self.crc32)
+        if self.checksum:
+            self.checksum.update(data)
+        await self.extractor.feed(data)
+        self.offset += len(data)
+
+    async def flush(self) -> None:
+        pass
+
+
+async def receive_chunk(upload: UploadSession, request: Request, checksum_header: str | None, user: str) -> UploadSession:
+    checksum = ChunkChecksum(checksum_header) if checksum_header else None
+    if upload.extract:
+        if upload.id not in _extractors:
+            await discard_upload(upload)
+            raise HTTPException(status_code=410, detail="Archive extraction was interrupted, upload the archive again")
+        writer = ArchiveWriter(upload, _extractors[upload.id], checksum)
+    else:
+        writer = ChunkWriter(upload, await upload_digest(upload), checksum)
+    disconnected = False
+    UPLOADS_IN_PROGRESS.inc(kind="resumable")
+    try:
+        async for data in request.stream():
+            await governor.throttle(user, len(data))
+            await writer.write(data)
+        await writer.flush()
+    except ClientDisconnect:
+        disconnected = True
+        await writer.flush()
+    except ArchiveError as e:
+        await discard_upload(upload)
+        raise HTTPException(status_code=422, detail=str(e))
+    except BaseException:
+        if upload.extract:  # the extractor has the bytes already, a resumed chunk would feed them twice
+            await discard_upload(upload)
+        raise
+    finally:
+        UPLOADS_IN_PROGRESS.dec(kind="resumable")
+
+    if checksum and (disconnected or not checksum.matches()):
+        if upload.extract:  # already extracted, there is nothing to roll back to
+            await discard_upload(upload)
+            raise HTTPException(status_code=460, detail="Checksum mismatch, upload the archive again")
+        # the chunk cannot be trusted - roll back to the last committed offset
+        await run_in_threadpool(os.truncate, writer.path, upload.offset)
+        raise HTTPException(status_code=460, detail="Checksum mismatch", headers=upload_headers(upload))
+
+    # without a checksum whatever reached the disk before a disconnect is kept, so the client can resume from there
+    async with async_session_maker() as session:
+        stored = await session.get(UploadSession, upload.id)
+        if stored is None:  # the upload or its project was deleted while the chunk arrived
+            await discard_upload(upload)
+            raise HTTPException(status_code=410, detail="Upload was deleted")
+        upload = stored
+        upload.offset = writer.offset
+        upload.crc32 = writer.crc32
+        upload.active_at = utcnow()
+        session.add(upload)
+        await session.commit()
+    if writer.digest is not None:
+        _upload_digests[upload.id] = (writer.offset, writer.digest)
+
+    if upload.offset == upload.length:
+        await complete_upload(upload)
+    return upload
+
+
+### === ROUTES === ###
+@router.post("/projects/{project_id}/uploads", status_code=status.HTTP_201_CREATED)
+async def create_upload(
+    project_id: int,
+    current_user: Annotated[User, Depends(get_current_active_user)],
+    upload_length: Annotated[int, Header()],
+    upload_metadata: Annotated[str | None, Header()] = None,
+    upload_crc32: Annotated[str | None, Header()] = None,
+    filename: str | None = None,
+    extract: bool = False,
+):
+    if await db.get_project_async(project_id, current_user.username) is None:
+        raise HTTPException(status_code=404, detail="Project not found")
+    if upload_length < 0:
+        raise HTTPException(status_code=400, detail="Invalid Upload-Length")
+    try:
+        await governor.check_space(project_dir(project_id), upload_length)
+    except UploadRejected as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail, headers=e.headers)
+    metadata = parse_upload_metadata(upload_metadata)
+    name = clean_filename(filename or metadata.get("filename", ""))
+    try:
+        expected_crc32 = int(upload_crc32, 16) if upload_crc32 else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Malformed Upload-Crc32 header, expected 8 hex digits")
+    if expected_crc32 is not None and not 0 <= expected_crc32 <= 0xFFFFFFFF:
+        raise HTTPException(status_code=400, detail="Malformed Upload-Crc32 header, expected 8 hex digits")
+    extract = extract or "extract" in metadata  # unpack a ZIP/TAR into the project instead of storing it
+    if extract and archive_kind(name) is None:
+        raise HTTPException(status_code=400, detail="Only ZIP and TAR archives can be extracted")
+    if extract and SERVER_WORKERS > 1 and not UPLOAD_STICKY_ROUTING:
+        raise HTTPException(status_code=400, detail="Archive extraction is not available on this server, "
+                                                    "upload the archive as a file")
+
+    upload = UploadSession(
+        id=uuid.uuid4().hex,
+        project_id=project_id,
+        user_id=current_user.id,
+        filename=name,
+        length=upload_length,
+        expected_crc32=expected_crc32,
+        extract=extract or None,
+    )
+    remaining = await usage.remaining_bytes(current_user) if extract else None  # before this upload is reserved
+    if not await usage.reserve(current_user, upload):  # before a single byte is accepted
+        raise HTTPException(status_code=413, detail="Storage quota exceeded")
+    if extract:
+        _extractors[upload.id] = ArchiveExtractor(project_id, archive_kind(name), remaining)
+        _extractors[upload.id].start()
+    else:
+        os.makedirs(os.path.dirname(partial_path(upload)), exist_ok=True)
+        open(partial_path(upload), "wb").close()
+
+    headers = upload_headers(upload)
+    headers["Location"] = f"/uploads/{upload.id}"
+    if upload_length == 0:
+        await complete_upload(upload)
+    return Response(status_code=status.HTTP_201_CREATED, headers=headers)
+
+
+@router.get("/uploads")
+async def list_uploads(current_user: Annotated[User, Depends(get_current_active_user)]):
+    # lets a client that lost its upload ids resume or delete them (and free their quota)
+    async with async_session_maker() as session:
+        uploads = (await session.exec(select(UploadSession).where(
+            UploadSession.user_id == current_user.id, UploadSession.completed == False,  # noqa: E712
+        ).order_by(UploadSession.created_at))).all()
+    return [
+        {"id": upload.id, "project_id": upload.project_id, "filename": upload.filename, "length": upload.length,
+         "offset": upload.offset, "extract": bool(upload.extract), "direct": upload.storage_key is not None,
+         "error": upload.error, "expires": expires_at(upload).isoformat()}
+        for upload in uploads
+    ]
+
+
+@router.head("/uploads/{upload_id}")
+async def get_upload_offset(
+    upload_id: str,
+    current_user: Annotated[User, Depends(get_current_active_user)],
+):
+    upload = await get_upload_for_user(upload_id, current_user)
+    return Response(status_code=status.HTTP_200_OK, headers=upload_headers(upload))
+
+
+@router.patch("/uploads/{upload_id}")
+async def append_chunk(
+    upload_id: str,
+    request: Request,
+    current_user: Annotated[User, Depends(get_current_active_user)],
+    upload_offset: Annotated[int, Header()],
+    upload_checksum: Annotated[str | None, Header()] = None,
+):
+    if request.headers.get("content-type") != "application/offset+octet-stream":
+        raise HTTPException(status_code=415, detail="Expected application/offset+octet-stream")
+    upload = await get_upload_for_user(upload_id, current_user)
+    if upload.storage_key is not None:
+        raise HTTPException(status_code=409, detail="Direct upload, send the parts to their storage URLs")
+    if upload.completed:
+        raise HTTPException(status_code=409, detail="Upload already completed")
+    if upload_offset != upload.offset:
+        raise HTTPException(
+            status_code=409, detail="Upload-Offset does not match the committed offset",
+            headers=upload_headers(upload))
+    if upload.id in _active_uploads:
+        raise HTTPException(status_code=423, detail="Another chunk is being written for this upload")
+
+    try:
+        size = parse_content_length(request.headers.get("content-length"))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid Content-Length")
+    # without a length (chunked), the rest of the upload is reserved
+    size = upload.length - upload.offset if size is None else min(size, upload.length - upload.offset)
+
+    _active_uploads.add(upload.id)
+    try:
+        async with governor.admit(current_user.username, size, project_dir(upload.project_id)):
+            upload = await receive_chunk(upload, request, upload_checksum, current_user.username)
+    except UploadRejected as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail, headers={**upload_headers(upload), **e.headers})
+    finally:
+        _active_uploads.discard(upload.id)
+    return Response(status_code=status.HTTP_204_NO_CONTENT, headers=upload_headers(upload))
+
+
+@router.delete("/uploads/{upload_id}")
+async def terminate_upload(
+    upload_id: str,
+    current_user: Annotated[User, Depends(get_current_active_user)],
+):
+    upload = await get_upload_for_user(upload_id, current_user)
+    if upload.completed:
+        raise HTTPException(status_code=409, detail="Upload already completed")
+    await discard_upload(upload)
+    return Response(status_code=status.HTTP_204_NO_CONTENT, headers={"Tus-Resumable": TUS_VERSION})
+
+
+async def discard_upload(upload: UploadSession) -> None:
+    extractor = _extractors.pop(upload.id, None)
+    if extractor is not None:
+        await extractor.abort()
+    if os.path.exists(partial_path(upload)):
+        os.remove(partial_path(upload))
+    _upload_digests.pop(upload.id, None)
+    async with async_session_maker() as session:
+        stored = await session.get(UploadSession, upload.id)
+        if stored is not None:
+            await session.delete(stored)
+            await session.commit()
+
+
+async def expire_uploads() -> int:
+    # deletes unfinished uploads without a chunk for UPLOAD_EXPIRES_AFTER, with their partial files and
+    # multipart uploads; imports of direct uploads are left to their resumer. Returns how many
+    cutoff = utcnow() - timedelta(seconds=UPLOAD_EXPIRES_AFTER)
+    async with async_session_maker() as session:
+        expired = (await session.exec(select(UploadSession).where(
+            UploadSession.completed == False,  # noqa: E712
+            func.coalesce(UploadSession.active_at, UploadSession.created_at) < cutoff,
+            (UploadSession.storage_key == None) | (UploadSession.multipart_id != None)  # noqa: E711
+            | (UploadSession.error != None),  # noqa: E711
+        ))).all()
+    count = 0
+    for upload in expired:
+        if upload.id in _active_uploads:  # a chunk is arriving right now
+            continue
+        if upload.multipart_id is not None and (storage := get_storage()) is not None:
+            try:
+                await run_in_threadpool(storage.abort_multipart, upload.storage_key, upload.multipart_id)
+            except Exception as e:
+                print(f"[uploads] aborting {upload.storage_key} failed: {e!r}")
+        await discard_upload(upload)
+        count += 1
+    return count
+
+
+async def complete_upload(upload: UploadSession) -> None:
+    if upload.expected_crc32 is not None and upload.expected_crc32 != upload.crc32:
+        # some chunk was corrupted, there is no telling which - free the quota and the disk, start over
+        await discard_upload(upload)
+        raise HTTPException(status_code=460, detail="File checksum mismatch, upload the file again")
+    if upload.extract:
+        try:
+            await _extractors.pop(upload.id).finish()  # counted in lotografia_archive_members_total
+        except ArchiveError as e:
+            await discard_upload(upload)
+            raise HTTPException(status_code=422, detail=str(e))
+    else:
+        sha256 = (await upload_digest(upload)).hexdigest()
+        await run_in_threadpool(_finish, upload)
+        _upload_digests.pop(upload.id, None)
+        await ingest_file(upload.project_id, upload.filename, sha256)
+    async with async_session_maker() as session:
+        stored = await session.get(UploadSession, upload.id)
+        stored.completed = True
+        session.add(stored)
+        await session.commit()
+    upload.completed = True
+
+
+def test_parse_upload_metadata():
+    assert parse_upload_metadata("filename ZHJvbmUuanBn,empty") == {"filename": "drone.jpg", "empty": ""}
+    assert parse_upload_metadata(None) == {}
+    for header in ("filename not-base64!", "filename //79"):  # bad base64, not UTF-8
+        try:
+            parse_upload_metadata(header)
+        except HTTPException as e:
+            assert e.status_code == 400
+        else:
+            raise AssertionError(header)
+
+
+def test_expired_upload_frees_quota():
+    import asyncio
+    from sqlmodel import Session
+    from db_connector import create_db_and_tables, engine
+    from models import Project
+    create_db_and_tables()
+    with Session(engine) as session:
+        user = User(username=f"uploads-test-{uuid.uuid4().hex}", storage_quota=100)
+        session.add(user)
+        session.commit()
+        project = Project(name="uploads-test", user_id=user.id)
+        session.add(project)
+        session.commit()
+        session.refresh(user)
+        project_id = project.id
+
+    def new_upload() -> UploadSession:
+        return UploadSession(id=uuid.uuid4().hex, project_id=project_id, user_id=user.id, filename="a.bin", length=100)
+
+    async def scenario():
+        idle = new_upload()
+        assert await usage.reserve(user, idle) and not await usage.reserve(user, new_upload())
+        os.makedirs(os.path.dirname(partial_path(idle)), exist_ok=True)
+        open(partial_path(idle), "wb").close()
+        async with async_session_maker() as session:
+            stored = await session.get(UploadSession, idle.id)
+            stored.active_at = utcnow() - timedelta(seconds=UPLOAD_EXPIRES_AFTER + 1)
+            session.add(stored)
+            await session.commit()
+        assert await expire_uploads() == 1 and not os.path.exists(partial_path(idle))
+        assert await usage.reserve(user, new_upload())
+
+    asyncio.run(scenario())
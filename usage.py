@@ -0,0 +1,227 @@
+### === STORAGE USAGE AND QUOTAS === ###
+# Per-project and per-user file/byte counters, kept by file_index in the same transaction as the
+# ProjectFile change (the same way blobs keeps refcounts), so usage is a primary-key read instead
+# of a directory walk. Bytes are logical: a file stored once but present in two projects counts twice.
+# Uploads are admitted against the quota before any data is accepted; the bytes of unfinished
+# resumable uploads are reserved until they complete or expire (uploads.expire_uploads, run by
+# the reconciler loop). A periodic full reconcile corrects drift against the disk.
+# Every uvicorn worker runs the reconciler loop, but each run is claimed in the database
+# (ScheduledRun), so the sweep and the reconcile happen once per interval for all of them.
+import asyncio
+import os
+import socket
+import uuid
+from datetime import timedelta
+
+from sqlalchemy import func, literal, update
+from sqlalchemy.dialects.sqlite import insert
+from sqlmodel import Session, select
+from starlette.concurrency import run_in_threadpool
+
+from config import USER_QUOTA_BYTES, USAGE_RECONCILE_INTERVAL
+from db_connector import async_session_maker
+from models import Project, ProjectFile, ProjectUsage, ScheduledRun, UploadSession, User, UserUsage, utcnow
+
+UPLOAD_SWEEP_INTERVAL = 600  # seconds between looks for expired uploads
+
+
+### Counters (inside the caller's session)
+def record(session: Session, project_id: int, files: int, size: int) -> None:
+    # adds to the counters of a project and, unless the project is deleted, of its owner
+    if not files and not size:
+        return
+    project = session.get(Project, project_id)
+    targets = [(ProjectUsage, ProjectUsage.project_id, project_id)]
+    if project is not None and project.deleted_at is None:
+        targets.append((UserUsage, UserUsage.user_id, project.user_id))
+    for model, key, value in targets:
+        session.execute(insert(model).values({key.key: value}).on_conflict_do_nothing())
+        session.execute(update(model).where(key == value).values(files=model.files + files, size=model.size + size))
+
+
+async def detach_project(session, project_id: int) -> None:
+    # a deleted project stops counting against its owner right away, while its files are reclaimed
+    project = await session.get(Project, project_id)
+    counters = await session.get(ProjectUsage, project_id)
+    if counters is None or project.user_id is None:
+        return
+    await session.execute(update(UserUsage).where(UserUsage.user_id == project.user_id).values(
+        files=UserUsage.files - counters.files, size=UserUsage.size - counters.size))
+
+
+def recount(session: Session) -> int:
+    # rebuilds every counter from the ProjectFile rows; returns how many counters had drifted
+    per_project = {project_id: (files, size) for project_id, files, size in session.exec(
+        select(ProjectFile.project_id, func.count(ProjectFile.id), func.coalesce(func.sum(ProjectFile.size), 0))
+        .group_by(ProjectFile.project_id)
+    ).all()}
+    per_user = {}
+    for project_id, user_id in session.exec(
+        select(Project.id, Project.user_id).where(Project.deleted_at.is_(None), Project.user_id.is_not(None))
+    ).all():
+        files, size = per_project.get(project_id, (0, 0))
+        user_files, user_size = per_user.get(user_id, (0, 0))
+        per_user[user_id] = (user_files + files, user_size + size)
+    drifted = 0
+    for model, key, expected in ((ProjectUsage, "project_id", per_project), (UserUsage, "user_id", per_user)):
+        for row in session.exec(select(model)).all():
+            files, size = expected.pop(getattr(row, key), (0, 0))
+            if (row.files, row.size) != (files, size):
+                drifted += 1
+                row.files, row.size = files, size
+                session.add(row)
+        for owner, (files, size) in expected.items():
+            drifted += 1
+            session.add(model(**{key: owner}, files=files, size=size))
+    return drifted
+
+
+### Admission control
+def quota_for(user: User) -> int | None:
+    # None = unlimited
+    quota = user.storage_quota if user.storage_quota is not None else USER_QUOTA_BYTES
+    return quota or None
+
+
+def used_bytes(user_id: int):
+    # stored bytes plus the full length of unfinished uploads, as a scalar subquery
+    stored = select(func.coalesce(func.max(UserUsage.size), 0)).where(UserUsage.user_id == user_id)
+    reserved = select(func.coalesce(func.sum(UploadSession.length), 0)).where(
+        UploadSession.user_id == user_id, UploadSession.completed == False,  # noqa: E712
+        UploadSession.error == None)  # noqa: E711 - failed imports hold no bytes
+    return stored.scalar_subquery() + reserved.scalar_subquery()
+
+
+async def remaining_bytes(user: User) -> int | None:
+    # quota minus stored bytes minus the full length of unfinished uploads; None = unlimited
+    quota = quota_for(user)
+    if quota is None:
+        return None
+    async with async_session_maker() as session:
+        return quota - (await session.exec(select(used_bytes(user.id)))).one()
+
+
+async def admits(user: User, size: int) -> bool:
+    remaining = await remaining_bytes(user)
+    return remaining is None or size <= remaining
+
+
+async def reserve(user: User, upload: UploadSession) -> bool:
+    # inserts the upload session unless its length is more than is left of the quota; the check and the
+    # insert are one statement, so two uploads cannot both take the last bytes
+    quota = quota_for(user)
+    async with async_session_maker() as session:
+        if quota is None:
+            session.add(upload)
+            await session.commit()
+            return True
+        table = UploadSession.__table__
+        values = {column.name: getattr(upload, column.name) for column in table.columns}
+        result = await session.execute(insert(table).from_select(list(values), select(
+            *(literal(value, table.c[name].type) for name, value in values.items())
+        ).where(literal(quota) - used_bytes(user.id) >= upload.length)))
+        await session.commit()
+    return bool(result.rowcount)
+
+
+async def get_user_usage(user_id: int) -> UserUsage:
+    async with async_session_maker() as session:
+        return await session.get(UserUsage, user_id) or UserUsage(user_id=user_id)
+
+
+### Periodic reconcile
+class UsageReconciler:
+    # runs the full file index reconcile (disk -> index -> blob refcounts and usage counters) every interval,
+    # and expires idle uploads every UPLOAD_SWEEP_INTERVAL
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.task: asyncio.Task | None = None
+
+    def start(self) -> None:
+        self.task = asyncio.create_task(self.loop())
+
+    async def stop(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+
+    async def claim(self, name: str, interval: float) -> bool:
+        # takes the run of a periodic task that is due, for all workers; the first claim only schedules it
+        now = utcnow()
+        async with async_session_maker() as session:
+            await session.execute(insert(ScheduledRun).values(
+                name=name, next_run_at=now + timedelta(seconds=interval),
+            ).on_conflict_do_nothing())
+            result = await session.execute(update(ScheduledRun).where(
+                ScheduledRun.name == name, ScheduledRun.next_run_at <= now,
+            ).values(owner=self.owner, next_run_at=now + timedelta(seconds=interval))
+             .execution_options(synchronize_session=False))
+            await session.commit()
+        return result.rowcount == 1
+
+    async def loop(self) -> None:
+        import file_index  # file_index keeps the counters through this module
+        import uploads
+        while True:
+            await asyncio.sleep(min(self.interval, UPLOAD_SWEEP_INTERVAL) if self.interval > 0 else UPLOAD_SWEEP_INTERVAL)
+            try:
+                if await self.claim("expire_uploads", UPLOAD_SWEEP_INTERVAL):
+                    if expired := await uploads.expire_uploads():
+                        print(f"[usage] expired {expired} idle uploads")
+            except Exception as e:
+                print(f"[usage] expiring uploads failed: {e!r}")
+            try:
+                if self.interval <= 0 or not await self.claim("reconcile", self.interval):
+                    continue
+                report = await run_in_threadpool(file_index.reconcile)
+                print(f"[usage] reconcile: {report}")
+            except Exception as e:
+                print(f"[usage] reconcile failed: {e!r}")
+
+
+reconciler = UsageReconciler(USAGE_RECONCILE_INTERVAL)
+
+
+def test_counters_match_reconcile():
+    import os
+    import uuid
+    import file_index
+    from config import USER_PROJECTS_PATH
+    from db_connector import create_db_and_tables, engine
+    # the full reconcile walks every project - only ever on the temporary tree of conftest.py
+    assert "lotografia-test-" in USER_PROJECTS_PATH, "run it through pytest"
+    create_db_and_tables()
+    with Session(engine) as session:
+        user = User(username=f"usage-test-{uuid.uuid4().hex}")
+        session.add(user)
+        session.commit()
+        project = Project(name="usage-test", user_id=user.id)
+        session.add(project)
+        session.commit()
+        user_id, project_id = user.id, project.id
+    os.makedirs(file_index.project_dir(project_id))
+
+    def put(name: str, size: int) -> None:
+        with open(os.path.join(file_index.project_dir(project_id), name), "wb") as f:
+            f.write(os.urandom(size))
+
+    def counters() -> tuple:
+        with Session(engine) as session:
+            project, user = session.get(ProjectUsage, project_id), session.get(UserUsage, user_id)
+            return (project.files, project.size), (user.files, user.size)
+
+    for name, size in (("a.bin", 100), ("b.bin", 200)):
+        put(name, size)
+        file_index.index_file(project_id, name)
+    assert counters() == ((2, 300), (2, 300))
+    # changes behind the index's back: a new file, a removed one and a counter that drifted
+    put("c.bin", 400)
+    os.remove(os.path.join(file_index.project_dir(project_id), "a.bin"))
+    with Session(engine) as session:
+        session.execute(update(UserUsage).where(UserUsage.user_id == user_id).values(size=1))
+        session.commit()
+    report = file_index.reconcile()
+    assert report["added"] >= 1 and report["removed"] >= 1 and report["usage_corrected"] >= 1
+    assert counters() == ((2, 600), (2, 600))
+    with Session(engine) as session:
+        assert recount(session) == 0
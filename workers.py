@@ -0,0 +1,34 @@
+### === BACKGROUND WORKERS === ###
+# Shared process pool for CPU-heavy work triggered by uploads (octrees, image pyramids, ...).
+import multiprocessing
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+
+from config import BACKGROUND_WORKERS
+
+_pool: ProcessPoolExecutor | None = None
+_pool_lock = threading.Lock()  # work is submitted from threadpool threads too
+
+
+def get_pool() -> ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawn: the server process has threads, forking it is not safe
+            _pool = ProcessPoolExecutor(max_workers=BACKGROUND_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _pool
+
+
+def submit(label: str, func, *args, on_done=None) -> Future:
+    future = get_pool().submit(func, *args)
+
+    def report(done: Future) -> None:
+        if done.exception() is not None:
+            print(f"[worker] {label} failed: {done.exception()!r}")
+        else:
+            print(f"[worker] {label} done: {done.result()}")
+        if on_done is not None:
+            on_done(done)
+
+    future.add_done_callback(report)
+    return future